@@ -0,0 +1,141 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark ASCII mode, ChatbotEngine(ascii=True), which normalizes ASCII
+messages with bytes.translate and matches them with regular expressions
+compiled with re.ASCII, against the usual Unicode handling. Times making
+Targets for messages of 1, 10 and 500 words, matching messages against a
+topic of 1000 made-up patterns, and whole replies from the valves script.
+(The eliza topic has a few non-ASCII patterns, so it doesn't use ASCII
+mode.)
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import time
+
+from benchutil import (best_time, load_engine, print_table,
+                       synthetic_messages, synthetic_patterns,
+                       synthetic_topic, vocabulary)
+from chatbot_reply.patterns import _ASCII_FLAG, Pattern, VariableLayers
+from chatbot_reply.reply import Target
+
+NUMBER = 1000
+ROUNDS = 200
+
+WILDCARD_PATTERNS = ["_* is _* of _*", "* a * b * c", "[*] the machine [*]",
+                     "_@ [#] is *", "_@ *"]
+
+VALVES_MESSAGES = ["status", "valve status", "shutoff valve status",
+                   "is the main water valve open", "close the drain valve",
+                   "turn the water on", "drain the house", "open it",
+                   "what is the water drain valve status", "hello robot"]
+
+
+def make_message(length, words, rnd):
+    punctuation = ["", "", "", ",", ".", "!", "'s", "?"]
+    return " ".join(rnd.choice(words).capitalize() + rnd.choice(punctuation)
+                    for i in range(length))
+
+
+def usec(seconds, number):
+    return "{0:.1f}".format(seconds / number * 1e6)
+
+
+def time_targets(table):
+    rnd = random.Random(0)
+    words = vocabulary(1000)
+    rows = []
+    for length in [1, 10, 500]:
+        message = make_message(length, words, rnd)
+        for label, subs in [("none", None), ("eliza", table)]:
+            plain = Target(message, [], subs)
+            fast = Target(message, [], subs, ascii=True)
+            assert plain.tokenized_words == fast.tokenized_words
+            times = [best_time(lambda: Target(message, [], subs, ascii),
+                               number=NUMBER) for ascii in (False, True)]
+            rows.append((length, label, usec(times[0], NUMBER),
+                         usec(times[1], NUMBER),
+                         "{0:.1f}x".format(times[0] / times[1])))
+    print("Making Targets:")
+    print_table(("words", "substitutions", "unicode usec", "ascii usec",
+                 "speedup"), rows)
+
+
+def time_matching():
+    words = vocabulary(300)
+    patterns = synthetic_patterns(1000, words)
+    messages = [Target(m) for m in synthetic_messages(200, words, patterns)]
+    variables = VariableLayers({"u": {}}, {"b": {}})
+    rows = []
+    for matcher in ["index", "linear"]:
+        results = []
+        times = []
+        for ascii in (False, True):
+            topic = synthetic_topic(patterns)
+            topic.set_ascii(ascii)
+            if matcher == "index":
+                run = lambda: [topic.match(t, [], variables)[0]
+                               for t in messages]
+            else:
+                run = lambda: [[rule.pattern.match(t.normalized, variables)
+                                is not None for rule in topic.sortedrules]
+                               for t in messages[:20]]
+            results.append([getattr(r, "rulename", r) for r in run()])
+            times.append(best_time(run, number=3))
+        assert results[0] == results[1]
+        count = 3 * (len(messages) if matcher == "index" else 20)
+        rows.append((matcher, usec(times[0], count), usec(times[1], count),
+                     "{0:.1f}x".format(times[0] / times[1])))
+    print("Matching messages against 1000 patterns:")
+    print_table(("rules tried", "unicode usec/msg", "ascii usec/msg",
+                 "speedup"), rows)
+
+    # Most of those patterns fail on their first word. Wildcards have to
+    # check the class of every character they pass over.
+    rnd = random.Random(0)
+    message = " ".join(rnd.choice(words) for i in range(30))
+    rows = []
+    for raw in WILDCARD_PATTERNS:
+        plain, fast = Pattern(raw, {}), Pattern(raw, {})
+        fast.set_ascii(True)
+        times = [best_time(lambda: p.match(message, variables),
+                           number=NUMBER) for p in (plain, fast)]
+        rows.append((raw, usec(times[0], NUMBER), usec(times[1], NUMBER),
+                     "{0:.1f}x".format(times[0] / times[1])))
+    print("Matching a 30 word message against patterns with wildcards:")
+    print_table(("pattern", "unicode usec", "ascii usec", "speedup"), rows)
+
+
+def time_replies():
+    rows = []
+    replies = []
+    for label, ascii in [("unicode", False), ("ascii", True)]:
+        ch = load_engine(["valves.py"], ascii=ascii)
+        assert ch.rules_db.topics["all"].ascii == ascii
+        random.seed(0)  # valves picks some replies at random
+        ch.reply("bench", {}, "hello")
+        start = time.time()
+        replies.append([ch.reply("bench", {}, m)
+                        for i in range(ROUNDS) for m in VALVES_MESSAGES])
+        elapsed = time.time() - start
+        rows.append((label, usec(elapsed, ROUNDS * len(VALVES_MESSAGES))))
+    assert replies[0] == replies[1]
+    print("valves replies:")
+    print_table(("mode", "usec/reply"), rows)
+
+
+def main():
+    if _ASCII_FLAG is None:
+        print("ASCII mode needs Python 3.7 or later")
+        return
+    eliza = load_engine(["eliza.py"])
+    time_targets(eliza.rules_db.topics["eliza"].substitution_table)
+    time_matching()
+    time_replies()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark normalize_messages on a corpus of made-up messages, with no
+substitutions and with the eliza topic's, against making a Target for
+each message. Pass a number of processes on the command line to also try
+normalize_messages with a process pool.
+
+Without substitutions, a whole chunk of messages is joined and normalized
+with one bytes.translate. With eliza's substitution table, the words of
+the whole chunk are also looked up in the table together. Either way,
+what is left to do a message at a time in Python is splitting it into
+words and counting their offsets, which profiling shows takes about half
+the time. So substitutions roughly halve the rate, and don't bring it to
+several hundred thousand messages a second. No rules are matched here. On
+one CPU, a pool only adds the cost of pickling the messages and results.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import sys
+import time
+
+from benchutil import load_engine, print_table, vocabulary
+from chatbot_reply.reply import Target, normalize_messages
+
+COUNT = 200000
+
+
+def make_messages(count, words, rnd):
+    punctuation = ["", "", "", ",", ".", "!", "'s", "?"]
+    contractions = ["I'm", "don't", "can't", "you're"]
+    words = words + contractions * 10
+    return [" ".join(rnd.choice(words).capitalize() + rnd.choice(punctuation)
+                     for j in range(rnd.randint(1, 12)))
+            for i in range(count)]
+
+
+def rate(func):
+    start = time.time()
+    count = sum(1 for result in func())
+    return "{0:,.0f}".format(count / (time.time() - start))
+
+
+def main():
+    processes = [int(arg) for arg in sys.argv[1:]]
+    messages = make_messages(COUNT, vocabulary(1000), random.Random(0))
+    eliza = load_engine(["eliza.py"]).rules_db.topics["eliza"]
+    rows = []
+    for label, topic in [("none", None), ("eliza", eliza)]:
+        subs, table = [], None
+        if topic is not None:
+            subs, table = topic.substitutions, topic.substitution_table
+        rows.append((label, "Target",
+                     rate(lambda: (Target(m, subs, table)
+                                   for m in messages))))
+        rows.append((label, "batch",
+                     rate(lambda: normalize_messages(messages, topic))))
+        for n in processes:
+            rows.append((label, "batch, {0} processes".format(n),
+                         rate(lambda: normalize_messages(messages, topic,
+                                                         processes=n))))
+    print_table(("substitutions", "normalizer", "messages/sec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark starting an engine for made-up scripts of 20 topics of 500
+rules each, by loading the script directory and sorting the rules, as a
+worker process does without a bundle, and by loading a bundle saved from
+another engine. Patterns from a bundle compile their regular expressions
+the first time they are matched, so the last column also times matching
+100 messages, half of them made to match, in every topic.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import (print_table, synthetic_messages, synthetic_patterns,
+                       vocabulary, write_synthetic_script)
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.reply import Target
+
+TOPICS = 20
+RULES = 500
+REPEAT = 3
+MESSAGES = 100
+
+
+def from_scripts(directory, bundle):
+    ch = ChatbotEngine()
+    ch.load_script_directory(directory)
+    ch.rules_db.sort_rules()
+    return ch
+
+
+def from_bundle(directory, bundle):
+    ch = ChatbotEngine()
+    ch.load_bundle(bundle, directory)
+    return ch
+
+
+def start(load, directory, bundle, messages):
+    """ Return the rules of an engine started by load, the seconds taken to
+    start it, and the seconds to start it and match messages, a dictionary
+    of lists of Targets by topic name.
+    """
+    begin = time.time()
+    ch = load(directory, bundle)
+    loaded = time.time() - begin
+    for name, targets in messages.items():
+        topic = ch.rules_db.topics[name]
+        for target in targets:
+            topic.match(target, [], {})
+    matched = time.time() - begin
+    rules = dict((name, [r.rulename for r in topic.sortedrules])
+                 for name, topic in ch.rules_db.topics.items())
+    return rules, loaded, matched
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    bundle_dir = tempfile.mkdtemp()
+    bundle = os.path.join(bundle_dir, "scripts.bundle")
+    try:
+        words = vocabulary(2000)
+        messages = {}
+        for i in range(TOPICS):
+            name = "topic{0}".format(i)
+            write_synthetic_script(directory, RULES, name=name, seed=i,
+                                   topic=name)
+            patterns = synthetic_patterns(RULES, words, i)
+            messages[name] = [Target(m) for m in synthetic_messages(
+                MESSAGES, words, patterns, i)]
+        begin = time.time()
+        from_scripts(directory, None).save_bundle(bundle)
+        saved = time.time() - begin
+        rows = []
+        expected = None
+        for label, load in [("load_script_directory", from_scripts),
+                            ("load_bundle", from_bundle)]:
+            times = []
+            for i in range(REPEAT):
+                rules, loaded, matched = start(load, directory, bundle,
+                                               messages)
+                if expected is None:
+                    expected = rules
+                assert rules == expected
+                times.append((loaded, matched))
+            loaded, matched = min(times)
+            rows.append((label, "{0:.0f}".format(loaded * 1e3),
+                         "{0:.0f}".format(matched * 1e3)))
+        size = os.path.getsize(bundle)
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(bundle_dir)
+    print("{0} topics of {1} rules, bundle of {2:.1f} MB saved in "
+          "{3:.0f} msec:".format(TOPICS, RULES, size / 1e6, saved * 1e3))
+    print_table(("start", "msec", "start and match msec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark remembering replies as LazyTargets, which are only normalized
+when a rule with a previous reply pattern looks at them, against making a
+Target for every reply the way ChatbotEngine._remember used to. eliza has
+no previous reply patterns, and valves has a few.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import time
+
+from benchutil import load_engine, print_table
+from chatbot_reply import reply
+from chatbot_reply.reply import ChatbotEngine
+
+ROUNDS = 100
+
+ELIZA_MESSAGES = ["I remember my mother's cooking", "I am sad about my job",
+                  "why can't I sleep at night", "My father is like a machine",
+                  "I feel like nobody listens", "you are not very helpful"]
+
+VALVES_MESSAGES = ["status", "valve status", "close the drain valve",
+                   "open it", "is the main water valve open", "close it",
+                   "turn the water on", "hello robot"]
+
+
+class Counter(object):
+    targets = 0
+
+
+class CountingTarget(reply.Target):
+    def __init__(self, *args, **kwargs):
+        Counter.targets += 1
+        super(CountingTarget, self).__init__(*args, **kwargs)
+
+
+def eager_remember(self, user, message, reply):
+    """ ChatbotEngine._remember as it used to be """
+    user_info = self._users[user]
+    topic_name = user_info.topic_name
+    user_info.msg_history.appendleft(message)
+    user_info.repl_history.appendleft(
+        self._make_target(reply, self.rules_db.topics[topic_name]))
+
+
+lazy_remember = ChatbotEngine._remember
+
+
+def run(ch, user, greeting, messages):
+    random.seed(0)
+    ch.reply(user, {}, greeting)
+    Counter.targets = 0
+    replies = []
+    start = time.time()
+    for i in range(ROUNDS):
+        for message in messages:
+            replies.append(ch.reply(user, {}, message))
+    elapsed = time.time() - start
+    count = float(ROUNDS * len(messages))
+    return replies, Counter.targets / count, elapsed / count * 1e6
+
+
+def main():
+    rows = []
+    saved, reply.Target = reply.Target, CountingTarget
+    try:
+        for name, greeting, messages in [
+                ("eliza", "talk to eliza", ELIZA_MESSAGES),
+                ("valves", "hello", VALVES_MESSAGES)]:
+            ch = load_engine([name + ".py"])
+            run(ch, "warm up", greeting, messages)
+            results = []
+            for label, remember in [("eager", eager_remember),
+                                    ("lazy", lazy_remember)]:
+                ChatbotEngine._remember = remember
+                try:
+                    replies, targets, usec = run(ch, label, greeting,
+                                                 messages)
+                finally:
+                    ChatbotEngine._remember = lazy_remember
+                results.append(replies)
+                rows.append((name, label, "{0:.2f}".format(targets),
+                             "{0:.1f}".format(usec)))
+            assert results[0] == results[1]
+    finally:
+        reply.Target = saved
+    print_table(("script", "history", "targets/reply", "usec/reply"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark loading made-up scripts of 200 topics of 100 rules each, with
+every topic built when loaded, and in lazy mode where each one is built
+when a user first enters it. Each mode is run in a fresh process, which
+reports the time and resident memory after loading, after a user's first
+reply in the "all" topic, and after visiting 10 other topics.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchutil import print_table, write_synthetic_script
+from chatbot_reply import ChatbotEngine
+
+TOPICS = 200
+RULES = 100
+VISITS = 10
+
+
+def rss_mb():
+    """ Return the resident set size of this process in megabytes """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def write_scripts(directory):
+    for i in range(TOPICS):
+        write_synthetic_script(directory, RULES, name="topic{0}".format(i),
+                               seed=i, topic="topic{0}".format(i))
+    with open(os.path.join(directory, "all.py"), "w") as f:
+        f.write("from __future__ import unicode_literals\n"
+                "from chatbot_reply import Script, rule\n"
+                "class Main(Script):\n"
+                '    @rule("hello")\n'
+                "    def rule_hello(self):\n"
+                '        return "hi"\n'
+                '    @rule("go to _*")\n'
+                "    def rule_go(self):\n"
+                '        self.current_topic = self.match["match0"]\n'
+                '        return "ok"\n')
+
+
+def measure(directory, lazy):
+    """ Run in a child process: load the scripts and print a JSON list of
+    (step, seconds, megabytes) """
+    steps = [("start", 0, rss_mb())]
+    start = time.time()
+    ch = ChatbotEngine(lazy=lazy)
+    ch.load_script_directory(directory)
+    ch.rules_db.sort_rules()
+    steps.append(("loaded", time.time() - start, rss_mb()))
+    assert ch.reply("local", {}, "hello") == "hi"
+    steps.append(("first reply", time.time() - start, rss_mb()))
+    for i in range(VISITS):
+        ch._users["local"].topic_name = "all"
+        assert ch.reply("local", {}, "go to topic{0}".format(i)) == "ok"
+        ch.reply("local", {}, "hello")
+    steps.append(("visited {0} topics".format(VISITS), time.time() - start,
+                  rss_mb()))
+    print(json.dumps(steps))
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        write_scripts(directory)
+        rows = []
+        for label in ["eager", "lazy"]:
+            output = subprocess.check_output(
+                [sys.executable, __file__, directory, label])
+            steps = json.loads(output.decode("utf-8").splitlines()[-1])
+            base = steps[0][2]
+            for step, seconds, mb in steps[1:]:
+                rows.append((label, step, "{0:.0f}".format(seconds * 1e3),
+                             "{0:.1f}".format(mb - base)))
+    finally:
+        shutil.rmtree(directory)
+    print("{0} topics of {1} rules:".format(TOPICS, RULES))
+    print_table(("mode", "after", "msec", "RSS MB added"), rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        measure(sys.argv[1], sys.argv[2] == "lazy")
+    else:
+        main()
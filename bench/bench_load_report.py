@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark loading 300 made-up script files in 10 packages, most with 20
+rules and a few with 1000, compiling them from source every time and using
+.pyc files (cold, when they are first written, and warm), and print the
+slowest files from the load report, which should be the big ones.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import print_table, write_synthetic_script
+from chatbot_reply import ChatbotEngine
+
+PACKAGES = 10
+FILES = 30
+RULES = 20
+BIG_RULES = 1000
+BIG_EVERY = 50
+
+
+def write_scripts(directory):
+    for i in range(PACKAGES):
+        package = os.path.join(directory, "package{0}".format(i))
+        os.mkdir(package)
+        io.open(os.path.join(package, "__init__.py"), "w").close()
+        for j in range(FILES):
+            n = i * FILES + j
+            write_synthetic_script(package,
+                                   BIG_RULES if n % BIG_EVERY == 0 else RULES,
+                                   name="script{0}".format(j), seed=n)
+
+
+def load(directory, bytecode):
+    ch = ChatbotEngine()
+    start = time.time()
+    report = ch.load_script_directory(directory, bytecode=bytecode)
+    return time.time() - start, report
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        write_scripts(directory)
+        rows = []
+        for label, bytecode in [("from source", False),
+                                ("pyc cold", True),
+                                ("pyc warm", True)]:
+            loaded, report = load(directory, bytecode)
+            imported = sum(t[0] for t in report.files.values())
+            rules = sum(t[1] for t in report.files.values())
+            rows.append((label, "{0:.0f}".format(loaded * 1e3),
+                         "{0:.0f}".format(imported * 1e3),
+                         "{0:.0f}".format(rules * 1e3)))
+        print("{0} files:".format(len(report.files)))
+        print_table(("scripts", "load msec", "import msec", "rules msec"),
+                    rows)
+        print()
+        print(report.format(8).replace(directory + os.sep, ""))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
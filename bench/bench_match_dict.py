@@ -0,0 +1,135 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark the lazy MatchDict on the eliza script. Before, Match built
+every matchN, raw_matchN and reply_ entry for every reply, and eliza's
+process_reply reflected all of them. Now entries are only looked up when
+read, and eliza only reflects the ones named in the reply. This counts the
+match values built per reply each way, and times the replies.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import bisect
+import random
+import time
+
+from benchutil import best_time, load_engine, print_table
+from chatbot_reply import Script, rules
+from chatbot_reply.patterns import Pattern
+from chatbot_reply.reply import Target
+
+ROUNDS = 100
+
+MESSAGES = ["I remember my mother's cooking",
+            "Do you remember when we talked about computers?",
+            "I am sad about my job", "I want a new car for my birthday",
+            "why can't I sleep at night", "My father is like a machine",
+            "I feel like nobody listens", "you are not very helpful",
+            "I dreamed about flying over the sea", "are you a computer",
+            "perhaps I was wrong about my sister", "I need a vacation"]
+
+
+class Counter(object):
+    values = 0
+
+
+class EagerMatchDict(dict):
+    """ The match dictionary as it used to be built """
+    def add_matches(self, m, target, prefix):
+        offsets = []
+        offset = 0
+        for wl in target.tokenized_words:
+            offsets.append(offset)
+            offset += len(" ".join(wl)) + 1
+        for k, v in m.groupdict().items():
+            self[prefix + k] = v
+            start, end = m.span(k)
+            i_start = bisect.bisect_left(offsets, start)
+            i_end = bisect.bisect(offsets, end)
+            self["raw_" + prefix + k] = " ".join(target.raw_words[i_start:
+                                                                  i_end])
+            Counter.values += 2
+
+
+def eager_process_reply(self, string):
+    """ eliza's process_reply as it used to be """
+    reflected_matches = {}
+    for k, v in self.match.items():
+        reflected_matches[k] = v
+        reflected_matches["refl_" + k] = self.reflect(v)
+    return string.format(*[], **reflected_matches)
+
+
+def counting_lookup(self, m, name, target, raw):
+    Counter.values += 1
+    return lazy_lookup(self, m, name, target, raw)
+
+
+lazy_lookup = rules.MatchDict._lookup
+
+
+def run(ch, user):
+    random.seed(0)  # eliza picks replies at random
+    ch.reply(user, {}, "talk to eliza")
+    Counter.values = 0
+    replies = []
+    start = time.time()
+    for i in range(ROUNDS):
+        for message in MESSAGES:
+            replies.append(ch.reply(user, {}, message))
+    elapsed = time.time() - start
+    count = float(ROUNDS * len(MESSAGES))
+    return replies, Counter.values / count, elapsed / count * 1e6
+
+
+def main():
+    ch = load_engine(["eliza.py"])
+    eliza = [inst for inst in ch.rules_db.script_instances
+             if inst.topic == "eliza"][0]
+    lazy_process_reply = eliza.process_reply
+
+    rows = []
+    run(ch, "warm up")
+    rules.MatchDict._lookup = counting_lookup
+    try:
+        lazy, lazy_values, lazy_usec = run(ch, "lazy")
+        rules.MatchDict, saved = EagerMatchDict, rules.MatchDict
+        eliza.process_reply = eager_process_reply.__get__(eliza)
+        try:
+            eager, eager_values, eager_usec = run(ch, "eager")
+        finally:
+            rules.MatchDict = saved
+            eliza.process_reply = lazy_process_reply
+    finally:
+        rules.MatchDict._lookup = lazy_lookup
+    assert lazy == eager
+
+    rows.append(("eager", "{0:.2f}".format(eager_values),
+                 "{0:.1f}".format(eager_usec)))
+    rows.append(("lazy", "{0:.2f}".format(lazy_values),
+                 "{0:.1f}".format(lazy_usec)))
+    print("eliza replies:")
+    print_table(("match dict", "values/reply", "usec/reply"), rows)
+
+    # A rule with six memorized groups which only uses one of them
+    pattern = Pattern("_* (is|was) _* [_*] and _@ _* [_#]", {})
+    target = Target("My old car, the blue one, was fast and Fred said so 42")
+    m = pattern.match(target.normalized, {})
+    script = Script()
+    rows = []
+    for label, cls in [("eager", EagerMatchDict),
+                       ("lazy", saved)]:
+        def build_and_read():
+            script.match = cls()
+            script.match.add_matches(m, target, "")
+            return script.process_reply("{raw_match0} was it?")
+        seconds = best_time(build_and_read, number=10000)
+        rows.append((label, "{0:.2f}".format(seconds / 10000 * 1e6)))
+    print("Building a Match with six groups and using one:")
+    print_table(("match dict", "usec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark rule selection: a linear scan of every rule in a topic against
+Topic.match with each of the matchers, for the eliza and valves example
+scripts and a synthetic topic of 50,000 rules.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+
+from benchutil import (best_time, load_engine, print_table, synthetic_messages,
+                       synthetic_patterns, synthetic_topic, vocabulary)
+from chatbot_reply.reply import Target
+
+MATCHERS = ["index", "trie", "regex"]
+
+ELIZA_MESSAGES = ["I remember my mother's cooking",
+                  "Do you remember when we talked about computers?",
+                  "I am sad about my job", "hello there",
+                  "why can't I sleep at night", "My father is like a machine",
+                  "what is going on", "yes", "I feel like nobody listens",
+                  "this is a long message about nothing much at all, really"]
+
+VALVES_MESSAGES = ["status", "valve status", "shutoff valve status",
+                   "is the main water valve open", "close the drain valve",
+                   "turn the water on", "drain the house", "open it",
+                   "what is the water drain valve status", "hello robot"]
+
+
+def linear_match(topic, target, history, variables):
+    for rule in topic.sortedrules:
+        m = rule.match(target, history, variables)
+        if m is not None:
+            return rule, m
+    return None, None
+
+
+def mean_candidates(topic, targets):
+    return (sum(len(list(topic.candidate_rules(t))) for t in targets) /
+            float(len(targets)))
+
+
+def time_topics(name, topics, messages, variables, number):
+    rows = []
+    history = collections.deque()
+    targets = [Target(m, topics["index"].substitutions,
+                      topics["index"].substitution_table) for m in messages]
+    results = []
+    for label, topic, match in [("linear", topics["index"], linear_match),
+                                ("index", topics["index"], None),
+                                ("trie", topics["trie"], None),
+                                ("regex", topics["regex"], None)]:
+        if match is None:
+            match = lambda topic, t, h, v: topic.match(t, h, v)
+        found = [match(topic, t, history, variables)[0] for t in targets]
+        results.append([rule and rule.rulename for rule in found])
+        seconds = best_time(lambda: [match(topic, t, history, variables)
+                                     for t in targets], number=number)
+        per_message = seconds / (number * len(targets)) * 1e6
+        rows.append((name, len(topic.sortedrules), label,
+                     "{0:.1f}".format(per_message),
+                     "{0:.1f}".format(mean_candidates(topic, targets))
+                     if label != "linear" else len(topic.sortedrules)))
+    assert all(result == results[0] for result in results)
+    return rows
+
+
+def main():
+    rows = []
+    variables = {"b": {}, "u": {}}
+    for name, files, topic_name, messages in [
+            ("eliza", ["eliza.py"], "eliza", ELIZA_MESSAGES),
+            ("valves", ["valves.py"], "all", VALVES_MESSAGES)]:
+        topics = {}
+        for matcher in MATCHERS:
+            ch = load_engine(files, matcher=matcher)
+            topics[matcher] = ch.rules_db.topics[topic_name]
+        rows.extend(time_topics(name, topics, messages, variables, 200))
+
+    words = vocabulary(5000)
+    patterns = synthetic_patterns(50000, words)
+    topics = dict((matcher, synthetic_topic(patterns, matcher=matcher))
+                  for matcher in MATCHERS)
+    messages = synthetic_messages(50, words, patterns)
+    rows.extend(time_topics("synthetic", topics, messages, variables, 1))
+
+    print_table(("script", "rules", "matcher", "usec/msg", "candidates"), rows)
+
+
+if __name__ == "__main__":
+    main()
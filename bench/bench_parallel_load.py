@@ -0,0 +1,70 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark loading made-up scripts of 20000 rules with their patterns
+parsed in the loading process, and in pools of 1, 2 and 4 processes.
+Patterns parsed by the pool are pickled back to the loading process, which
+compiles their regular expressions when they are first matched, so the
+last column also times matching one message against every rule. The pool
+can only help as much as there are CPUs to run it on.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from benchutil import print_table, write_synthetic_script
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.reply import Target
+
+RULES = 20000
+FILES = 4
+
+
+def load(directory, processes):
+    """ Return the rules loaded from directory, the seconds taken to load
+    them, and the seconds to load them and match a message against them.
+    """
+    ch = ChatbotEngine()
+    start = time.time()
+    ch.load_script_directory(directory, processes=processes)
+    loaded = time.time() - start
+    target = Target("nothing like any of the patterns")
+    topic = ch.rules_db.topics["all"]
+    for rule in topic.rules.values():
+        rule.pattern.match(target.normalized, {})
+    matched = time.time() - start
+    topic.sort_rules()
+    rules = [(r.rulename, r.pattern.formatted_pattern)
+             for r in topic.sortedrules]
+    return rules, loaded, matched
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(FILES):
+            write_synthetic_script(directory, RULES // FILES,
+                                   name="synthetic{0}".format(i), seed=i)
+        rows = []
+        expected = None
+        for processes in [None, 1, 2, 4]:
+            rules, loaded, matched = load(directory, processes)
+            if expected is None:
+                expected = rules
+            assert rules == expected
+            rows.append((processes or "-", "{0:.0f}".format(loaded * 1e3),
+                         "{0:.0f}".format(matched * 1e3)))
+    finally:
+        shutil.rmtree(directory)
+    print("{0} rules in {1} files, {2} CPUs:".format(
+        len(expected), FILES, multiprocessing.cpu_count()))
+    print_table(("processes", "load msec", "load and match msec"), rows)
+
+
+if __name__ == "__main__":
+    main()
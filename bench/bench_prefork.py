@@ -0,0 +1,127 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark the memory used by worker processes forked from an engine
+loaded with made-up scripts of 10000 rules: forked straight after loading,
+after ChatbotEngine.preload, and by prefork.fork_workers, which also
+freezes the garbage collector. Each worker replies to 500 messages, half of
+them made to match, runs a full garbage collection as a long-running
+worker eventually would, and reports its unique set size (the memory it
+doesn't share with any other process) and its proportional set size from
+/proc/self/smaps_rollup, so this only works on Linux. Each way is run in a
+fresh process.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchutil import (print_table, synthetic_messages, synthetic_patterns,
+                       vocabulary, write_synthetic_script)
+from chatbot_reply import ChatbotEngine, prefork
+
+FILES = 10
+RULES = 1000
+WORKERS = 4
+MESSAGES = 500
+
+
+def memory_mb():
+    """ Return this process's unique and proportional set sizes in MB """
+    sizes = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                sizes[parts[0].rstrip(":")] = int(parts[1]) / 1024.0
+    return (sizes["Private_Clean"] + sizes["Private_Dirty"], sizes["Pss"])
+
+
+def fork(engine, count, serve):
+    """ Fork workers without preloading or freezing anything """
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            serve(engine, index)
+            os._exit(0)
+        pids.append(pid)
+    return pids
+
+
+def measure(directory, results, mode):
+    """ Run in a child process: load the scripts, fork the workers, and
+    have each write a JSON list of (seconds, USS MB, PSS MB) to results.
+    """
+    words = vocabulary(2000)
+    messages = []
+    for i in range(FILES):
+        patterns = synthetic_patterns(RULES, words, i)
+        messages.extend(synthetic_messages(MESSAGES // FILES, words,
+                                           patterns, i))
+    ch = ChatbotEngine()
+    ch.load_script_directory(directory)
+
+    def serve(engine, index):
+        start = time.time()
+        for message in messages:
+            engine.reply(index, {}, message)
+        gc.collect()
+        seconds = time.time() - start
+        with open(os.path.join(results, "{0}.json".format(index)), "w") as f:
+            f.write(json.dumps((seconds,) + memory_mb()))
+
+    if mode == "fork_workers":
+        pids = prefork.fork_workers(ch, WORKERS, serve)
+    else:
+        if mode == "preload":
+            ch.preload()
+        pids = fork(ch, WORKERS, serve)
+    assert prefork.wait_workers(pids) == [0] * WORKERS
+
+
+def main():
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        print("Needs /proc/self/smaps_rollup (Linux 4.14 or later)")
+        return
+    directory = tempfile.mkdtemp()
+    results = tempfile.mkdtemp()
+    try:
+        for i in range(FILES):
+            write_synthetic_script(directory, RULES,
+                                   name="synthetic{0}".format(i), seed=i)
+        rows = []
+        for mode in ["fork", "preload", "fork_workers"]:
+            subprocess.check_call([sys.executable, __file__, directory,
+                                   results, mode])
+            workers = []
+            for index in range(WORKERS):
+                with open(os.path.join(results,
+                                       "{0}.json".format(index))) as f:
+                    workers.append(json.load(f))
+            seconds, uss, pss = [sum(column) / WORKERS
+                                 for column in zip(*workers)]
+            rows.append((mode, "{0:.0f}".format(seconds * 1e3),
+                         "{0:.1f}".format(uss), "{0:.1f}".format(pss)))
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(results)
+    print("{0} workers, {1} rules, {2} messages each, averages per "
+          "worker:".format(WORKERS, FILES * RULES, MESSAGES))
+    print_table(("forked by", "reply msec", "unique MB", "proportional MB"),
+                rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        measure(*sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,56 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark worst case messages for patterns with several wildcards,
+comparing the usual regular expressions with the atomic ones made by
+Pattern(..., atomic=True), which need Python 3.11 or later. Each message is
+built to almost match its pattern, so the re module has to try every way
+of dividing the message between the wildcards before giving up.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from benchutil import best_time, print_table
+from chatbot_reply.patterns import _ATOMIC_GROUPS, Pattern
+
+
+def words(n, word="blah"):
+    return " ".join([word] * n)
+
+
+# pattern, function of n making the message, sizes of n to try
+CASES = [("* * * * x", lambda n: words(n), [10, 20, 40]),
+         ("* a * b * c", lambda n: words(n, "a b"), [10, 20, 40]),
+         ("_* is _* of _*", lambda n: words(n, "is of") + " x_", [20, 40, 80]),
+         ("[*] the machine [*]",
+          lambda n: words(n, "the machine") + " the", [50, 100, 200]),
+         ("@ [#] is *", lambda n: words(n, "abc" * 20 + "1"), [50, 100, 200]),
+         ("what is _*", lambda n: "what is " + words(n, "x" * 30) + " !",
+          [100, 1000, 10000])]
+
+
+def main():
+    if not _ATOMIC_GROUPS:
+        print("Atomic regular expressions need Python 3.11 or later")
+        return
+    rows = []
+    for raw, make_message, sizes in CASES:
+        plain = Pattern(raw, {})
+        atomic = Pattern(raw, {}, atomic=True)
+        for n in sizes:
+            message = make_message(n)
+            assert ((plain.regexc.match(message) is None) ==
+                    (atomic.regexc.match(message) is None))
+            times = [best_time(lambda: p.regexc.match(message), repeat=3)
+                     for p in (plain, atomic)]
+            rows.append((raw, len(message.split()),
+                         "{0:.3f}".format(times[0] * 1000),
+                         "{0:.3f}".format(times[1] * 1000),
+                         "{0:.0f}x".format(times[0] / max(times[1], 1e-9))))
+    print_table(("pattern", "words", "plain msec", "atomic msec", "speedup"),
+                rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark Pattern.regex_cache, the cache of compiled regular expressions
+for patterns containing user variables, with 100,000 users who each have a
+different %u:name. Users are picked with a skewed distribution, so some talk
+a lot more than others, and the cache is tried at several sizes.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import time
+
+from benchutil import print_table, vocabulary
+from chatbot_reply.cache import LRUCache
+from chatbot_reply.patterns import Pattern
+
+USERS = 100000
+MESSAGES = 30000
+PATTERNS = ["my name is %u:name", "[*] %u:name is my name",
+            "hello %u:name [*]", "do you remember %u:name", "*"]
+
+
+def make_messages(names, rnd):
+    messages = []
+    for i in range(MESSAGES):
+        user = int(USERS * rnd.random() ** 4)
+        template = rnd.choice(["my name is {0}", "hello {0} how are you",
+                               "what is the weather like"])
+        messages.append((user, template.format(names[user])))
+    return messages
+
+
+def run(patterns, names, messages):
+    variables = {"u": None, "b": {}}
+    for user, message in messages:
+        variables["u"] = {"name": names[user]}
+        for pattern in patterns:
+            if pattern.match(message, variables) is not None:
+                break
+
+
+def main():
+    rnd = random.Random(0)
+    words = vocabulary(2000)
+    names = ["{0} {1}".format(rnd.choice(words), i) for i in range(USERS)]
+    messages = make_messages(names, rnd)
+    patterns = [Pattern(p, {}) for p in PATTERNS]
+
+    rows = []
+    saved = Pattern.regex_cache
+    try:
+        for size in [0, 1000, 10000, 100000]:
+            cache = Pattern.regex_cache = LRUCache(size)
+            start = time.time()
+            run(patterns, names, messages)
+            elapsed = time.time() - start
+            rows.append((size, "{0:.1f}".format(elapsed / MESSAGES * 1e6),
+                         "{0:.1%}".format(cache.hit_rate()), cache.hits,
+                         cache.misses, cache.evictions))
+    finally:
+        Pattern.regex_cache = saved
+
+    print("{0} users, {1} messages".format(USERS, MESSAGES))
+    print_table(("cache size", "usec/msg", "hit rate", "hits", "misses",
+                 "evictions"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark reloading made-up scripts of 200 topics of 100 rules each,
+one file per topic, after changing one file, by clearing the rules and
+loading the whole directory again as chat.py's /reload used to, and with
+reload_changed, which only imports the changed file and rebuilds its topic.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import print_table, write_synthetic_script
+from chatbot_reply import ChatbotEngine
+
+TOPICS = 200
+RULES = 100
+ROUNDS = 5
+
+
+def change_one_file(directory, i):
+    """ Add a rule to the script for topic 0 """
+    with io.open(os.path.join(directory, "topic0.py"), "a") as f:
+        f.write('    @rule("changed {0}")\n'
+                '    def rule_changed_{0}(self):\n'
+                '        return "changed"\n'.format(i))
+
+
+def full_reload(ch, directory):
+    ch.clear_rules()
+    ch.load_script_directory(directory)
+    ch.rules_db.sort_rules()
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(TOPICS):
+            write_synthetic_script(directory, RULES, name="topic{0}".format(i),
+                                   seed=i, topic="topic{0}".format(i))
+        ch = ChatbotEngine()
+        start = time.time()
+        full_reload(ch, directory)
+        load = time.time() - start
+
+        rows = [("initial load", "{0:.0f}".format(load * 1e3))]
+        changes = 0
+        for label, reload in [
+                ("clear and load", lambda: full_reload(ch, directory)),
+                ("reload_changed", ch.reload_changed)]:
+            times = []
+            for i in range(ROUNDS):
+                time.sleep(0.01)  # so the modification time changes
+                changes += 1
+                change_one_file(directory, changes)
+                start = time.time()
+                reload()
+                times.append(time.time() - start)
+                topic = ch.rules_db.topics["topic0"]
+                assert len(topic.rules) == RULES + changes
+            rows.append((label, "{0:.0f}".format(min(times) * 1e3)))
+    finally:
+        shutil.rmtree(directory)
+    print("{0} topics of {1} rules, changing one file:".format(TOPICS, RULES))
+    print_table(("reload", "msec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark loading scripts with no rule cache, with an empty one (cold)
+and with one written by an earlier load (warm), for the example scripts
+and for a made-up script of 5000 rules. Patterns read from the cache
+compile their regular expressions the first time they are matched, so
+the last column also times matching one message against every rule, to
+show how much of the saving is only put off until then.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import SCRIPTS_DIR, print_table, write_synthetic_script
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.reply import Target
+
+REPEAT = 3
+
+
+def load(directory, cache_dir):
+    """ Return the seconds taken to load directory, and then to match a
+    message against every rule.
+    """
+    ch = ChatbotEngine()
+    start = time.time()
+    ch.load_script_directory(directory, cache_dir=cache_dir)
+    loaded = time.time() - start
+    target = Target("nothing like any of the patterns")
+    for topic in ch.rules_db.topics.values():
+        for rule in topic.rules.values():
+            rule.pattern.match(target.normalized, {})
+    return loaded, time.time() - start
+
+
+def main():
+    rows = []
+    directories = [("example scripts", SCRIPTS_DIR)]
+    synthetic_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_script(synthetic_dir, 5000)
+        directories.append(("5000 rules", synthetic_dir))
+        for label, directory in directories:
+            for kind in ["no cache", "cold", "warm"]:
+                times = []
+                for i in range(REPEAT):
+                    cache_dir = None
+                    if kind != "no cache":
+                        cache_dir = os.path.join(synthetic_dir, "cache")
+                        if kind == "cold":
+                            shutil.rmtree(cache_dir, ignore_errors=True)
+                    times.append(load(directory, cache_dir))
+                loaded, matched = min(times)
+                rows.append((label, kind, "{0:.1f}".format(loaded * 1e3),
+                             "{0:.1f}".format(matched * 1e3)))
+            shutil.rmtree(os.path.join(synthetic_dir, "cache"))
+    finally:
+        shutil.rmtree(synthetic_dir)
+    print_table(("scripts", "rule cache", "load msec",
+                 "load and match msec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark making Targets for the eliza topic with eliza's contraction
+expander written as a substitute method, the way it used to be, and as a
+substitutions dictionary, which RulesDB compiles into a SubstitutionTable.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import string
+
+from benchutil import best_time, load_engine, print_table, vocabulary
+from chatbot_reply.reply import Target
+
+NUMBER = 2000
+
+CONTRACTIONS = {"don't": "do not", "can't": "can not", "won't": "will not",
+                "you're": "you are", "i'm": "i am",
+                "i've": "i have", "you've": "you have"}
+
+
+def substitute(text, wordlists):
+    """ eliza's substitute method as it used to be """
+    results = []
+    for wl in wordlists:
+        new = []
+        for word in wl:
+            stripped = word.lower().rstrip(string.punctuation)
+            new_word = CONTRACTIONS.get(stripped, word)
+            new.extend(new_word.split())
+        results.append(new)
+    return results
+
+
+def make_message(length, words, rnd):
+    words = words + list(CONTRACTIONS) * 20
+    punctuation = ["", "", "", ",", ".", "!", "?"]
+    return " ".join(rnd.choice(words).capitalize() + rnd.choice(punctuation)
+                    for i in range(length))
+
+
+def main():
+    ch = load_engine(["eliza.py"])
+    table = ch.rules_db.topics["eliza"].substitution_table
+    methods = [("ElizaScript.substitute", substitute)]
+    rnd = random.Random(0)
+    words = vocabulary(1000)
+    rows = []
+    for length in [1, 10, 100]:
+        message = make_message(length, words, rnd)
+        old, new = Target(message, methods), Target(message, [], table)
+        assert old.tokenized_words == new.tokenized_words
+        times = [best_time(lambda: Target(message, methods), number=NUMBER),
+                 best_time(lambda: Target(message, [], table), number=NUMBER)]
+        rows.append((length, "{0:.1f}".format(times[0] / NUMBER * 1e6),
+                     "{0:.1f}".format(times[1] / NUMBER * 1e6)))
+    print_table(("words", "method usec", "table usec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark making Targets from messages of 1, 10 and 500 words, and
+building the Match for a pattern that memorizes part of each message,
+against the way they were done before Target recorded word offsets.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import bisect
+import random
+import re
+
+from benchutil import best_time, print_table, vocabulary
+from chatbot_reply.patterns import Pattern
+from chatbot_reply.reply import Target
+from chatbot_reply.rules import Match
+
+NUMBER = 2000
+
+
+def old_split_on_whitespace(text):
+    matches = [m for m in re.finditer(r"[\S]+", text, flags=re.UNICODE)]
+    return [text[m.span()[0]:m.span()[1]] for m in matches]
+
+
+def old_kill_non_alphanumerics(text):
+    matches = [m for m in re.finditer(r"[\w]+", text, flags=re.UNICODE)]
+    return "".join([text[m.span()[0]:m.span()[1]] for m in matches])
+
+
+class OldTarget(object):
+    def __init__(self, text):
+        self.raw_text = text
+        self.raw_words = old_split_on_whitespace(text)
+        sub_words = [[word] for word in self.raw_words]
+        self.tokenized_words = [[old_kill_non_alphanumerics(word.lower())
+                                 for word in wl] for wl in sub_words]
+        self.normalized = " ".join(
+            [" ".join(wl) for wl in self.tokenized_words])
+
+
+def old_match(m, target):
+    result = {}
+    offsets = []
+    offset = 0
+    for wl in target.tokenized_words:
+        offsets.append(offset)
+        offset += len(" ".join(wl)) + 1
+    for k, v in m.groupdict().items():
+        result[k] = v
+        start, end = m.span(k)
+        i_start = bisect.bisect_left(offsets, start)
+        i_end = bisect.bisect(offsets, end)
+        result["raw_" + k] = " ".join(target.raw_words[i_start:i_end])
+    return result
+
+
+def make_message(length, words, rnd):
+    punctuation = ["", "", "", ",", ".", "!", "'s", "?"]
+    message = [rnd.choice(words).capitalize() + rnd.choice(punctuation)
+               for i in range(length - 1)]
+    return " ".join(["Well"] + message)
+
+
+def main():
+    rnd = random.Random(0)
+    words = vocabulary(1000)
+    pattern = Pattern("well _* [_*]", {})
+    rows = []
+    for length in [1, 10, 500]:
+        message = make_message(length, words, rnd)
+        old, new = OldTarget(message), Target(message)
+        assert old.normalized == new.normalized
+        assert old.tokenized_words == new.tokenized_words
+        m = pattern.match(new.normalized, {})
+        if m is not None:
+            expected = old_match(m, old)
+            assert Match(m, None, new, None).dict == expected
+
+        target_times = [best_time(lambda: cls(message), number=NUMBER)
+                        for cls in (OldTarget, Target)]
+        match_times = [None, None]
+        if m is not None:
+            match_times = [
+                best_time(lambda: old_match(m, old), number=NUMBER),
+                best_time(lambda: Match(m, None, new, None), number=NUMBER)]
+        rows.append((length, len(message)) + tuple(
+            "-" if t is None else "{0:.1f}".format(t / NUMBER * 1e6)
+            for t in target_times + match_times))
+    print_table(("words", "chars", "old target usec", "new target usec",
+                 "old match usec", "new match usec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark ChatbotEngine.reply on repetitive traffic, where a few short
+messages like "yes" and "status" make up most of what users say, with the
+Target cache off and at a few sizes.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import time
+
+from benchutil import load_engine, print_table
+
+ROUNDS = 2000
+
+COMMON = ["status", "valve status", "hello robot", "open it", "close it",
+          "yes", "no", "thanks", "turn the water on", "drain the house"]
+RARE = ["is the main water valve open", "close the drain valve",
+        "what is the water drain valve status",
+        "shutoff valve status please", "open the main valve now"]
+
+
+def messages(rnd):
+    return [rnd.choice(RARE) if rnd.random() < 0.1 else rnd.choice(COMMON)
+            for i in range(ROUNDS)]
+
+
+def main():
+    rows = []
+    msgs = messages(random.Random(0))
+    expected = None
+    for size in [0, 4, 16, 64]:
+        ch = load_engine(["valves.py"], target_cache_size=size)
+        ch.reply("bench", {}, "hello")
+        random.seed(0)  # valves picks some replies at random
+        start = time.time()
+        replies = [ch.reply("bench", {}, message) for message in msgs]
+        elapsed = time.time() - start
+        if expected is None:
+            expected = replies
+        assert replies == expected
+        cache = ch.target_cache
+        rows.append((size, len(cache), "{0:.0%}".format(cache.hit_rate()),
+                     cache.evictions,
+                     "{0:.1f}".format(elapsed / len(msgs) * 1e6)))
+    print_table(("cache size", "cached", "hit rate", "evictions",
+                 "usec/msg"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark the throughput of one engine replying from 1, 2, 4 and 8
+threads at once, each to its own users, with made-up scripts of 5000
+rules. With the GIL, more threads can't make it faster, only show what the
+locking costs. On a free-threaded build of CPython (3.13t or later) with
+more than one CPU, the threads can reply in parallel.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchutil import (print_table, synthetic_messages, synthetic_patterns,
+                       vocabulary, write_synthetic_script)
+from chatbot_reply import ChatbotEngine
+
+RULES = 5000
+REPLIES = 4000
+USERS = 4
+
+
+def run(ch, threads, messages):
+    """ Return the seconds taken by threads threads to make REPLIES
+    replies between them.
+    """
+    count = REPLIES // threads
+
+    def converse(index):
+        for i in range(count):
+            user = index * USERS + i % USERS
+            ch.reply(user, {}, messages[(index + i) % len(messages)])
+
+    workers = [threading.Thread(target=converse, args=(index,))
+               for index in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        write_synthetic_script(directory, RULES)
+        ch = ChatbotEngine()
+        ch.load_script_directory(directory)
+        ch.preload()
+    finally:
+        shutil.rmtree(directory)
+    words = vocabulary(2000)
+    messages = synthetic_messages(1000, words,
+                                  synthetic_patterns(RULES, words), 1)
+    run(ch, 1, messages)  # to make every user once
+    rows = []
+    for threads in [1, 2, 4, 8]:
+        seconds = min(run(ch, threads, messages) for i in range(3))
+        rows.append((threads, "{0:.0f}".format(REPLIES / seconds)))
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("{0} rules, {1} CPUs, GIL {2}:".format(
+        RULES, multiprocessing.cpu_count(), "enabled" if gil else "disabled"))
+    print_table(("threads", "replies/sec"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Benchmark how many variable dictionaries are made per message. Before
+VariableLayers, Pattern.match copied the alternates and the user and bot
+variables into a new dictionary for every rule it was asked about. Now
+ChatbotEngine.reply makes one VariableLayers per message, and Pattern.match
+only makes another when it has to fill in variables to build a regular
+expression. Both are timed with ChatbotEngine.reply, which only looks at
+the rules the index picks out, and with a linear scan of every rule.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+from benchutil import load_engine, print_table
+from chatbot_reply import patterns, reply
+from chatbot_reply.patterns import Pattern, PatternVariableNotFoundError
+from chatbot_reply.reply import Target
+
+ROUNDS = 50
+
+ELIZA_MESSAGES = ["I remember my mother's cooking",
+                  "Do you remember when we talked about computers?",
+                  "I am sad about my job", "hello there",
+                  "why can't I sleep at night", "My father is like a machine",
+                  "what is going on", "yes", "I feel like nobody listens",
+                  "this is a long message about nothing much at all, really"]
+
+VALVES_MESSAGES = ["status", "valve status", "shutoff valve status",
+                   "is the main water valve open", "close the drain valve",
+                   "turn the water on", "drain the house", "open it",
+                   "what is the water drain valve status", "hello robot"]
+
+
+class Counter(object):
+    matches = 0
+    allocations = 0
+    legacy = False  # the old engine reused one dictionary for every message
+
+
+class CountingLayers(patterns.VariableLayers):
+    __slots__ = ()
+
+    def __init__(self, *layers):
+        if not Counter.legacy:
+            Counter.allocations += 1
+        super(CountingLayers, self).__init__(*layers)
+
+
+def counting_match(self, string, variables):
+    Counter.matches += 1
+    return new_match(self, string, variables)
+
+
+def legacy_match(self, string, variables):
+    """ Pattern.match as it was, making a new dictionary for every call """
+    Counter.matches += 1
+    Counter.allocations += 1
+    allvars = {}
+    allvars.update(self.alternates)
+    allvars.update({"u": variables["u"], "b": variables["b"]})
+    if self.regexc is not None:
+        return self.regexc.match(string)
+    try:
+        regexc = self._variable_regexc(allvars)
+    except PatternVariableNotFoundError:
+        return None
+    return regexc.match(string)
+
+
+new_match = Pattern.match
+
+
+def linear_reply(ch, messages):
+    """ Match each message against every rule of the topic in turn, making
+    the variables the same way ChatbotEngine.reply does.
+    """
+    user = ch._users["bench"]
+    topic = ch.rules_db.topics[user.topic_name]
+    for message in messages:
+        variables = patterns.VariableLayers({"u": user.vars},
+                                            ch._bot_variables)
+        target = Target(message, topic.substitutions,
+                        topic.substitution_table)
+        for rule in topic.sortedrules:
+            if rule.match(target, user.repl_history, variables) is not None:
+                break
+
+
+def engine_reply(ch, messages):
+    for message in messages:
+        ch.reply("bench", {}, message)
+
+
+def measure(ch, run, messages, match):
+    """ Return the number of Pattern.match calls and variable dictionaries
+    per message, and the microseconds per message, for one way of matching.
+    """
+    Pattern.match = match
+    Counter.legacy = match is legacy_match
+    try:
+        Counter.matches = Counter.allocations = 0
+        start = time.time()
+        for i in range(ROUNDS):
+            run(ch, messages)
+        elapsed = time.time() - start
+    finally:
+        Pattern.match = new_match
+    count = float(ROUNDS * len(messages))
+    return (Counter.matches / count, Counter.allocations / count,
+            elapsed / count * 1e6)
+
+
+def main():
+    rows = []
+    saved = patterns.VariableLayers, reply.VariableLayers
+    patterns.VariableLayers = reply.VariableLayers = CountingLayers
+    try:
+        for name, files, greeting, messages in [
+                ("eliza", ["eliza.py"], "talk to eliza", ELIZA_MESSAGES),
+                ("valves", ["valves.py"], "hello", VALVES_MESSAGES)]:
+            ch = load_engine(files)
+            ch.reply("bench", {}, greeting)
+            for label, run in [("reply", engine_reply),
+                               ("linear", linear_reply)]:
+                for version, match in [("dict", legacy_match),
+                                       ("layers", counting_match)]:
+                    matches, allocs, usec = measure(ch, run, messages, match)
+                    rows.append((name, label, version,
+                                 "{0:.1f}".format(matches),
+                                 "{0:.1f}".format(allocs),
+                                 "{0:.1f}".format(usec)))
+    finally:
+        patterns.VariableLayers, reply.VariableLayers = saved
+
+    print_table(("script", "matching", "variables", "matches/msg",
+                 "allocs/msg", "usec/msg"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Helpers shared by the benchmark scripts """
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath("."))
+
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.rules import Rule, Topic
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "scripts")
+
+
+def load_engine(script_files, **kwargs):
+    """ Make a ChatbotEngine, passing it kwargs, and load just the named
+    files from the scripts directory into it.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for name in script_files:
+            shutil.copy(os.path.join(SCRIPTS_DIR, name), directory)
+        ch = ChatbotEngine(**kwargs)
+        ch.load_script_directory(directory)
+    finally:
+        shutil.rmtree(directory)
+    ch.rules_db.sort_rules()
+    return ch
+
+
+def best_time(func, number=1, repeat=3):
+    """ Return the best time in seconds of repeat runs of calling func
+    number times.
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def vocabulary(size, seed=0):
+    """ Return a list of size made-up lowercase words """
+    rnd = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rnd.choice(letters)
+                          for i in range(rnd.randint(3, 8))))
+    return sorted(words)
+
+
+def synthetic_patterns(count, words, seed=0):
+    """ Return a list of count different patterns, of the kinds found in
+    large scripts: literals, literals with optional words, and words
+    surrounded by wildcards.
+    """
+    rnd = random.Random(seed)
+    templates = ["{0} {1} [{2}]", "{0} {1} {2}", "[*] {0} {1} *",
+                 "{0} *~3 {1}", "* {0} *", "{0} ({1}|{2}) *2",
+                 "_* {0} {1}", "[{0}|{1}] {2} _*"]
+    patterns = set()
+    while len(patterns) < count:
+        template = rnd.choice(templates)
+        patterns.add(template.format(*rnd.sample(words, 3)))
+    return sorted(patterns)
+
+
+def write_synthetic_script(directory, count, name="synthetic", seed=0,
+                           topic="all"):
+    """ Write a script file to directory, containing one class in topic
+    with a rule for each of count synthetic patterns.
+    """
+    patterns = synthetic_patterns(count, vocabulary(2000), seed)
+    lines = ["from __future__ import unicode_literals",
+             "from chatbot_reply import Script, rule",
+             "class Synthetic(Script):",
+             '    topic = "{0}"'.format(topic)]
+    for i, pattern in enumerate(patterns):
+        lines.append('    @rule("{0}")'.format(pattern))
+        lines.append("    def rule_{0}(self):".format(i))
+        lines.append('        return "{0}"'.format(i))
+    with io.open(os.path.join(directory, name + ".py"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def synthetic_topic(patterns, **kwargs):
+    """ Make a Topic, passing it kwargs, containing one rule for each
+    pattern, with no methods.
+    """
+    topic = Topic(**kwargs)
+    topic.add_rules([Rule(pattern, "", 1, {}, None, "rule_{0}".format(i))
+                     for i, pattern in enumerate(patterns)])
+    topic.sort_rules()
+    return topic
+
+
+def synthetic_messages(count, words, patterns, seed=0):
+    """ Return a list of count messages, half made of random words and half
+    built from the literal words of patterns, so some of them match.
+    """
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(count):
+        if i % 2:
+            length = rnd.randint(1, 12)
+            messages.append(" ".join(rnd.choice(words)
+                                     for j in range(length)))
+        else:
+            pattern = rnd.choice(patterns)
+            message = []
+            for word in pattern.split():
+                word = word.strip("[]()_")
+                if "|" in word:
+                    word = word.split("|")[0]
+                if word.startswith("*"):
+                    message.append(rnd.choice(words))
+                elif word:
+                    message.append(word)
+            messages.append(" ".join(message))
+    return messages
+
+
+def print_table(headings, rows):
+    """ Print a list of tuples as a table, under headings """
+    widths = [max(len(str(x)) for x in column)
+              for column in zip(headings, *rows)]
+    line = "  ".join("{{{0}:>{1}}}".format(i, w) for i, w in enumerate(widths))
+    print(line.format(*headings))
+    for row in rows:
+        print(line.format(*row))
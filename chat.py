@@ -24,7 +24,7 @@ if __name__ == "__main__":
     ch.load_script_directory("scripts")
     print ("Type /quit to quit, "
            "/botvars or /uservars to see values of variables, "
-           "/reload to reload the scripts directory,"
+           "/reload to reload changed files in the scripts directory, "
            "/log plus debug, info, warning or error to set logging level.")
     while True:
         msg = text_type(input("You> "))
@@ -38,8 +38,8 @@ if __name__ == "__main__":
             else:
                 print("No user variables have been defined.")
         elif msg == "/reload":
-            ch.clear_rules()
-            ch.load_script_directory("scripts")
+            reloaded = ch.reload_changed()
+            print("Reloaded: " + (", ".join(reloaded) or "nothing"))
         elif msg == "/log debug":
             log.setLevel(logging.DEBUG)
         elif msg == "/log info":
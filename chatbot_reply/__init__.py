@@ -3,7 +3,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from .exceptions import PatternError, NoRulesFoundError, RecursionTooDeepError
-from .exceptions import PatternVariableNotFoundError
+from .exceptions import PatternVariableNotFoundError, BundleError
 from .script import rule, Script, split_on_whitespace, kill_non_alphanumerics
 from .script import UserInfo
 from .reply import ChatbotEngine
@@ -21,7 +21,7 @@ logging.getLogger(__name__).addHandler(NullHandler())
 
 __all__ = ["ChatbotEngine", "Script", "rule", "UserInfo", "PatternError",
            "PatternVariableNotFoundError", "NoRulesFoundError",
-           "RecursionTooDeepError", "split_on_whitespace",
+           "RecursionTooDeepError", "BundleError", "split_on_whitespace",
            "kill_non_alphanumerics"]
 
 __version__ = "0.1.0"
@@ -0,0 +1,84 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.cache, a size-limited cache that counts its hits and misses
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """ A dictionary-like cache which holds at most maxsize items, throwing
+    out the least recently used one when it is full.
+
+    Public instance variables:
+    maxsize - the most items the cache will hold. If this is 0, nothing
+        will be stored.
+    hits - the number of times get found what it was asked for
+    misses - the number of times get didn't find what it was asked for
+    evictions - the number of items thrown out to make room for new ones
+
+    Public methods:
+    get - look up a key, returning None if it isn't there
+    put - add a key and value
+    clear - empty the cache and reset the counters
+    hit_rate - return the fraction of lookups which were hits
+
+    All the methods may be called from more than one thread at once.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Empty the cache and reset the counters """
+        with self._lock:
+            self._items = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """ Return the value for key and mark it recently used, or return
+        None if it's not in the cache.
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Add key and value to the cache, throwing out the least
+        recently used items if it is over maxsize.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def hit_rate(self):
+        """ Return the fraction of calls to get which found something """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return self.hits / float(lookups)
@@ -8,3 +8,10 @@
 """
 _PREFIX = "___"  # added to script module names to avoid namespace conflicts
 _HISTORY = 10    # number of previous messages/replies to keep
+_REGEX_CACHE_SIZE = 10000  # compiled regexes for patterns with variables
+# Change these when the files change, or when pattern parsing or the
+# regular expressions made from patterns change, since the files hold
+# pickled Patterns. A hash of patterns.py and trie.py is part of their
+# keys too, but won't notice changes made elsewhere.
+_RULE_CACHE_FORMAT = 1     # change when RuleCache files change
+_BUNDLE_FORMAT = 2         # change when RulesDB.save_bundle files change
@@ -0,0 +1,77 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.dispatch, combined regular expressions for many patterns.
+
+    Instead of calling re.match once for each pattern in a topic, the
+    regular expressions of the patterns can be joined together with | into
+    one big regular expression, in the order the rules are sorted, with an
+    empty group at the end of each alternative. The re module tries the
+    alternatives in order, skipping quickly over those which start with the
+    wrong letter, and the number of the group that gets set tells which
+    pattern matched first.
+
+    Because re stops at the first alternative that matches, this only finds
+    the best pattern, so it should only be given patterns which are
+    sufficient for their rule to match, in other words rules without
+    previous reply patterns.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# The regular expressions made by ParsedPattern only contain the groups it
+# creates itself, since words can't contain parentheses, so they can all
+# safely be made non-capturing.
+_named_group = re.compile(r"\(\?P<match\d+>", re.UNICODE)
+_plain_group = re.compile(r"\((?!\?)", re.UNICODE)
+
+
+class PatternDispatcher(object):
+    """ A list of combined regular expressions, built from a list of
+    regular expression strings and the values to return when they match.
+
+    Public method:
+    match - return the value for the first regular expression in the list
+            which matches a string
+    """
+    def __init__(self, regexes, values):
+        """ Compile regexes (a list of strings made by Pattern.regex) into
+        as few combined regular expressions as the re module will allow.
+        values should be a list of the same length.
+        """
+        regexes = [_plain_group.sub("(?:", _named_group.sub("(?:", regex)) +
+                   "()" for regex in regexes]
+        self._chunks = self._compile(regexes, list(values))
+
+    def _compile(self, regexes, values):
+        """ Try to compile all the regexes as one, and if that's too much
+        for the re module, split them in half and try again.
+        """
+        if not regexes:
+            return []
+        try:
+            return [(re.compile("|".join(regexes), re.UNICODE), values)]
+        except (AssertionError, OverflowError, RuntimeError, re.error) as e:
+            if len(regexes) == 1:
+                raise
+            log.debug("Splitting {0} patterns into two chunks "
+                      "because: {1}".format(len(regexes), e))
+            half = len(regexes) // 2
+            return (self._compile(regexes[:half], values[:half]) +
+                    self._compile(regexes[half:], values[half:]))
+
+    def match(self, string):
+        """ Return the value given for the first regular expression which
+        matches the string, or None if none of them do.
+        """
+        for regexc, values in self._chunks:
+            m = regexc.match(string)
+            if m is not None:
+                return values[m.lastindex - 1]
+        return None
@@ -32,6 +32,13 @@ class NoRulesFoundError(Exception):
     pass
 
 
+class BundleError(Exception):
+    """ Raised by ChatbotEngine.load_bundle when a bundle was saved by a
+    different version of chatbot_reply or Python, with different options,
+    or from script files which have changed since. """
+    pass
+
+
 class RecursionTooDeepError(Exception):
     """ Raised by reply.reply when recursively expanding replies goes
     over the recursion depth limit."""
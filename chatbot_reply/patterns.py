@@ -73,6 +73,26 @@
                              groupdict will contain "match0" and "match1",
                              and m.groupdict()["match1"] might be None.
 
+    Atomic regular expressions:
+        Normally a pattern with several wildcards is translated into a
+        regular expression which can match a long message in many different
+        ways, so the re module may spend a long time backtracking before it
+        decides a message doesn't match. With Python 3.11 or later, passing
+        atomic=True to Pattern makes regular expressions which match exactly
+        the same messages, with the same memorized text, but can only match
+        each word, and each space before a word or wildcard, in one way.
+        Wildcards which end the pattern consume the rest of the message
+        without backtracking, and unmemorized wildcards next to each other,
+        such as "* *", are combined into one, "*2~".
+
+    ASCII regular expressions:
+        Regular expressions are compiled with re.UNICODE, but matching
+        them against ASCII text is quicker when they are compiled with
+        re.ASCII instead, which gives the same results for targets that
+        are all ASCII. Pattern.set_ascii(True) switches a pattern to
+        re.ASCII, and from then on it uses a regular expression compiled
+        with re.UNICODE only for targets which contain other characters.
+        This needs Python 3.7 or later.
 
 """
 from __future__ import print_function
@@ -82,9 +102,13 @@ import inspect
 import itertools
 import logging
 import re
+import sys
 
 from chatbot_reply.six import text_type, next
+from chatbot_reply.cache import LRUCache
+from chatbot_reply.constants import _REGEX_CACHE_SIZE
 from chatbot_reply.exceptions import *
+from chatbot_reply.trie import TrieCompileError, unique_nodes
 
 # TODO - could pass in a string such as "uba" with variable classes to create
 
@@ -94,6 +118,12 @@ _SPACE_SCORE = 0
 _WORD_SCORE = 10
 _VARIABLE_SCORE = 10
 
+# atomic groups and possessive quantifiers were added to re in 3.11
+_ATOMIC_GROUPS = sys.version_info >= (3, 11)
+
+# str.isascii, which makes checking targets cheap, was added in 3.7
+_ASCII_FLAG = re.ASCII if hasattr(text_type, "isascii") else None
+
 log = logging.getLogger(__name__)
 
 
@@ -157,8 +187,36 @@ class Wild(Token):
         else:
             return _LIMITED_WILDCARD_SCORE
 
-    def regex(self, variables, counter):
+    def required_words(self, variables):
+        return []
+
+    def add_to_trie(self, nodes, variables):
+        maximum = int(self.maximum) if self.maximum else None
+        return [node.add_wild(self.wild, int(self.minimum), maximum)
+                for node in nodes]
+
+    def expansions(self, variables, limit):
+        return None
+
+    def word_count(self, variables):
+        maximum = int(self.maximum) if self.maximum else None
+        return int(self.minimum), maximum
+
+    def referenced_variables(self):
+        return []
+
+    def regex(self, variables, counter, atomic=False, final=False):
         wildcard = self.wildcards[self.wild]
+        group, repeat = r"(", r"}?"
+        if atomic:
+            # a word can only be matched whole, so don't let re try
+            # any shorter pieces of it
+            wildcard = r"(?>" + wildcard + r")"
+            group = r"(?:"
+            if final:
+                # nothing follows but the end of the string, so the only
+                # way to match is to take every word that's left
+                repeat = r"}+"
         if self.maximum == "1":
             return wildcard + r"\b"
         else:
@@ -169,10 +227,23 @@ class Wild(Token):
             max_str = self.maximum
             if max_str != "":
                 max_str = text_type(int(self.maximum) - 1)
-            return (r"(" + wildcard + r"\s)" +
-                    r"{" + min_str + r"," + max_str + r"}?" +
+            return (group + wildcard + r"\s)" +
+                    r"{" + min_str + r"," + max_str + repeat +
                     wildcard + r"\b")
 
+    def combine(self, other):
+        """ Return a new Wild which matches the same things as this one
+        followed by a space and other, if they use the same wildcard
+        character, or None if they don't.
+        """
+        if self.wild != other.wild:
+            return None
+        maximum = ""
+        if self.maximum and other.maximum:
+            maximum = text_type(int(self.maximum) + int(other.maximum))
+        return Wild(None, "{0}{1}~{2}".format(
+            self.wild, int(self.minimum) + int(other.minimum), maximum), None)
+
 
 class Word(Token):
     """ Parse and represent words. Instance variables:
@@ -198,7 +269,28 @@ class Word(Token):
     def score(self):
         return len(self.text.split(" ")) * _WORD_SCORE
 
-    def regex(self, variables, counter):
+    def required_words(self, variables):
+        return [frozenset([word]) for word in self.text.split(" ")]
+
+    def add_to_trie(self, nodes, variables):
+        results = []
+        for node in nodes:
+            for word in self.text.split(" "):
+                node = node.add_word(word)
+            results.append(node)
+        return results
+
+    def expansions(self, variables, limit):
+        return [tuple(self.text.split(" "))]
+
+    def word_count(self, variables):
+        count = len(self.text.split(" "))
+        return count, count
+
+    def referenced_variables(self):
+        return []
+
+    def regex(self, variables, counter, atomic=False, final=False):
         return self.text + r"\b"
 
 
@@ -219,9 +311,24 @@ class Memo(Token):
     def score(self):
         return self.item.score()
 
-    def regex(self, variables, counter):
-        return "(?P<match{0}>{1})".format(next(counter),
-                                          self.item.regex(variables, counter))
+    def required_words(self, variables):
+        return self.item.required_words(variables)
+
+    def add_to_trie(self, nodes, variables):
+        return self.item.add_to_trie(nodes, variables)
+
+    def expansions(self, variables, limit):
+        return self.item.expansions(variables, limit)
+
+    def word_count(self, variables):
+        return self.item.word_count(variables)
+
+    def referenced_variables(self):
+        return self.item.referenced_variables()
+
+    def regex(self, variables, counter, atomic=False, final=False):
+        return "(?P<match{0}>{1})".format(
+            next(counter), self.item.regex(variables, counter, atomic, final))
 
 
 class Space(Token):
@@ -244,7 +351,22 @@ class Space(Token):
     def score(self):
         return _SPACE_SCORE
 
-    def regex(self, variables, counter):
+    def required_words(self, variables):
+        return []
+
+    def add_to_trie(self, nodes, variables):
+        return nodes
+
+    def expansions(self, variables, limit):
+        return [()]
+
+    def word_count(self, variables):
+        return 0, 0
+
+    def referenced_variables(self):
+        return []
+
+    def regex(self, variables, counter, atomic=False, final=False):
         return r"\s?"
 
 
@@ -267,7 +389,50 @@ class Variable(Token):
     def score(self):
         return _VARIABLE_SCORE
 
-    def regex(self, variables, counter):
+    def required_words(self, variables):
+        # Only alternates are fixed at load time. User and bot variables
+        # may change between messages, so they can't require anything.
+        parse_tree = self._parse_alternate(variables)
+        if parse_tree is None:
+            return []
+        return parse_tree.required_words(None)
+
+    def add_to_trie(self, nodes, variables):
+        parse_tree = self._parse_alternate(variables)
+        if parse_tree is None:
+            raise TrieCompileError("Variable %{0}:{1} can't be added to a "
+                                   "trie".format(self.var_id, self.var_name))
+        return parse_tree.add_to_trie(nodes, None)
+
+    def expansions(self, variables, limit):
+        parse_tree = self._parse_alternate(variables)
+        if parse_tree is None:
+            return None
+        return parse_tree.expansions(None, limit)
+
+    def word_count(self, variables):
+        parse_tree = self._parse_alternate(variables)
+        if parse_tree is None:
+            return 0, None
+        return parse_tree.word_count(None)
+
+    def referenced_variables(self):
+        return [(self.var_id, self.var_name)]
+
+    def _parse_alternate(self, variables):
+        """ If this is an alternates variable with a value in variables,
+        return the value parsed into a ParsedPattern, otherwise None.
+        """
+        if (self.var_id != "a" or not variables or
+                self.var_id not in variables or
+                self.var_name not in variables[self.var_id]):
+            return None
+        value = variables[self.var_id][self.var_name]
+        if not isinstance(value, text_type):
+            return None
+        return ParsedPattern(value.lower(), simple=True)
+
+    def regex(self, variables, counter, atomic=False, final=False):
         if (self.var_id not in variables or
                 self.var_name not in variables[self.var_id]):
             raise PatternVariableNotFoundError(
@@ -282,7 +447,7 @@ class Variable(Token):
         value = value.lower()
         try:
             parse_tree = ParsedPattern(value, simple=True)
-            regex = parse_tree.regex(None)
+            regex = parse_tree.regex(None, atomic=atomic)
         except PatternError as e:
             msg = " in variable %{0}:{1}".format(self.var_id, self.var_name)
             e.args = (e.args[0] + msg,) + e.args[1:]
@@ -309,11 +474,36 @@ class Optional(Token):
     def score(self):
         return max([chunk.score() for chunk in self.choices.contents])
 
-    def regex(self, variables, counter):
-        output = [chunk.regex(variables, counter)
+    def regex(self, variables, counter, atomic=False, final=False):
+        output = [chunk.regex(variables, counter, atomic, final)
                   for chunk in self.choices.contents]
         return "(" + "|".join(output) + ")?"
 
+    def required_words(self, variables):
+        return []
+
+    def add_to_trie(self, nodes, variables):
+        results = list(nodes)
+        for chunk in self.choices.contents:
+            results.extend(chunk.add_to_trie(nodes, variables))
+        return unique_nodes(results)
+
+    def expansions(self, variables, limit):
+        results = set([()])
+        for chunk in self.choices.contents:
+            expanded = chunk.expansions(variables, limit)
+            if expanded is None:
+                return None
+            results.update(expanded)
+        return list(results)
+
+    def word_count(self, variables):
+        minimum, maximum = word_count_range(self.choices.contents, variables)
+        return 0, maximum
+
+    def referenced_variables(self):
+        return self.choices.referenced_variables()
+
 
 class Group(Token):
     """ Parse and represent alternative parts of a pattern. Instance variables:
@@ -333,11 +523,44 @@ class Group(Token):
     def score(self):
         return max([chunk.score() for chunk in self.choices.contents])
 
-    def regex(self, variables, counter):
-        output = [chunk.regex(variables, counter)
+    def regex(self, variables, counter, atomic=False, final=False):
+        output = [chunk.regex(variables, counter, atomic, final)
                   for chunk in self.choices.contents]
         return "(" + "|".join(output) + ")"
 
+    def required_words(self, variables):
+        # One of the choices must match, so take the narrowest requirement
+        # from each choice and require at least one word from the union.
+        # If any choice requires nothing, neither does the group.
+        either = set()
+        for chunk in self.choices.contents:
+            required = chunk.required_words(variables)
+            if not required:
+                return []
+            either.update(min(required, key=len))
+        return [frozenset(either)]
+
+    def add_to_trie(self, nodes, variables):
+        results = []
+        for chunk in self.choices.contents:
+            results.extend(chunk.add_to_trie(nodes, variables))
+        return unique_nodes(results)
+
+    def expansions(self, variables, limit):
+        results = set()
+        for chunk in self.choices.contents:
+            expanded = chunk.expansions(variables, limit)
+            if expanded is None:
+                return None
+            results.update(expanded)
+        return list(results)
+
+    def word_count(self, variables):
+        return word_count_range(self.choices.contents, variables)
+
+    def referenced_variables(self):
+        return self.choices.referenced_variables()
+
 
 class Terminator(Token):
     """ Parse the terminator characters ) and ]
@@ -374,6 +597,54 @@ class Invalid(Token):
         raise PatternError("Found an unexpected character {0}".format(text))
 
 
+class VariableLayers(object):
+    """ A read-only view of one or more dictionaries of variable
+    dictionaries, such as {"u": uservars, "b": botvars}, that can be used
+    as the variables argument of ParsedPattern.regex. Looking up a key
+    finds it in the first layer which has it. This lets a dictionary of
+    user and bot variables be combined with a pattern's alternates without
+    copying either.
+    """
+    __slots__ = ("_layers",)
+
+    def __init__(self, *layers):
+        """ Create a view of the dictionaries given as arguments, skipping
+        any that are None or empty.
+        """
+        self._layers = tuple(layer for layer in layers if layer)
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return True
+        return False
+
+    def __getitem__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+
+def starts_with_word(token):
+    """ Return True if the regular expression for a token can only match
+    strings that begin with a word character.
+    """
+    if isinstance(token, Memo):
+        token = token.item
+    return isinstance(token, (Word, Wild))
+
+
+def word_count_range(choices, variables):
+    """ Given a list of ParsedPatterns, return the smallest minimum
+    and largest maximum of their word counts.
+    """
+    counts = [chunk.word_count(variables) for chunk in choices]
+    maximums = [maximum for minimum, maximum in counts]
+    maximum = None if None in maximums else max(maximums)
+    return min(minimum for minimum, maximum in counts), maximum
+
+
 class PatternTokenizer(object):
     """ Pattern Tokenizer class for simplified regular expression patterns.
     The class instance has no public instance variables, but builds and contains
@@ -542,7 +813,71 @@ class ParsedPattern(object):
         """
         return sum(token.score() for token in self.contents)
 
-    def regex(self, variables, counter=None):
+    def required_words(self, variables):
+        """Return a list of sets of words, which must each have at least
+        one member present in any target this pattern can match. Only
+        alternates are looked up in variables, since user and bot variables
+        may change after this is called.
+        """
+        required = []
+        for token in self.contents:
+            required.extend(token.required_words(variables))
+        return required
+
+    def add_to_trie(self, nodes, variables):
+        """Add this pattern to a trie (see trie.py), starting from each of
+        the TrieNodes in the list nodes, and return a list of the nodes
+        where it ends. Alternates are looked up in variables. Raises
+        TrieCompileError if the pattern contains user or bot variables.
+        """
+        for token in self.contents:
+            nodes = token.add_to_trie(nodes, variables)
+        return nodes
+
+    def expansions(self, variables, limit):
+        """Return a list of all the sequences of words (as tuples) that this
+        pattern can match, or None if there are more than limit of them
+        or infinitely many because the pattern contains wildcards. Only
+        alternates are looked up in variables, so patterns containing user
+        or bot variables also return None.
+        """
+        results = [()]
+        for token in self.contents:
+            expanded = token.expansions(variables, limit)
+            if expanded is None:
+                return None
+            results = set(words + more
+                          for words in results for more in expanded)
+            if len(results) > limit:
+                return None
+        return list(results)
+
+    def word_count(self, variables):
+        """Return a tuple of the minimum and maximum number of words in a
+        target that this pattern can match. The maximum is None if there
+        is no limit. Only alternates are looked up in variables, user and
+        bot variables are assumed to match any number of words.
+        """
+        minimum, maximum = 0, 0
+        for token in self.contents:
+            token_min, token_max = token.word_count(variables)
+            minimum += token_min
+            if maximum is not None and token_max is not None:
+                maximum += token_max
+            else:
+                maximum = None
+        return minimum, maximum
+
+    def referenced_variables(self):
+        """Return a list of (var_id, var_name) tuples for every variable
+        in the pattern, in the order they appear.
+        """
+        results = []
+        for token in self.contents:
+            results.extend(token.referenced_variables())
+        return results
+
+    def regex(self, variables, counter=None, atomic=False, final=False):
         """ Generate a regular expression from the parsed pattern,
         substituting in variable values if given.
 
@@ -557,6 +892,12 @@ class ParsedPattern(object):
             is added onto "match" to create the names for the named
             groups for memorized matches. If None is passed, starts
             counting at zero.
+        atomic - if True, use atomic groups and possessive quantifiers
+            to generate a regular expression which can't backtrack into
+            words, spaces or adjacent wildcards (see the module docstring).
+            Needs Python 3.11 or later.
+        final - if True, the regular expression will be followed by "$",
+            so a wildcard at the end can be made possessive.
 
         May raise:
         PatternVariableNotFoundError if a variable is referenced which is
@@ -568,8 +909,40 @@ class ParsedPattern(object):
         if counter is None:
             counter = itertools.count()
 
-        return "".join([token.regex(variables, counter)
-                        for token in self.contents])
+        if not atomic:
+            return "".join([token.regex(variables, counter)
+                            for token in self.contents])
+
+        contents = self._combine_wilds()
+        last = len(contents) - 1
+        output = []
+        for i, token in enumerate(contents):
+            if (isinstance(token, Space) and i < last and
+                    starts_with_word(contents[i + 1])):
+                # the next token can't begin with a space, so if
+                # there is one here it must be matched
+                output.append(r"\s?+")
+            else:
+                output.append(token.regex(variables, counter, atomic,
+                                          final and i == last))
+        return "".join(output)
+
+    def _combine_wilds(self):
+        """ Return a copy of the contents list with each run of unmemorized
+        wildcards with the same wildcard character, separated by spaces,
+        replaced by a single wildcard.
+        """
+        contents = []
+        for token in self.contents:
+            if (isinstance(token, Wild) and len(contents) > 1 and
+                    isinstance(contents[-1], Space) and
+                    isinstance(contents[-2], Wild)):
+                combined = contents[-2].combine(token)
+                if combined is not None:
+                    contents[-2:] = [combined]
+                    continue
+            contents.append(token)
+        return contents
 
     def group_tokens(self):
         tokens = [t for t in self.contents if isinstance(t, Token)]
@@ -586,20 +959,62 @@ class ParsedPattern(object):
 
 
 class Pattern(object):
+    """ A pattern string, parsed and ready to match against targets.
+
+    Public instance variables:
+    regexc - the compiled regular expression, or None if the pattern
+        contains user or bot variables. Patterns which have been pickled
+        and unpickled don't compile it again until it's first used.
+    atomic - True if the regular expressions are generated with atomic
+        groups and possessive quantifiers (see the module docstring)
+    ascii - True if the regular expressions are compiled with re.ASCII
+        for ASCII targets (see set_ascii and the module docstring)
+    match_key - a hashable value which is the same for two Patterns if and
+        only if they match the same strings: the formatted pattern along with
+        the values of any alternates it uses
+
+    Public class variable:
+    regex_cache - an LRUCache (see cache.py) of compiled regular expressions
+        for patterns containing user or bot variables, keyed by the pattern
+        and the values of its variables. Its maxsize may be changed, and
+        its hits, misses and evictions counters may be inspected.
+    """
+    regex_cache = LRUCache(_REGEX_CACHE_SIZE)
 
-    def __init__(self, raw, alternates=None, simple=False):
+    def __init__(self, raw, alternates=None, simple=False, atomic=False):
         self.raw = raw
         self.alternates = alternates
+        self.atomic = atomic and _ATOMIC_GROUPS
+        self.ascii = False
+        self._unicode_regexc = None
         if self.raw:
             self._parse_tree = ParsedPattern(raw, simple=simple)
             self.formatted_pattern = self._parse_tree.format()
             self.score = self._parse_tree.score()
-            self.regexc = self._cache_regexc(alternates)
+            self._regex_source = self._cache_regex(alternates)
+            self._regexc = None
+            self.regexc  # compile it now, to find any errors
+            self.required_words = self._parse_tree.required_words(alternates)
+            self.min_words, self.max_words = self._parse_tree.word_count(
+                alternates)
+            self._variable_refs = []
+            for ref in self._parse_tree.referenced_variables():
+                if ref not in self._variable_refs:
+                    self._variable_refs.append(ref)
+            self.match_key = tuple(
+                [self.formatted_pattern] +
+                [(alternates or {}).get("a", {}).get(var_name)
+                 for var_id, var_name in self._variable_refs
+                 if var_id == "a"])
         else:
             self._parse_tree = None
             self.formatted_pattern = ""
             self.score = _WILDCARD_SCORE
-            self.regexc = None
+            self._regex_source = self._regexc = None
+            self.required_words = []
+            self.min_words, self.max_words = 0, None
+            self._variable_refs = []
+            self.match_key = ("",)
 
     def __bool__(self):
         return len(self.raw) != 0
@@ -607,36 +1022,147 @@ class Pattern(object):
     def __nonzero__(self):
         return self.__bool__()
 
-    def _cache_regexc(self, alternates):
+    def __getstate__(self):
+        """ Pickle everything but the compiled regular expressions, and
+        leave out ASCII mode, which is chosen when the rules are loaded.
+        """
+        state = self.__dict__.copy()
+        state.update(ascii=False, _regexc=None, _unicode_regexc=None)
+        return state
+
+    @property
+    def regexc(self):
+        if self._regexc is None and self._regex_source is not None:
+            self._regexc = re.compile(self._regex_source,
+                                      flags=self._flags())
+        return self._regexc
+
+    def _cache_regex(self, alternates):
+        """ Return the regular expression for this pattern, or None if it
+        contains user or bot variables.
+        """
         try:
-            regex = self.regex(alternates)
-            return re.compile(regex, flags=re.UNICODE)
+            return self.regex(alternates)
         except PatternVariableNotFoundError as e:
             log.debug("[Pattern] " + e.args[0] +
                       ' in "{0}"'.format(self.formatted_pattern) +
                       ", failed to cache regex")
             return None
 
+    def _flags(self, string=""):
+        """ Return the flags to compile regular expressions with for
+        matching against string.
+        """
+        if self.ascii and string.isascii():
+            return _ASCII_FLAG
+        return re.UNICODE
+
+    def set_ascii(self, ascii):
+        """ Choose whether to compile the regular expression for this
+        pattern with re.ASCII, which is quicker for ASCII targets. Other
+        targets will be matched against a second regular expression
+        compiled with re.UNICODE, which is made when it's first needed.
+        Does nothing before Python 3.7.
+        """
+        ascii = bool(ascii and _ASCII_FLAG is not None)
+        if ascii == self.ascii:
+            return
+        self.ascii = ascii
+        self._regexc = self._unicode_regexc = None
+
+    def compile_regexes(self):
+        """ Compile the regular expression now instead of when it's first
+        used, and in ASCII mode, the re.UNICODE one for other targets too.
+        """
+        if self._regex_source is None:
+            return
+        self.regexc
+        if self.ascii and self._unicode_regexc is None:
+            self._unicode_regexc = re.compile(self._regex_source,
+                                              flags=re.UNICODE)
+
     def regex(self, variables):
-        return self._parse_tree.regex(variables) + "$"
+        return self._parse_tree.regex(variables, atomic=self.atomic,
+                                      final=True) + "$"
+
+    def expansions(self, limit):
+        """ Return a list of the normalized strings this pattern can match,
+        or None if it can match more than limit of them.
+        """
+        expanded = self._parse_tree.expansions(self.alternates, limit)
+        if expanded is None:
+            return None
+        return [" ".join(words) for words in expanded]
+
+    def add_to_trie(self, trie, value):
+        """ Add this pattern to a PatternTrie, with value to be returned
+        when the pattern matches. Return False if the pattern can't be
+        represented in a trie.
+        """
+        try:
+            trie.add(self._parse_tree, self.alternates, value)
+        except TrieCompileError as e:
+            log.debug("[Pattern] " + e.args[0] +
+                      ' in "{0}"'.format(self.formatted_pattern) +
+                      ", it will be matched by regex")
+            return False
+        return True
 
     def match(self, string, variables):
-        allvars = {}
-        allvars.update(self.alternates)
-        allvars.update(variables)
-        if self.regexc:
-            m = re.match(self.regexc, string)
+        """ Match the pattern against a string, and return the regular
+        expression match object or None. variables is a dictionary or
+        VariableLayers containing dictionaries of user and bot variables.
+        It will only be combined with the alternates if the pattern has
+        variables which weren't filled in when it was compiled.
+        """
+        if self._regex_source is not None:
+            regexc = self._regexc or self.regexc
+            if self.ascii and not string.isascii():
+                if self._unicode_regexc is None:
+                    self._unicode_regexc = re.compile(self._regex_source,
+                                                      flags=re.UNICODE)
+                regexc = self._unicode_regexc
+            m = regexc.match(string)
         else:
+            allvars = VariableLayers(variables, self.alternates)
             try:
-                regex = self.regex(allvars)
+                regexc = self._variable_regexc(allvars, self._flags(string))
             except PatternVariableNotFoundError as e:
                 log.debug(e.args[0] +
                           ' in "{0}"'.format(self.formatted_pattern) +
                           ", match failed")
                 return None
-            m = re.match(regex, string, flags=re.UNICODE)
+            m = regexc.match(string)
         if m is not None:
             log.debug(self.formatted_pattern +
                       '" matched "' + string + '"')
 
         return m
+
+    def _variable_regexc(self, variables, flags=re.UNICODE):
+        """ Return a regular expression for this pattern compiled with
+        flags, with the values of the variables substituted in. Look it up
+        in regex_cache first, using the formatted pattern, flags and the
+        variable values as the key, and add it there if it wasn't found.
+
+        Raises the same exceptions as ParsedPattern.regex.
+        """
+        key = [self.formatted_pattern, self.atomic, flags]
+        for var_id, var_name in self._variable_refs:
+            if (var_id not in variables or
+                    var_name not in variables[var_id]):
+                raise PatternVariableNotFoundError(
+                    "Chatbot variable %{0}:{1} is undefined".format(var_id,
+                                                                    var_name))
+            value = variables[var_id][var_name]
+            if not isinstance(value, text_type):
+                # let ParsedPattern.regex complain about it
+                return re.compile(self.regex(variables), flags=flags)
+            key.append(value)
+        key = tuple(key)
+
+        regexc = self.regex_cache.get(key)
+        if regexc is None:
+            regexc = re.compile(self.regex(variables), flags=flags)
+            self.regex_cache.put(key, regexc)
+        return regexc
@@ -0,0 +1,92 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.prefork, serving replies from worker processes forked
+from one loaded ChatbotEngine.
+
+    Loading scripts with many rules takes time and memory, so a server
+    which replies from several processes can load them once in a parent
+    process and fork the workers from it. After os.fork, a worker shares
+    all of the parent's memory until one of them writes to a page of it,
+    at which point the writer gets its own copy of that page. Replying
+    doesn't change the rules database, so most of it can stay shared if
+    nothing else writes to it:
+
+    - Topics are built and sorted, and patterns compile their regular
+      expressions, the first time they are used. If the workers did that,
+      each would do the work again and keep its own copy of the results,
+      and the pages they are written into. ChatbotEngine.preload does it
+      all in the parent instead.
+
+    - The garbage collector writes to every object it looks at, so the
+      first full collection in each worker would copy almost every page.
+      fork_workers runs a collection in the parent and then moves all the
+      objects left into the permanent generation with gc.freeze, where
+      the workers' collections don't look at them. gc.freeze needs
+      Python 3.7 or later.
+
+    - Reference counts change whenever an object is used, so the pages
+      holding the patterns, rules and regular expressions a worker uses
+      still get copied. How many depends on the messages it replies to,
+      not on the number of rules or workers.
+
+    Everything a worker changes is its own: its users and their variables,
+    the bot variables, the target cache, and the regular expressions
+    cached for patterns containing variables. The workers don't share
+    reloaded scripts either, so rather than using reload_changed, restart
+    them from a parent which has reloaded.
+
+    bench/bench_prefork.py measures the memory each worker doesn't share.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import logging
+import os
+import sys
+
+log = logging.getLogger(__name__)
+
+
+def fork_workers(engine, count, serve):
+    """ Preload a ChatbotEngine, freeze the garbage collector's view of
+    everything in memory, and fork count worker processes. Each worker
+    calls serve(engine, index), where index counts from 0, and exits with
+    status 0 when it returns, or 1 if it raises an exception, which is
+    logged. Return a list of the workers' process ids. Needs os.fork, so
+    doesn't work on Windows.
+    """
+    engine.preload()
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                serve(engine, index)
+                status = 0
+            except BaseException:
+                log.exception("Worker {0} failed".format(index))
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        pids.append(pid)
+    return pids
+
+
+def wait_workers(pids):
+    """ Wait for the worker processes in a list of process ids to exit,
+    and return a list of their exit statuses.
+    """
+    statuses = []
+    for pid in pids:
+        pid, status = os.waitpid(pid, 0)
+        statuses.append(os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                        else -os.WTERMSIG(status))
+    return statuses
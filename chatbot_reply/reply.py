@@ -9,22 +9,43 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
+import itertools
 import logging
+import multiprocessing
 import re
+import string
+import threading
+import time
 
-from chatbot_reply.six import get_method_self, text_type
+from chatbot_reply.six import text_type
 
+from chatbot_reply.cache import LRUCache
+from chatbot_reply.patterns import VariableLayers
 from chatbot_reply.rules import RulesDB
-from chatbot_reply.script import Script, UserInfo
+from chatbot_reply.script import Script, UserInfo, ReplyContext
 from chatbot_reply.script import kill_non_alphanumerics, split_on_whitespace
 from chatbot_reply.exceptions import *
 
-# todo use imp thread locking, though this thing is totally not thread-safe
 # should case sensitivity be an option?
 # If we decide to rerun setup methods, need to reparse alternates
 
 log = logging.getLogger(__name__)
 
+_non_alphanumerics = re.compile(r"[^\w\s]+", re.UNICODE)
+
+# For normalizing ASCII text with bytes.translate, which lower cases and
+# deletes everything but letters, digits, the underscore and spaces much
+# more quickly than str.lower and a regular expression
+_ASCII = hasattr(text_type, "isascii")
+if _ASCII:
+    _ascii_lower = bytes.maketrans(string.ascii_uppercase.encode("ascii"),
+                                   string.ascii_lowercase.encode("ascii"))
+    _ascii_deletions = bytes(bytearray(
+        c for c in range(128)
+        if not (chr(c).isalnum() or chr(c) in "_ ")))
+    _ascii_line_deletions = _ascii_deletions.replace(b"\n", b"")
+
 
 class ChatbotEngine(object):
     """ Python Chatbot Reply Generator
@@ -38,35 +59,177 @@ class ChatbotEngine(object):
 
     Public instance methods:
       load_script_directory: loads rules from a directory of python files
+      reload_changed: reloads just the python files which have changed
+      preload: does all the work put off until the first reply, before
+              forking worker processes
+      save_bundle: saves the compiled rule database to a file
+      load_bundle: loads a compiled rule database saved by save_bundle
       clear_rules: empties the rule database
       reply: given a message, find the best matching rule, run it, and return
-              the reply
+              the reply. It may be called from several threads at once.
+
+    Public instance variables:
+      target_cache: LRUCache of recently made Targets, see target_cache_size
     """
 
-    def __init__(self, depth=50):
+    def __init__(self, depth=50, matcher="index", exact_limit=64,
+                 atomic=False, target_cache_size=0, ascii=False,
+                 reload_interval=0, lazy=False):
         """Initialize a new ChatbotEngine.
 
-        Keyword argument:
+        Keyword arguments:
         depth -- Recursion depth limit for replies that reference other replies
+        matcher -- How to narrow down the rules to try for a message:
+            "index" -- skip rules whose patterns contain words that aren't
+                in the message
+            "trie" -- walk the message through a word-level trie built
+                from all the patterns in a topic
+            "regex" -- match the message against a combined regular
+                expression built from all the patterns in a topic
+        exact_limit -- Patterns which can only match this many different
+            messages or fewer, such as "[can i|may i] talk to eliza", are
+            expanded into a dictionary of those messages when the rules are
+            sorted, so they can be found with one lookup. 0 turns this off.
+        atomic -- If True, translate patterns into regular expressions with
+            atomic groups and possessive quantifiers, which match the same
+            messages but can't spend a long time backtracking through long
+            ones. Only has an effect on Python 3.11 or later.
+        target_cache_size -- How many of the most recently seen messages and
+            replies to keep after splitting, substituting and normalizing
+            them, so that repeated ones like "yes" don't have to be done
+            again. The default of 0 turns this off. Only use it if your
+            substitute methods always give the same results for the same
+            text.
+        ascii -- If True, check when scripts are loaded which topics have
+            only ASCII patterns, and in those topics, match ASCII messages
+            with regular expressions compiled with re.ASCII, and normalize
+            them with bytes.translate instead of str.lower and regular
+            expressions, which are both quicker. Messages with any other
+            characters are handled the usual way. Only has an effect on
+            Python 3.7 or later.
+        reload_interval -- If not 0, then when reply is called and it has
+            been this many seconds since the script directories were last
+            checked, call reload_changed first. Errors reloading are
+            logged, and the old rules are kept.
+        lazy -- If True, don't make the rules and patterns of a topic until
+            a user first enters it, so that loading is quicker and topics
+            nobody visits take no memory. Errors in patterns are then
+            raised by reply instead of load_script_directory. The building
+            is thread-safe. See RulesDB.__init__.
         """
         self._depth_limit = depth
+        self._matcher = matcher
+        self._exact_limit = exact_limit
+        self._atomic = atomic
+        self._ascii = ascii
+        self._lazy = lazy
+        self.target_cache = LRUCache(target_cache_size)
+        self._reload_interval = reload_interval
+        self._reload_checked = time.time()
 
         self._botvars = {}
-        self._variables = {"b": self._botvars,
-                           "u": None}
+        self._bot_variables = {"b": self._botvars}
 
         self._users = {}  # will contain UserInfo objects
+        self._users_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
         log.debug("Chatbot instance created.")
         self.clear_rules()
 
     def clear_rules(self):
         """ Empty the rules database """
         log.debug("Rules database cleared")
-        self.rules_db = RulesDB()
+        self.target_cache.clear()
+        self.rules_db = RulesDB(matcher=self._matcher,
+                                exact_limit=self._exact_limit,
+                                atomic=self._atomic, ascii=self._ascii,
+                                lazy=self._lazy)
+
+    def load_script_directory(self, directory, cache_dir=None,
+                              processes=None, bytecode=True):
+        """ Load rules from *.py in a directory and the packages in it. If
+        cache_dir is given, the patterns parsed from the scripts are kept
+        there so that loading the same scripts again is faster, and if
+        processes is given, the patterns are parsed by that many processes.
+        If bytecode is False, the scripts are compiled from source without
+        using or writing .pyc files. Return a LoadReport of the time spent
+        on each file. See RulesDB.load_script_directory.
+        """
+        report = self.rules_db.load_script_directory(directory, self._botvars,
+                                                     cache_dir=cache_dir,
+                                                     processes=processes,
+                                                     bytecode=bytecode)
+        self.target_cache.clear()
+        return report
+
+    def reload_changed(self):
+        """ Import the script files which have been added or changed since
+        they were loaded, drop the scripts from files which have been
+        removed, and rebuild just the topics affected. User variables and
+        topics and bot variables are kept. The setup methods of the
+        reloaded scripts are run again, but can only add bot variables,
+        not change the ones already there. The setup_user methods of
+        scripts which weren't loaded before are called for all the users
+        seen so far, but those of reloaded scripts aren't, so that they
+        don't reset the users' variables; a reloaded script which needs
+        new user variables should check for them before using them.
+        Return a list of the names of the files which were reloaded or
+        removed. See RulesDB.reload_changed.
+        """
+        self._reload_checked = time.time()
+        filenames, instances = self.rules_db.reload_changed(self._botvars)
+        if filenames:
+            log.info("Reloaded " + ", ".join(filenames))
+            self.target_cache.clear()
+        for user, userinfo in list(self._users.items()):
+            with userinfo.lock, ReplyContext(userinfo):
+                for inst in instances:
+                    inst.setup_user(user)
+        return filenames
+
+    def preload(self):
+        """ Build and sort every topic and compile all the regular
+        expressions, which would otherwise be done by the first replies in
+        each topic. Call this before forking worker processes, so the work
+        is done once and its results stay in memory shared with the parent
+        instead of being copied into every worker. See prefork.py.
+        """
+        self.rules_db.preload()
 
-    def load_script_directory(self, directory):
-        """ Load rules from *.py in a directory """
-        self.rules_db.load_script_directory(directory, self._botvars)
+    def save_bundle(self, path):
+        """ Save the rules loaded by load_script_directory, with all their
+        topics built and sorted, to a file, from which load_bundle can load
+        them again much more quickly, for example in each of many worker
+        processes. See RulesDB.save_bundle.
+        """
+        self.rules_db.save_bundle(path)
+
+    def load_bundle(self, path, script_dir):
+        """ Replace the rules with those saved by save_bundle from the
+        scripts in script_dir. The scripts are imported and set up as usual,
+        but their patterns aren't parsed or sorted again. Raises BundleError
+        if the bundle doesn't match this version of chatbot_reply, the
+        matcher, exact_limit and atomic options of this engine, or the
+        scripts. See RulesDB.load_bundle.
+        """
+        self.rules_db.load_bundle(path, script_dir, self._botvars)
+        self.target_cache.clear()
+
+    def _poll_scripts(self):
+        """ If it's time, reload any changed scripts, logging errors. If
+        another thread is already doing it, don't wait for it.
+        """
+        if (not self._reload_interval or
+                time.time() - self._reload_checked < self._reload_interval):
+            return
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            self.reload_changed()
+        except Exception as e:
+            log.error("Could not reload scripts: {0}".format(e))
+        finally:
+            self._reload_lock.release()
 
     def reply(self, user, user_dict, message):
         """ For the current topic, find the best matching rule for the message.
@@ -85,27 +248,42 @@ class ChatbotEngine(object):
         Exceptions:
         RecursionTooDeepError -- if recursion goes over depth limit passed
             to __init__
+
+        This may be called from several threads at once. Replies to the
+        same user are made one at a time, and the rule methods of a reply
+        see its user and match through a ReplyContext kept for the thread
+        (see script.py) rather than in the Script instances they share. A
+        reply uses the topics as they were when it started, even if
+        another thread reloads scripts while it is being made.
         """
         if not isinstance(message, text_type):
             raise TypeError("message argument must be string, not bytestring")
 
+        self._poll_scripts()
         self.rules_db.sort_rules()
+        topics = self.rules_db.topics
 
         log.debug('Asked to reply to: "{0}" from {1}'.format(message, user))
-        self._setup_user(user, user_dict)
+        userinfo = self._setup_user(user, user_dict)
+        variables = VariableLayers({"u": userinfo.vars}, self._bot_variables)
 
-        try:
-            reply = self._reply(user, message, 0)
-        except RecursionTooDeepError as e:
-            e.args = ('Could not find reply to "{0}", due to rules '
-                      "referencing other rules too many "
-                      "times".format(message),)
-            raise
-        self._remember(user, message, reply)
+        with userinfo.lock, ReplyContext(userinfo, variables=variables):
+            self._check_topic(user, userinfo, topics)
+            try:
+                reply = self._reply(user, message, 0, variables, topics)
+            except RecursionTooDeepError as e:
+                e.args = ('Could not find reply to "{0}", due to rules '
+                          "referencing other rules too many "
+                          "times".format(message),)
+                raise
+            self._remember(user, message, reply)
         return reply
 
-    def _reply(self, user, message, depth):
-        """ Recursively construct replies """
+    def _reply(self, user, message, depth, variables, topics):
+        """ Recursively construct replies. variables is a VariableLayers
+        containing the user and bot variables, for matching patterns, and
+        topics is the dictionary of Topics to use.
+        """
         if depth > self._depth_limit:
             raise RecursionTooDeepError
 
@@ -113,42 +291,40 @@ class ChatbotEngine(object):
             message, depth))
         userinfo = self._users[user]
         topic = userinfo.topic_name
-        target = Target(message, self.rules_db.topics[topic].substitutions)
+        current = topics.get(topic, topics["all"])
+        target = self._make_target(message, current)
         reply = ""
 
-        for rule in self.rules_db.topics[topic].sortedrules:
-            m = rule.match(target, userinfo.repl_history,
-                           self._variables)
-            if m is not None:
-                reply = self._reply_from_rule(rule, m, userinfo)
-                self._check_for_topic_change(user, rule, topic,
-                                             userinfo.topic_name)
-                break
+        rule, m = current.match(target, userinfo.repl_history, variables)
+        if rule is not None:
+            reply = self._reply_from_rule(rule, m, userinfo, variables)
+            self._check_for_topic_change(user, rule, topic,
+                                         userinfo.topic_name, topics)
 
-        reply = self._recursively_expand_reply(user, reply, depth)
+        reply = self._recursively_expand_reply(user, reply, depth, variables,
+                                               topics)
         if not reply:
             log.debug("Empty reply generated")
         else:
             log.debug("Generated reply: " + reply)
         return reply
 
-    def _reply_from_rule(self, rule, rule_match, userinfo):
+    def _reply_from_rule(self, rule, rule_match, userinfo, variables):
         """ Given a rule and the results from a successful match of the rule's
         pattern, call the rule method and return the results.
         """
         log.debug("Found match, rule {0}".format(rule.rulename))
 
-        inst = get_method_self(rule.method)
-        inst.userinfo = userinfo
-        inst.match = rule_match.dict
-        reply = rule.method()
+        with ReplyContext(userinfo, rule_match.dict, variables):
+            reply = rule.method()
         if not isinstance(reply, text_type):
             raise TypeError("Rule {0} returned something other than a "
                             "string.".format(rule.rulename))
         log.debug('Rule {0} returned "{1}"'.format(rule.rulename, reply))
         return reply
 
-    def _recursively_expand_reply(self, user, reply, depth):
+    def _recursively_expand_reply(self, user, reply, depth, variables,
+                                  topics):
         """ Given a reply string from a rule, look for references to other
         rules enclosed within < > and recursively call _reply to get responses,
         and substitute those into the original string. Evaluates from left
@@ -157,7 +333,8 @@ class ChatbotEngine(object):
         matches = [m for m in re.finditer("<(.*?)>", reply, flags=re.UNICODE)]
         if matches:
             log.debug("Rule returned: " + reply)
-        sub_replies = [self._reply(user, m.groups()[0], depth + 1)
+        sub_replies = [self._reply(user, m.groups()[0], depth + 1, variables,
+                                   topics)
                        for m in matches]
         zipper = list(zip(matches, sub_replies))
         zipper.reverse()
@@ -165,42 +342,54 @@ class ChatbotEngine(object):
             reply = reply[:m.start()] + sub_reply + reply[m.end():]
         return reply
 
-    def _check_for_topic_change(self, user, rule, old_topic, new_topic):
+    def _check_for_topic_change(self, user, rule, old_topic, new_topic,
+                                topics):
         """ Given a rule, and the topic set before and after its execution,
-        make sure the change is legit and do appropriate debug logging.
+        make sure the change is legit, given the dictionary of Topics, and
+        do appropriate debug logging.
         """
         if old_topic != new_topic:
-            if new_topic not in self.rules_db.topics:
+            if new_topic not in topics:
                 log.warning("Rule {0} changed to empty topic {1}, "
                             "returning to 'all'".format(
                                 rule.rulename, new_topic))
                 new_topic = "all"
             log.debug("User {0} now in topic {1}".format(user, new_topic))
+            topics[new_topic].build()
 
         self._users[user].topic_name = new_topic
 
     def _setup_user(self, user, user_dict):
-        """ Set up the Script class to process a message from a user. If the
-        user is new to us, create the UserInfo object for them, and call
-        the setup_user method of all the script instances so they can
-        initialize user variables.
+        """ Return the UserInfo object for a user. If the user is new to
+        us, create it, and call the setup_user method of all the script
+        instances so they can initialize user variables, before any other
+        thread can see it.
         """
-        new = (user not in self._users)
-        if new:
-            self._users[user] = UserInfo(user_dict)
-
-        self._variables["u"] = self._users[user].vars
-        topic = self._users[user].topic_name
-        if topic not in self.rules_db.topics:
+        userinfo = self._users.get(user)
+        if userinfo is not None:
+            return userinfo
+        with self._users_lock:
+            userinfo = self._users.get(user)
+            if userinfo is None:
+                userinfo = UserInfo(user_dict)
+                log.debug("New user, running all scripts' setup_user "
+                          "methods")
+                with ReplyContext(userinfo):
+                    for inst in self.rules_db.script_instances:
+                        inst.setup_user(user)
+                self._users[user] = userinfo
+        return userinfo
+
+    def _check_topic(self, user, userinfo, topics):
+        """ Make sure the user's topic exists in a dictionary of Topics, and
+        is built.
+        """
+        topic = userinfo.topic_name
+        if topic not in topics:
             log.warning("User {0} is in empty topic {1}, "
                         "returning to 'all'".format(user, topic))
-            topic = self._users[user].topic_name = "all"
-
-        if new:
-            log.debug("New user, running all scripts' setup_user methods")
-            for inst in self.rules_db.script_instances:
-                inst.userinfo = self._users[user]
-                inst.setup_user(user)
+            topic = userinfo.topic_name = "all"
+        topics[topic].build()
 
     def _remember(self, user, message, reply):
         """ Save recent messages and replies, per user """
@@ -208,7 +397,34 @@ class ChatbotEngine(object):
         topic_name = user_info.topic_name
         user_info.msg_history.appendleft(message)
         user_info.repl_history.appendleft(
-            Target(reply, self.rules_db.topics[topic_name].substitutions))
+            LazyTarget(reply, topic_name, self._make_reply_target))
+
+    def _make_reply_target(self, text, topic_name):
+        """ Make a Target from a reply, using the substitutions of the
+        named topic as it is now, which may have been replaced by
+        reload_changed or load_bundle since the reply was made. If the topic
+        is gone, use "all".
+        """
+        topics = self.rules_db.topics
+        return self._make_target(text, topics.get(topic_name, topics["all"]))
+
+    def _make_target(self, text, topic):
+        """ Make a Target from text using the substitutions of a Topic,
+        or find one made earlier in the target cache. Targets are cached by
+        the names of the substitution methods and tables rather than the
+        topic, so topics with the same substitutions share them.
+        """
+        substitutions, table = topic.substitutions, topic.substitution_table
+        ascii = topic.ascii
+        if self.target_cache.maxsize <= 0:
+            return Target(text, substitutions, table, ascii)
+        key = (tuple([name for name, method in substitutions]),
+               table.names if table is not None else (), text)
+        target = self.target_cache.get(key)
+        if target is None:
+            target = Target(text, substitutions, table, ascii)
+            self.target_cache.put(key, target)
+        return target
 
 
 class Target(object):
@@ -221,9 +437,12 @@ class Target(object):
         after doing substitutions (see below), making them lower case,
         and removing all remaining non-alphanumeric characters.
     normalized: tokenized_words, joined back together by single spaces
+    offsets: an array of the positions in normalized where the words
+        from each list in tokenized_words begin, used by Match to find the
+        raw words which correspond to memorized matches
 
     """
-    def __init__(self, text, substitutions=[]):
+    def __init__(self, text, substitutions=[], table=None, ascii=False):
         """ Create a match target from a string.
             - Break it into a list of words on whitespace and save the originals
             - Run substitutions
@@ -239,6 +458,11 @@ class Target(object):
                 the same length as the input. The functions in the substitutions
                 list will all be called, using the output of one as the input of
                 the next.
+            table - a SubstitutionTable, or None. If given, each word is
+                looked up in it before the substitution functions are called.
+            ascii - if True, and the words are all ASCII, normalize them
+                with bytes.translate, which is quicker. Only has an effect
+                on Python 3.7 or later.
 
         Examples, showing text and the results placed in raw_words,
         tokenized_words and normalized.
@@ -268,33 +492,280 @@ class Target(object):
         """
         self.raw_text = text
         self.raw_words = split_on_whitespace(text)
-        sub_words = self._do_substitutions(substitutions)
-
-        self.tokenized_words = [[kill_non_alphanumerics(word.lower())
-                                 for word in wl] for wl in sub_words]
-        self.normalized = " ".join(
-                                [" ".join(wl) for wl in self.tokenized_words])
+        ascii = ascii and _ASCII
+        if substitutions or table is not None:
+            self.tokenized_words = _token_lists(
+                _substitute(text, self.raw_words, substitutions, table),
+                ascii)
+            self.normalized, self.offsets = _join_token_lists(
+                self.tokenized_words)
+        else:
+            self.normalized = _normalize_words(self.raw_words, ascii)
+            tokens = self.normalized.split(" ") if self.raw_words else []
+            self.tokenized_words = [[token] for token in tokens]
+            self.offsets = _word_offsets(tokens)
         log.debug('Normalized message to "{0}"'.format(self.normalized))
 
-    def _do_substitutions(self, substitutions):
-        """Check a word against the substitutions dictionary. If the word is
-        not found, return it wrapped in a list. Otherwise return the
-        value from the dictionary as a list of words.
-        """
-        results = [[word] for word in self.raw_words]
-        length = len(results)
-        for name, func in substitutions:
-            try:
-                clearer_error_message = ""
-                results = func(self.raw_text, results)
-                clearer_error_message = " return value of"
-                log.debug("{0} returned {1}".format(name, results))
-                if len(results) != length:
-                    raise TypeError("Returned list must be same length as "
-                                    "passed list")
-            except Exception as e:
-                msg = (" in{0} {1}".format(clearer_error_message, name))
-                e.args = (e.args[0] + msg,) + e.args[1:]
-                raise
 
+def normalize_messages(messages, topic=None, processes=None, chunksize=1000):
+    """ Normalize messages the same way Target does, using the substitution
+    methods and table of topic, a Topic from RulesDB.topics, if given. For
+    each message, generate a tuple of the normalized string and an array of
+    the offsets of its words (see Target.offsets). This is much quicker
+    than making a Target for each message, if that's all you need.
+
+    ASCII messages are normalized a chunk at a time, without or with a
+    substitution table, as long as the table's lookups can all be done in
+    one go (see SubstitutionTable.substitute_joined). Then the word
+    offsets are all that is left to do one message at a time. Substitution
+    methods, and so topics that have them, need every message to be done
+    on its own, which is several times slower.
+
+    If processes is given, the messages are divided into lists of chunksize
+    and normalized by a multiprocessing.Pool of that many processes, and
+    the results are generated in the same order as the messages. Where
+    processes can't be started with fork, the topic's substitution methods
+    must be picklable.
+    """
+    substitutions, table = [], None
+    if topic is not None:
+        substitutions, table = topic.substitutions, topic.substitution_table
+    chunks = _chunks(messages, chunksize)
+    if not processes:
+        for chunk in chunks:
+            for result in _normalize_chunk(chunk, substitutions, table):
+                yield result
+        return
+
+    try:
+        context = multiprocessing.get_context("fork")
+    except (AttributeError, ValueError):  # Python 2, or no fork
+        context = multiprocessing
+    pool = context.Pool(processes, _set_worker_substitutions,
+                        (substitutions, table))
+    try:
+        for results in pool.imap(_normalize_worker_chunk, chunks):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _chunks(iterable, size):
+    """ Generate lists of up to size items from iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_worker_substitutions = ([], None)
+
+
+def _set_worker_substitutions(substitutions, table):
+    """ Initialize a normalize_messages worker process """
+    global _worker_substitutions
+    _worker_substitutions = (substitutions, table)
+
+
+def _normalize_worker_chunk(chunk):
+    return _normalize_chunk(chunk, *_worker_substitutions)
+
+
+def _normalize_chunk(chunk, substitutions, table):
+    """ Return a list of tuples of the normalized string and offsets array
+    for each message in chunk. Without substitutions, the whole chunk is
+    normalized at once, joined by newlines, which normalization keeps.
+    """
+    if _ASCII and table is not None and not substitutions:
+        results = _normalize_chunk_with_table(chunk, table)
+        if results is not None:
+            return results
+    results = []
+    if substitutions or table is not None:
+        for text in chunk:
+            raw_words = split_on_whitespace(text)
+            results.append(_join_token_lists(_token_lists(
+                _substitute(text, raw_words, substitutions, table), _ASCII)))
         return results
+
+    texts = [" ".join(split_on_whitespace(text)) for text in chunk]
+    for text, normalized in zip(texts, _normalize_words(
+            texts, _ASCII, "\n").split("\n")):
+        tokens = normalized.split(" ") if text else []
+        results.append((normalized, _word_offsets(tokens)))
+    return results
+
+
+def _normalize_chunk_with_table(chunk, table):
+    """ Do what _normalize_chunk does for a chunk of messages with a
+    substitution table but no substitution methods, by looking up all the
+    words of the chunk in the table together and normalizing them all at
+    once. The words a word is replaced by are joined with "\x01", which
+    _ascii_normalize is told to keep, so that each group still counts as
+    one word for the offsets, and then changed back to spaces. Return None
+    if that can't be done, because the chunk isn't all ASCII or the table
+    needs more than one lookup per word.
+    """
+    lines = [" ".join(split_on_whitespace(text)) for text in chunk]
+    text = " \n ".join(lines)
+    if not text.isascii() or "\x01" in text or "" in lines:
+        return None
+    words = table.substitute_joined(text.split(" "), "\x01")
+    if words is None:
+        return None
+    results = []
+    for normalized in _ascii_normalize(" ".join(words), True,
+                                       "\x01").split(" \n "):
+        offsets = _word_offsets(normalized.split(" "))
+        if "\x01" in normalized:
+            normalized = normalized.replace("\x01", " ")
+        results.append((normalized, offsets))
+    return results
+
+
+def _substitute(text, raw_words, substitutions, table):
+    """ Look up each raw word in the substitution table, if there is
+    one, and then pass the resulting lists of words through each of the
+    substitution functions.
+    """
+    if table is None:
+        results = [[word] for word in raw_words]
+    else:
+        results = table.substitute(raw_words)
+    length = len(results)
+    for name, func in substitutions:
+        try:
+            clearer_error_message = ""
+            results = func(text, results)
+            clearer_error_message = " return value of"
+            log.debug("{0} returned {1}".format(name, results))
+            if len(results) != length:
+                raise TypeError("Returned list must be same length as "
+                                "passed list")
+        except Exception as e:
+            msg = (" in{0} {1}".format(clearer_error_message, name))
+            e.args = (e.args[0] + msg,) + e.args[1:]
+            raise
+
+    return results
+
+
+def _token_lists(sub_words, ascii=False):
+    """ Given a list of lists of words, lower case them and remove the
+    non-alphanumerics. If ascii is True, try doing all the words at once
+    with _ascii_tokens.
+    """
+    token_lists = None
+    if ascii:
+        token_lists = _ascii_tokens(sub_words)
+    if token_lists is None:
+        token_lists = [[kill_non_alphanumerics(word.lower())
+                        for word in wl] for wl in sub_words]
+    return token_lists
+
+
+def _join_token_lists(token_lists):
+    """ Given a list of lists of tokens, return them joined by single spaces
+    and an array of the offsets where each list begins, in one pass.
+    """
+    chunks = []
+    offsets = array.array(str("l"))
+    offset = 0
+    for tokens in token_lists:
+        chunk = " ".join(tokens)
+        offsets.append(offset)
+        chunks.append(chunk)
+        offset += len(chunk) + 1
+    return " ".join(chunks), offsets
+
+
+def _normalize_words(words, ascii=False, separator=" "):
+    """ Join a list of words which don't contain whitespace with separator,
+    which should be whitespace, and lower case and strip non-alphanumerics
+    from the result all at once. If ascii is True and the text is ASCII,
+    use _ascii_normalize.
+    """
+    text = separator.join(words)
+    if ascii and text.isascii():
+        return _ascii_normalize(text, separator == "\n")
+    return _non_alphanumerics.sub("", text.lower())
+
+
+def _word_offsets(tokens):
+    """ Return an array of the offsets of tokens joined by single spaces """
+    offsets = array.array(str("l"))
+    append = offsets.append
+    offset = 0
+    for token in tokens:
+        append(offset)
+        offset += len(token) + 1
+    return offsets
+
+
+def _ascii_normalize(text, keep_newlines=False, keep=""):
+    """ Lower case ASCII text and remove everything but letters, digits,
+    the underscore, spaces, the characters in keep and, if keep_newlines is
+    True, newlines.
+    """
+    deletions = _ascii_line_deletions if keep_newlines else _ascii_deletions
+    if keep:
+        deletions = deletions.translate(None, keep.encode("ascii"))
+    return text.encode("ascii").translate(_ascii_lower,
+                                          deletions).decode("ascii")
+
+
+def _ascii_tokens(sub_words):
+    """ Given a list of lists of words, normalize them all by joining them
+    with spaces into one string for _ascii_normalize, and return a list of
+    lists of the normalized words. Return None if that can't be done
+    because the words aren't all ASCII or some contain spaces.
+    """
+    words = [word for wl in sub_words for word in wl]
+    text = " ".join(words)
+    if not words or not text.isascii():
+        return None
+    tokens = _ascii_normalize(text).split(" ")
+    if len(tokens) != len(words):
+        return None
+    tokens.reverse()
+    return [[tokens.pop() for word in wl] for wl in sub_words]
+
+
+class LazyTarget(object):
+    """ Stands in for the Target of a reply in UserInfo.repl_history.
+    Only rules with previous reply patterns look at replies, so the Target
+    isn't made until one of its attributes is read, and then it is kept.
+
+    Public instance variables:
+    raw_text: the reply
+    topic_name: the name of the topic whose substitutions will be used
+    target: the Target, which is made the first time this is read
+    """
+    __slots__ = ("raw_text", "topic_name", "_make_target", "_target")
+
+    def __init__(self, text, topic_name, make_target):
+        """ Remember text and the name of a topic, to be passed to
+        make_target when the Target is needed. The topic is looked up by
+        name then rather than now, so that a LazyTarget kept across a
+        reload uses the new topic.
+        """
+        self.raw_text = text
+        self.topic_name = topic_name
+        self._make_target = make_target
+        self._target = None
+
+    @property
+    def target(self):
+        if self._target is None:
+            self._target = self._make_target(self.raw_text, self.topic_name)
+            self._make_target = None
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith("_"):  # such as unset slots, during copying
+            raise AttributeError(name)
+        return getattr(self.target, name)
@@ -0,0 +1,167 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.rulecache, keeps the patterns made from script files on
+disk so they don't have to be parsed again
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+from chatbot_reply.constants import _RULE_CACHE_FORMAT
+from chatbot_reply.patterns import Pattern
+
+log = logging.getLogger(__name__)
+
+
+class RuleCache(object):
+    """ A directory of files of pickled Pattern objects, one for each script
+    file, so that loading an unchanged script doesn't have to parse its
+    patterns again. The files are named after the script and a hash of its
+    contents, the chatbot_reply version, the source of the pattern parser
+    and the Python version, so a file is only used for the exact script
+    and library that made it. Within a
+    file, patterns are looked up by their raw text, alternates and options,
+    so it doesn't matter if a script's setup method changes its alternates.
+    Unpickled patterns don't compile their regular expressions until
+    they are used.
+
+    Public instance variables:
+    directory - the directory the files are kept in
+    hits - the number of patterns found in the cache
+    misses - the number of patterns that had to be made
+
+    Public methods:
+    read_script - read the cache file for a script, if there is one
+    has - check whether a pattern is in a script's cache file
+    pattern - find or make a Pattern for a script
+    write - save the patterns of scripts whose cache files have changed
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._scripts = {}
+
+    def read_script(self, name, filename):
+        """ Read the contents of a script file, and load the patterns cached
+        for that exact file, if there are any. name is used to tell the
+        scripts apart in calls to pattern, and to name the cache file, so it
+        should be unique, such as the module name of the script.
+        """
+        import chatbot_reply
+        with open(filename, "rb") as f:
+            contents = f.read()
+        version = "{0} {1} {2} {3}".format(chatbot_reply.__version__,
+                                           _RULE_CACHE_FORMAT,
+                                           pattern_source_digest(),
+                                           sys.version)
+        digest = hashlib.sha1(version.encode("utf-8") + b"\0" +
+                              contents).hexdigest()
+        path = self._path(name, digest)
+        cached = {}
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+            log.debug("Read cached patterns from " + path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                log.warning("Couldn't read {0}: {1}".format(path, e))
+        except Exception as e:  # unpickling can raise most anything
+            log.warning("Couldn't read {0}: {1}".format(path, e))
+        self._scripts[name] = (path, cached, {})
+
+    def has(self, name, raw, alternates=None, simple=False, atomic=False):
+        """ Return True if the Pattern made with the arguments following
+        name is in the cache for the named script.
+        """
+        cached = self._scripts.get(name, (None, {}, {}))[1]
+        return pattern_key(raw, alternates, simple, atomic) in cached
+
+    def pattern(self, name, raw, alternates=None, simple=False,
+                atomic=False, make=Pattern):
+        """ Return a Pattern made with the arguments following name, from
+        the cache for the named script if it's there, or else a new one
+        made by calling make with them.
+        """
+        path, cached, used = self._scripts.get(name, (None, {}, {}))
+        key = pattern_key(raw, alternates, simple, atomic)
+        pattern = cached.get(key)
+        if pattern is None:
+            self.misses += 1
+            pattern = make(raw, alternates, simple=simple, atomic=atomic)
+        else:
+            self.hits += 1
+        used[key] = pattern
+        return pattern
+
+    def write(self):
+        """ For each script whose patterns weren't all found in its cache
+        file, write a new cache file and remove any old ones. Since the
+        cache is only there to save time, problems writing it are logged
+        as warnings instead of raised.
+        """
+        for name, (path, cached, used) in sorted(self._scripts.items()):
+            if set(used) == set(cached):
+                continue
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                for old in glob.glob(self._path(name, "*")):
+                    # skip the files of modules in a package called name
+                    digest = os.path.basename(old)[len(name) + 1:]
+                    if "." not in os.path.splitext(digest)[0]:
+                        os.remove(old)
+                fd, temp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(used, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(temp, path)
+                log.debug("Wrote cached patterns to " + path)
+            except (IOError, OSError) as e:
+                log.warning("Couldn't write {0}: {1}".format(path, e))
+        self._scripts = {}
+
+    def _path(self, name, digest):
+        return os.path.join(self.directory,
+                            "{0}.{1}.patterns".format(name, digest))
+
+
+def pattern_key(raw, alternates=None, simple=False, atomic=False):
+    """ Return a hashable key for the Pattern which would be made with
+    the same arguments.
+    """
+    if alternates:
+        alternates = tuple(sorted((k, tuple(sorted(v.items())))
+                                  for k, v in alternates.items()))
+    return (raw, alternates or None, simple, atomic)
+
+
+_source_digests = []
+
+
+def pattern_source_digest():
+    """ Return a hash of the source of the modules which parse patterns and
+    generate their regular expressions, so that patterns saved by one
+    version of them aren't used with another, even if _RULE_CACHE_FORMAT
+    wasn't changed.
+    """
+    if not _source_digests:
+        from chatbot_reply import patterns, trie
+        digest = hashlib.sha1()
+        for module in [patterns, trie]:
+            filename = module.__file__
+            if filename.endswith((".pyc", ".pyo")):
+                filename = filename[:-1]
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+        _source_digests.append(digest.hexdigest())
+    return _source_digests[0]
@@ -8,15 +8,41 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import bisect
-import imp
+import collections
+import copy
+import functools
+import gc
+import hashlib
 import inspect
 import logging
+import multiprocessing
 import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
 
-from chatbot_reply.constants import _PREFIX
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:  # Python 2
+    import imp
+    module_from_spec = spec_from_file_location = None
+
+from chatbot_reply.constants import _BUNDLE_FORMAT, _PREFIX
+from chatbot_reply.dispatch import PatternDispatcher
 from chatbot_reply.exceptions import *
-from chatbot_reply.patterns import Pattern
-from chatbot_reply.script import Script, ScriptRegistrar
+from chatbot_reply.patterns import _ASCII_FLAG, Pattern
+from chatbot_reply.rulecache import (RuleCache, pattern_key,
+                                     pattern_source_digest)
+from chatbot_reply.script import Script, ScriptRegistrar, SubstitutionTable
+from chatbot_reply.six import string_types, text_type
+from chatbot_reply.trie import PatternTrie
 
 log = logging.getLogger(__name__)
 
@@ -29,132 +55,717 @@ class RulesDB(object):
     Public methods --
     load_script_directory: Load python files from a directory into the
         database
+    reload_changed: Load the python files which have changed since they
+        were loaded, and rebuild the topics they affect
+    preload: Build and sort all the topics and compile their patterns
+    save_bundle: Save the built and sorted topics to a file
+    load_bundle: Load topics saved by save_bundle, importing the scripts
+        they came from only to set them up and find their methods
     clear_rules: Empty the rules database
+    pattern_counts: Count the rules and different patterns in each topic
 
     Public instance variables --
     topics: dictionary of topic names (as found in Script subclasses) and
         Topic objects built from those subclasses
     script_instances: List containing one instance of each Script subclass
         found, except for those with their topic set to None
+    rule_cache: the RuleCache used by the last call to load_script_directory
+        or reload_changed, or None if it wasn't given a cache directory
     """
-    def __init__(self):
-        """ Create a new empty RulesDB object """
+    def __init__(self, matcher="index", exact_limit=64, atomic=False,
+                 ascii=False, lazy=False):
+        """ Create a new empty RulesDB object. matcher and exact_limit are
+        passed on to the Topic objects, see Topic.__init__, and atomic is
+        passed on to the Rule objects, see Rule.__init__.
+
+        If ascii is True, then after scripts are loaded, each topic whose
+        patterns, and the alternates they use, are all ASCII is switched to
+        ASCII mode (see Topic.set_ascii). This needs Python 3.7 or later.
+
+        If lazy is True, scripts are instantiated and set up, and their
+        rule methods and alternates are checked when they are loaded, but
+        the Rules and Patterns of each topic aren't made until the topic is
+        built (see Topic.build), so errors in patterns aren't found until
+        then either. The rule cache and process pool options of
+        load_script_directory aren't used for lazy topics.
+        """
+        self._matcher = matcher
+        self._exact_limit = exact_limit
+        self._atomic = atomic
+        self._ascii = ascii
+        self._lazy = lazy
+        self.rule_cache = None
         self.clear_rules()
 
     def clear_rules(self):
         """ Make a fresh new empty rules database. """
-        self.topics = {}
+        self.topics = {"all": self._new_topic()}
         self.script_instances = []
-        self._new_topic("all")
+        # For reload_changed: the cache directory and bytecode option each
+        # script directory was loaded with, the state of each file loaded,
+        # the file of each module name, and a tuple of (filename, instance,
+        # rules, substitute methods) for each script instance in the order
+        # loaded
+        self._directories = collections.OrderedDict()
+        self._files = {}
+        self._module_files = {}
+        self._loaded = []
 
-    def _new_topic(self, topic):
-        """ Add a new topic to the rules database. """
-        self.topics[topic] = Topic()
+    def _new_topic(self):
+        """ Return a new empty Topic for the rules database. """
+        return Topic(matcher=self._matcher, exact_limit=self._exact_limit)
 
-    def load_script_directory(self, directory, botvars):
-        """Iterate through the .py files in a directory, and import all of
-        them. Then look for subclasses of Script and search them for
-        rules, and load those into self.topics.
+    def load_script_directory(self, directory, botvars, cache_dir=None,
+                              processes=None, bytecode=True):
+        """Iterate through the .py files in a directory, and the packages
+        in it and in them, and import all of them. Then look for subclasses
+        of Script and search them for rules, and load those into
+        self.topics. Return a LoadReport of how long each file took.
         botvars is a dictionary that loaded scripts can use to initialize
         chatbot state
 
+        The modules are named after the files, with _PREFIX added to the
+        start to avoid conflicts, and packages are imported before their
+        modules, so scripts in packages may use relative imports. If
+        bytecode is False, script files are always compiled from source,
+        instead of using and writing .pyc files (except on Python 2).
+
+        If cache_dir is given, the patterns parsed from each script file
+        are saved in that directory, and loaded from there instead of
+        being parsed again the next time the same file is loaded by the
+        same versions of chatbot_reply and Python (see RuleCache).
+
+        If processes is given, all the Script subclasses are instantiated
+        and set up first, and then the patterns of their rules which
+        aren't in the cache are parsed by a multiprocessing.Pool of that
+        many processes, before the rules are built in the same order as
+        they would have been without it. Errors in patterns still name the
+        rule they came from.
         """
         self.rules_sorted = False
         ScriptRegistrar.clear()
+        self.rule_cache = None
+        if cache_dir is not None:
+            self.rule_cache = RuleCache(cache_dir)
+        self._directories[directory] = (cache_dir, bytecode)
+        report = LoadReport()
 
-        for item in os.listdir(directory):
-            if item.lower().endswith(".py"):
-                log.debug("Importing " + item)
-                filename = os.path.join(directory, item)
-                self._import(filename)
+        for filename, modname in self._script_files(directory):
+            start = time.time()
+            self._files[filename] = _file_state(filename)
+            self._import_script(filename, modname, bytecode)
+            report.add(filename, import_seconds=time.time() - start)
 
-        for cls in ScriptRegistrar.registry:
-            log.debug("Loading scripts from " + cls.__name__)
-            self._add_to_rulesdb(cls, botvars)
+        if processes and not self._lazy:
+            instances = []
+            for cls in ScriptRegistrar.registry:
+                start = time.time()
+                instance = self._new_script_instance(cls, botvars)
+                if instance is not None:
+                    instances.append((instance, self._script_methods(
+                        instance, self._pattern_maker(instance))))
+                report.add(self._module_files.get(cls.__module__),
+                           rules_seconds=time.time() - start)
+            start = time.time()
+            made = self._make_patterns(instances, processes)
+            report.pool_seconds = time.time() - start
+            for instance, methods in instances:
+                log.debug("Loading scripts from " +
+                          instance.__class__.__name__)
+                start = time.time()
+                count = self._add_script_instance(instance, made, methods)
+                report.add(self._module_files.get(instance.__module__),
+                           rules_seconds=time.time() - start,
+                           rule_count=count)
+        else:
+            for cls in ScriptRegistrar.registry:
+                log.debug("Loading scripts from " + cls.__name__)
+                start = time.time()
+                count = self._add_to_rulesdb(cls, botvars)
+                report.add(self._module_files.get(cls.__module__),
+                           rules_seconds=time.time() - start,
+                           rule_count=count)
+
+        if self.rule_cache is not None:
+            log.debug("Found {0} of {1} patterns in {2}".format(
+                self.rule_cache.hits,
+                self.rule_cache.hits + self.rule_cache.misses, cache_dir))
+            self.rule_cache.write()
 
-        if sum([len(t.rules) for k, t in self.topics.items()]) == 0:
+        if sum([t.rule_count() for k, t in self.topics.items()]) == 0:
             raise NoRulesFoundError(
                 "No rules were found in {0}/*.py".format(directory))
 
-    def _import(self, filename):
-        """Import a python module, given the filename, but to avoid creating
-        namespace conflicts give the module a name consisting of
-        _PREFIX + filename (minus any extension).
+        for topic, (rules, patterns) in sorted(self.pattern_counts().items()):
+            log.debug('Topic "{0}" has {1} rules using {2} different '
+                      'patterns'.format(topic, rules, patterns))
+        self._set_ascii()
+        return report
+
+    def reload_changed(self, botvars):
+        """ Look for .py files which have been added to, changed in or
+        removed from the directories loaded by load_script_directory, and
+        import just those. Then rebuild and sort only the topics which had
+        rules or substitutions from those files, reusing the Rules of the
+        unchanged scripts, and replace the old ones. Nothing is replaced
+        if there is an error. Scripts which import other scripts won't
+        notice when those change.
+
+        The setup methods of the reloaded scripts are run again, but any
+        bot variables which existed before are put back afterwards, so
+        setup can add new ones but not reset the old ones. If there is an
+        error, all of them are put back.
+
+        Return a tuple of a sorted list of the filenames found to be new,
+        changed or removed, and a list of the Script instances made from
+        them whose classes weren't loaded before, by module and class
+        name, and so whose setup_user methods haven't been called for any
+        user.
         """
-        global _PREFIX
-        path, name = os.path.split(filename)
-        name, ext = os.path.splitext(name)
+        changed, removed = [], set()
+        files = dict(self._files)
+        for directory in self._directories:
+            current = self._script_files(directory)
+            filenames = set(filename for filename, modname in current)
+            removed.update(f for f in self._files
+                           if f.startswith(os.path.join(directory, "")) and
+                           f not in filenames)
+            for filename, modname in current:
+                old = self._files.get(filename)
+                files[filename] = _file_state(filename, old)
+                if old is None or old[1] != files[filename][1]:
+                    changed.append((directory, filename, modname))
+        for filename in removed:
+            log.debug("Removing scripts from " + filename)
+            del files[filename]
+        if not changed and not removed:
+            self._files = files
+            return [], []
+
+        saved = dict(botvars)
+        try:
+            result = self._replace_changed(changed, removed, files, botvars)
+        except Exception:
+            botvars.clear()
+            botvars.update(saved)
+            raise
+        botvars.update(saved)
+        return result
+
+    def _replace_changed(self, changed, removed, files, botvars):
+        """ Do the work of reload_changed, given a list of tuples of the
+        directories, filenames and module names of the changed files, a
+        set of the removed filenames and the new dictionary of file states.
+        """
+        reloaded = {}
+        for directory, (cache_dir, bytecode) in self._directories.items():
+            scripts = [(f, m) for d, f, m in changed if d == directory]
+            if scripts:
+                reloaded.update(self._reload_scripts(scripts, botvars,
+                                                     cache_dir, bytecode))
+        changed = [f for d, f, m in changed]
+        changed_files = set(changed)
+        entries = []
+        for entry in self._loaded:
+            if entry[0] in reloaded:
+                entries.extend(reloaded.pop(entry[0]))
+            elif entry[0] not in removed and entry[0] not in changed_files:
+                entries.append(entry)
+        for filename in changed:
+            entries.extend(reloaded.pop(filename, []))
+
+        affected = set(entry[1].topic for entry in self._loaded
+                       if entry[0] in removed or entry[0] in changed_files)
+        new_instances = [entry[1] for entry in entries
+                         if entry[0] in changed_files]
+        affected.update(instance.topic for instance in new_instances)
+        topics = dict((name, topic) for name, topic in self.topics.items()
+                      if name not in affected)
+        topics.setdefault("all", self._new_topic())
+        for filename, instance, rules, substitutions in entries:
+            if instance.topic in affected:
+                self._add_to_topic(topics, instance, rules, substitutions)
+        if sum([t.rule_count() for k, t in topics.items()]) == 0:
+            raise NoRulesFoundError("No rules were found in {0}".format(
+                ", ".join(d + "/*.py" for d in self._directories)))
+        rebuilt = dict((name, topics[name]) for name in affected
+                       if name in topics)
+        for name, topic in sorted(rebuilt.items()):
+            log.debug('Rebuilding topic "{0}"'.format(name))
+            topic.sort_rules()
+        self._set_ascii(rebuilt)
+
+        known = set(_script_key(entry[1]) for entry in self._loaded)
+        self.topics = topics
+        self.script_instances = [entry[1] for entry in entries]
+        self._loaded = entries
+        self._files = files
+        return (sorted(changed + list(removed)),
+                [instance for instance in new_instances
+                 if _script_key(instance) not in known])
+
+    def preload(self):
+        """ Build and sort every topic, and compile the regular
+        expressions of all their patterns, so that nothing is left to be
+        done the first time a topic is used (see prefork.py).
+        """
+        for topic in self.topics.values():
+            topic.build()
+        self.sort_rules()
+        for topic in self.topics.values():
+            topic.compile_regexes()
+
+    def save_bundle(self, path):
+        """ Build and sort all the topics, and save them to a file, along
+        with the names and hashes of the script files they were loaded from,
+        so that load_bundle can use them instead of making them again. The
+        scripts must all have come from one call to load_script_directory.
+        """
+        if len(self._directories) != 1:
+            raise ValueError("Bundles can only be made of the scripts "
+                             "from one directory")
+        directory = list(self._directories)[0]
+        for topic in self.topics.values():
+            topic.build()
+        self.sort_rules()
+        bundle = {"version": _bundle_version(),
+                  "options": self._bundle_options(),
+                  "files": self._bundle_files(directory),
+                  "topics": self.topics}
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, path)
+        except Exception:
+            os.remove(temp)
+            raise
+        log.info("Saved {0} topics to {1}".format(len(self.topics), path))
+
+    def load_bundle(self, path, directory, botvars):
+        """ Replace the contents of the database with the topics saved by
+        save_bundle. The script files in directory must be the same ones
+        the bundle was made from, or BundleError is raised. They are
+        imported, and their Script subclasses instantiated and set up, so
+        that the rules can call their methods, but no patterns are parsed
+        and no topics sorted. reload_changed works afterwards as if the
+        directory had been loaded by load_script_directory. If importing
+        or setting up a script fails, the database is left as it was.
+        botvars is a dictionary that loaded scripts can use to initialize
+        chatbot state
+        """
+        # Unpickling makes a great many objects without freeing any, which
+        # would set off many full collections for nothing, and make the
+        # ones set off while importing the scripts slow
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._load_bundle(path, directory, botvars)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _load_bundle(self, path, directory, botvars):
+        with open(path, "rb") as f:
+            bundle = pickle.load(f)
+        if bundle["version"] != _bundle_version():
+            raise BundleError("{0} was saved by a different version of "
+                              "chatbot_reply or Python".format(path))
+        if bundle["options"] != self._bundle_options():
+            raise BundleError("{0} was saved with different matcher, "
+                              "exact_limit or atomic options".format(path))
+        if bundle["files"] != self._bundle_files(directory):
+            raise BundleError("The scripts in {0} have changed since {1} was "
+                              "saved".format(directory, path))
+
+        # Nothing is replaced until the scripts have all been imported and
+        # set up, so that if one of them fails the old rules are kept
+        self.rule_cache = None
+        ScriptRegistrar.clear()
+        scripts = self._script_files(directory)
+        files = {}
+        for filename, modname in scripts:
+            files[filename] = _file_state(filename)
+            self._import_script(filename, modname)
+        instances = collections.OrderedDict()
+        for cls in ScriptRegistrar.registry:
+            instance = self._new_script_instance(cls, botvars)
+            if instance is not None:
+                instances[instance.__module__[len(_PREFIX):] + "." +
+                          cls.__name__] = instance
+
+        rules, substitutions = {}, {}
+        topics = bundle["topics"]
+        for topic in topics.values():
+            for rule in topic.rules.values():
+                name, attribute = rule.rulename.rsplit(".", 1)
+                rule.method = getattr(instances[name], attribute)
+                rules.setdefault(name, []).append(rule)
+            for i, (subname, method) in enumerate(topic.substitutions):
+                name, attribute = subname.rsplit(".", 1)
+                method = getattr(instances[name], attribute)
+                topic.substitutions[i] = (subname, method)
+                substitutions.setdefault(name, []).append((subname, method))
+            topic.set_ascii(False)
+        module_files = dict((modname, filename)
+                            for filename, modname in scripts)
+        loaded = [(module_files.get(instance.__module__), instance,
+                   rules.get(name, []), substitutions.get(name, []))
+                  for name, instance in instances.items()]
+        self._set_ascii(topics)
+
+        self.topics = topics
+        self.script_instances = list(instances.values())
+        self._directories = collections.OrderedDict([(directory,
+                                                      (None, True))])
+        self._files = files
+        self._module_files = module_files
+        self._loaded = loaded
+        log.info("Loaded {0} topics from {1}".format(len(self.topics), path))
+
+    def _bundle_options(self):
+        return (self._matcher, self._exact_limit, self._atomic)
+
+    def _bundle_files(self, directory):
+        """ Return a list of tuples of the paths relative to directory,
+        module names and hashes of the script files in it.
+        """
+        return [(os.path.relpath(filename, directory), modname,
+                 _file_state(filename, self._files.get(filename))[1])
+                for filename, modname in self._script_files(directory)]
+
+    def _reload_scripts(self, scripts, botvars, cache_dir, bytecode):
+        """ Import the script files in a list of tuples of filenames and
+        module names, and instantiate and set up the Script subclasses
+        found in them, without changing the database. Return a dictionary
+        of filenames and lists of tuples of (filename, instance, rules,
+        substitute methods).
+        """
+        ScriptRegistrar.clear()
+        self.rule_cache = None
+        if cache_dir is not None:
+            self.rule_cache = RuleCache(cache_dir)
+        for filename, modname in scripts:
+            self._import_script(filename, modname, bytecode)
+        loaded = dict((filename, []) for filename, modname in scripts)
+        for cls in ScriptRegistrar.registry:
+            log.debug("Reloading scripts from " + cls.__name__)
+            instance = self._new_script_instance(cls, botvars)
+            if instance is not None:
+                rules, substitutions = self._load_script_methods(instance)
+                filename = self._module_files.get(instance.__module__)
+                loaded.setdefault(filename, []).append(
+                    (filename, instance, rules, substitutions))
+        if self.rule_cache is not None:
+            self.rule_cache.write()
+        return loaded
+
+    def _script_files(self, directory, package=None):
+        """ Return a list of tuples of the paths of the .py files in a
+        directory, in sorted order, and the module names to import them as.
+        Subdirectories containing an __init__.py are packages, and are
+        searched too, after their __init__.py. package is the module name
+        of the package the directory is, if it is one.
+        """
+        scripts = []
+        for item in sorted(os.listdir(directory)):
+            path = os.path.join(directory, item)
+            name, ext = os.path.splitext(item)
+            if package is not None and item == "__init__.py":
+                continue
+            elif ext.lower() == ".py":
+                if package is None:
+                    scripts.append((path, _PREFIX + name))
+                else:
+                    scripts.append((path, package + "." + name))
+            elif os.path.isfile(os.path.join(path, "__init__.py")):
+                if package is None:
+                    subpackage = _PREFIX + item
+                else:
+                    subpackage = package + "." + item
+                scripts.append((os.path.join(path, "__init__.py"),
+                                subpackage))
+                scripts.extend(self._script_files(path, subpackage))
+        return scripts
+
+    def _import_script(self, filename, modname, bytecode=True):
+        """ Import a script file as modname, remember which file the
+        module came from, and read its patterns from the rule cache if
+        there is one.
+        """
+        log.debug("Importing " + filename)
+        self._import(filename, modname, bytecode)
+        self._module_files[modname] = filename
+        if self.rule_cache is not None:
+            self.rule_cache.read_script(modname[len(_PREFIX):], filename)
+
+    def _set_ascii(self, topics=None):
+        """ If ASCII mode was asked for, turn it on for the topics whose
+        patterns are all ASCII, and off for the others. topics is a
+        dictionary of the topics to check, by default all of them.
+        """
+        if not self._ascii or _ASCII_FLAG is None:
+            return
+        if topics is None:
+            topics = self.topics
+        for name, topic in sorted(topics.items()):
+            topic.set_ascii(topic.is_ascii())
+            log.debug('ASCII mode is {0} for topic "{1}"'.format(
+                "on" if topic.ascii else "off", name))
 
+    def pattern_counts(self):
+        """ Return a dictionary of topic names and tuples of the number of
+        rules in the topic and the number of different patterns (including
+        previous reply patterns) used by those rules. Rules with the same
+        patterns share Pattern objects, so it's the second number which
+        determines how much memory compiled patterns take. Topics which
+        haven't been built yet (see Topic.build) have no patterns.
+        """
+        return dict((name, (topic.rule_count(), topic.pattern_count()))
+                    for name, topic in self.topics.items())
+
+    def _import(self, filename, modname, bytecode=True):
+        """Import a python module, given the filename and the name to give
+        it, which should begin with _PREFIX to avoid namespace conflicts.
+        If the file is an __init__.py, it is imported as a package. If
+        bytecode is False, compile it from source instead of using or
+        writing a .pyc file. If the import fails, any module previously
+        imported with the same name is left in sys.modules.
+        """
         log.debug("Reading " + filename)
-        modname = _PREFIX + name
-        file, filename, data = imp.find_module(name, [path])
-        module = imp.load_module(modname, file, filename, data)
+        path, name = os.path.split(filename)
+        is_package = (name == "__init__.py")
+        if spec_from_file_location is None:
+            if is_package:
+                path, name = os.path.split(path)
+            name = os.path.splitext(name)[0]
+            file, filename, data = imp.find_module(name, [path])
+            return imp.load_module(modname, file, filename, data)
+
+        spec = spec_from_file_location(
+            modname, filename,
+            submodule_search_locations=[path] if is_package else None)
+        module = module_from_spec(spec)
+        old = sys.modules.get(modname)
+        sys.modules[modname] = module
+        try:
+            if bytecode:
+                spec.loader.exec_module(module)
+            else:
+                code = spec.loader.source_to_code(
+                    spec.loader.get_data(filename), filename)
+                exec(code, module.__dict__)
+        except Exception:
+            if old is None:
+                del sys.modules[modname]
+            else:
+                sys.modules[modname] = old
+            raise
         return module
 
     def _add_to_rulesdb(self, script_class, botvars):
         """Given a subclass of Script, create an instance of it.  If it's
         topic is set to None, ignore it, otherwise search its
         attributes for methods that begin with "rule" or "substitute"
-        and add those to the topic database.
+        and add those, and its substitutions dictionary if it has one, to
+        the topic database. Return the number of rules found.
+        """
+        instance = self._new_script_instance(script_class, botvars)
+        if instance is None:
+            return 0
+        return self._add_script_instance(instance)
 
+    def _new_script_instance(self, script_class, botvars):
+        """ Given a subclass of Script, create an instance of it and set
+        it up, unless its topic is None, in which case return None.
         """
         instance = script_class()
-        topic = instance.topic
-        if topic is None:  # this is the way to define a script superclass
-            return
-        if topic not in self.topics:
-            self._new_topic(topic)
-
+        if instance.topic is None:  # the way to define a script superclass
+            return None
         instance.botvars = botvars
         instance.setup()
+        return instance
+
+    def _add_script_instance(self, instance, made=None, methods=None):
+        """ Add the rules, substitute methods and substitutions dictionary
+        of a set up Script instance to the database for its topic. made and
+        methods are passed on to _load_script_methods.
+        """
         self.script_instances.append(instance)
+        rules, substitutions = self._load_script_methods(instance, made,
+                                                         methods)
+        self._add_to_topic(self.topics, instance, rules, substitutions)
+        self._loaded.append((self._module_files.get(instance.__module__),
+                             instance, rules, substitutions))
+        return len(rules)
 
-        rules, substitutions = self._load_script_methods(instance)
-        self.topics[topic].add_rules(rules)
-        self.topics[topic].add_substitutions(substitutions)
+    def _add_to_topic(self, topics, instance, rules, substitutions):
+        """ Add the rules and substitute methods loaded from a Script
+        instance, and its substitutions dictionary if it has one, to its
+        topic in a dictionary of Topics, making the topic if it isn't there.
+        """
+        if instance.topic not in topics:
+            topics[instance.topic] = self._new_topic()
+        topic = topics[instance.topic]
+        if isinstance(rules, LazyRules):
+            topic.add_lazy_rules(rules)
+        else:
+            topic.add_rules(rules)
+        topic.add_substitutions(substitutions)
+        if getattr(instance, "substitutions", None):
+            self._load_substitution_table(instance, topic)
 
-    def _load_script_methods(self, instance):
+    def _load_script_methods(self, instance, made=None, methods=None):
         """Given an instance of a subclass of Script, find all of its methods
         which begin with one of our keywords and add them to the rules
         database for the topic of the script instance.
 
-        If the instance defines an alternates dictionary, substitute
-        those into the patterns of the rules.
+        made, if given, is a dictionary of Patterns (or the exceptions
+        raised making them) from _make_patterns, to use instead of making
+        new ones. methods, if given, is what _script_methods returned for
+        the instance, so that its methods and alternates aren't looked at
+        again.
 
+        Return a tuple of the list of Rules, or in lazy mode, a LazyRules
+        which will make them, and a list of substitute methods.
+        """
+        make_pattern = self._pattern_maker(instance, made)
+        if methods is None:
+            methods = self._script_methods(instance, make_pattern)
+        rule_args, substitutes = methods
+        make_rules = functools.partial(self._make_rules, rule_args,
+                                       make_pattern)
+        if self._lazy:
+            return LazyRules(make_rules, len(rule_args)), substitutes
+        return make_rules(), substitutes
+
+    def _pattern_maker(self, instance, made=None):
+        """ Return the function to call in place of Pattern to make the
+        patterns of a Script instance, which looks them up in made, a
+        dictionary from _make_patterns, if given, and in the rule cache, if
+        there is one.
+        """
+        make_pattern = Pattern
+        if made is not None:
+            make_pattern = functools.partial(_premade_pattern, made)
+        if self.rule_cache is not None and not self._lazy:
+            module_name = instance.__module__[len(_PREFIX):]
+            make_pattern = functools.partial(self.rule_cache.pattern,
+                                             module_name, make=make_pattern)
+        return make_pattern
+
+    def _script_methods(self, instance, make_pattern):
+        """ Find the rule and substitute methods of an instance of a Script
+        subclass. If the instance defines an alternates dictionary, parse
+        it, using make_pattern in place of Pattern, to substitute into the
+        patterns of the rules. Return a tuple of a list of tuples of
+        arguments for Rule from _rule_args, and a list of substitute
+        methods.
         """
         script_class_name = (instance.__module__[len(_PREFIX):] + "." +
                              instance.__class__.__name__)
         alternates = {}
         if hasattr(instance, "alternates"):
             alternates = self._parse_alternates(instance.alternates,
-                                                script_class_name)
-        rules = []
+                                                script_class_name,
+                                                make_pattern)
+        rule_args = []
         substitutes = []
         for attribute in dir(instance):
             if attribute.startswith('rule'):
-                rule = self._load_rule(script_class_name, instance,
-                                       attribute, alternates)
-                rules.append(rule)
+                rule_args.append(self._rule_args(script_class_name, instance,
+                                                 attribute, alternates))
             elif attribute.startswith('substitute'):
                 sub = self._load_substitution(script_class_name,
                                               instance, attribute)
                 substitutes.append(sub)
-        return rules, substitutes
+        return rule_args, substitutes
+
+    def _make_rules(self, rule_args, make_pattern):
+        """ Return a list of Rules made from a list of tuples of arguments
+        from _rule_args, using make_pattern to make their Patterns.
+        """
+        return [Rule(*args, atomic=self._atomic, make_pattern=make_pattern)
+                for args in rule_args]
 
-    def _parse_alternates(self, alternates, script_class_name):
+    def _make_patterns(self, instances, processes):
+        """ Parse the patterns used by the rules of a list of tuples of
+        Script instances and what _script_methods returned for them, except
+        for those found in the rule cache, in a multiprocessing.Pool of
+        processes processes. Return a dictionary of their pattern_keys and
+        the Patterns, or for patterns which couldn't be parsed, the
+        exceptions raised trying.
+        """
+        args = collections.OrderedDict()
+        for instance, (rule_args, substitutes) in instances:
+            module_name = instance.__module__[len(_PREFIX):]
+            for rule in rule_args:
+                raw_pattern, raw_previous, weight, alternates = rule[:4]
+                for raw in [raw_pattern, raw_previous]:
+                    if (self.rule_cache is not None and
+                            self.rule_cache.has(module_name, raw, alternates,
+                                                atomic=self._atomic)):
+                        continue
+                    key = pattern_key(raw, alternates, atomic=self._atomic)
+                    args[key] = (raw, alternates, self._atomic)
+        keys = list(args)
+        if not keys:
+            return {}
+        log.debug("Parsing {0} patterns in {1} processes".format(
+            len(keys), processes))
+        try:
+            context = multiprocessing.get_context("fork")
+        except (AttributeError, ValueError):  # Python 2, or no fork
+            context = multiprocessing
+        pool = context.Pool(processes)
+        try:
+            chunksize = max(1, len(keys) // (processes * 4))
+            patterns = pool.map(_make_pattern, [args[k] for k in keys],
+                                chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+        return dict(zip(keys, patterns))
+
+    def _load_substitution_table(self, instance, topic):
+        """ Check that the substitutions dictionary of an instance of a
+        Script subclass maps strings to strings, and add it to the topic's
+        substitution table, along with its substitutions_strip characters.
+        """
+        name = (instance.__module__[len(_PREFIX):] + "." +
+                instance.__class__.__name__)
+        substitutions = instance.substitutions
+        strip = getattr(instance, "substitutions_strip", "") or ""
+        try:
+            if not isinstance(strip, string_types):
+                raise TypeError("substitutions_strip must be a string")
+            strip = text_type(strip)
+            for k, v in substitutions.items():
+                if (not isinstance(k, text_type) or
+                        not isinstance(v, text_type)):
+                    raise TypeError('"{0}": "{1}" is not a pair of '
+                                    'strings'.format(k, v))
+        except Exception as e:
+            msg = " in substitutions of {0}".format(name)
+            e.args = (e.args[0] + msg,) + e.args[1:]
+            raise
+        topic.add_substitution_table(name, substitutions, strip)
+
+    def _parse_alternates(self, alternates, script_class_name,
+                          make_pattern=Pattern):
         """Construct Pattern objects for all the values in the alternates
         instance variable (hopefully a dictionary) of a Script
         subclass, and construct a dictionary of the keys from
         alternates and the pattern object. Wrap that in another
         dictionary keyed by 'a' so it can be used by %a:varname in
-        other patterns.
+        other patterns. make_pattern is called in place of Pattern.
 
         """
         valid = {}
         k = ""
         try:
             for k, v in alternates.items():
-                valid[k] = Pattern(v, simple=True).formatted_pattern
+                valid[k] = make_pattern(v, simple=True).formatted_pattern
         except Exception as e:
             msg = " in alternates"
             if k:
@@ -164,11 +775,12 @@ class RulesDB(object):
             raise
         return {"a": valid}
 
-    def _load_rule(self, script_class_name, instance, attribute,
+    def _rule_args(self, script_class_name, instance, attribute,
                    alternates):
         """ Given an instance of a class derived from Script and
         a callable attribute, check that it is declared correctly,
-        and then construct and return a Rule object.
+        and then return a tuple of the arguments to construct a Rule
+        object for it.
         """
         method = getattr(instance, attribute)
         rulename = script_class_name + "." + attribute
@@ -176,8 +788,8 @@ class RulesDB(object):
         argspec = get_rule_method_spec(rulename, method)
 
         raw_pattern, raw_previous, weight = argspec.defaults
-        return Rule(raw_pattern, raw_previous, weight, alternates,
-                    method, rulename)
+        return (raw_pattern, raw_previous, weight, alternates,
+                method, rulename)
 
     def _load_substitution(self, script_class_name, instance, attribute):
         """ Given an instance of a class derived from Script and
@@ -247,6 +859,118 @@ def check_substitution_method_spec(name, method):
     return argspec
 
 
+def _file_state(filename, old=None):
+    """ Return a tuple of the modification time and size of a file, and
+    a hash of its contents. If old, an earlier result for the same file,
+    has the same time and size, return that instead of reading the file.
+    """
+    info = os.stat(filename)
+    stat = (info.st_mtime, info.st_size)
+    if old is not None and old[0] == stat:
+        return old
+    with open(filename, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return stat, digest
+
+
+def _script_key(instance):
+    """ Return a tuple of the module and class names of a Script instance,
+    which stay the same when its file is reloaded.
+    """
+    return instance.__module__, instance.__class__.__name__
+
+
+def _bundle_version():
+    """ Return a string which changes when bundles saved by one version
+    of chatbot_reply or Python can't be used by another.
+    """
+    import chatbot_reply
+    return "{0} {1} {2} {3}".format(chatbot_reply.__version__,
+                                    _BUNDLE_FORMAT, pattern_source_digest(),
+                                    sys.version)
+
+
+def _make_pattern(args):
+    """ Make a Pattern in a worker process of RulesDB._make_patterns,
+    returning any exception instead of raising it, so that the Rule which
+    uses the pattern can add its name to the error message.
+    """
+    raw, alternates, atomic = args
+    try:
+        return Pattern(raw, alternates, atomic=atomic)
+    except Exception as e:
+        return e
+
+
+def _premade_pattern(made, raw, alternates=None, simple=False, atomic=False):
+    """ Look up the Pattern for the rest of the arguments in made, the
+    result of RulesDB._make_patterns, and return it, or raise a copy of the
+    exception found instead. If it's not there, make a new one.
+    """
+    pattern = made.get(pattern_key(raw, alternates, simple, atomic))
+    if pattern is None:
+        return Pattern(raw, alternates, simple=simple, atomic=atomic)
+    if isinstance(pattern, Exception):
+        raise copy.copy(pattern)
+    return pattern
+
+
+class LoadReport(object):
+    """ How long RulesDB.load_script_directory spent on each script file,
+    to help find the ones which make loading slow.
+
+    Public instance variables:
+    files - an OrderedDict of the paths of the files in the order they
+        were imported, and lists of three numbers: seconds spent importing
+        the file, seconds spent setting up its Script subclasses and
+        making their rules, and the number of rules
+    pool_seconds - seconds spent parsing patterns in a process pool, if
+        one was used, which aren't counted against any file
+
+    Public methods:
+    add - add some time to a file
+    slowest - return the files which took the most time
+    format - return a table of the slowest files as a string
+    """
+    def __init__(self):
+        self.files = collections.OrderedDict()
+        self.pool_seconds = 0
+
+    def add(self, filename, import_seconds=0, rules_seconds=0,
+            rule_count=0):
+        """ Add time and rules to a file. Scripts that don't come from a
+        file loaded by load_script_directory are counted against None.
+        """
+        times = self.files.setdefault(filename, [0, 0, 0])
+        times[0] += import_seconds
+        times[1] += rules_seconds
+        times[2] += rule_count
+
+    def slowest(self, count=None):
+        """ Return a list of tuples of the total seconds and the filename
+        of the count slowest files, or of all of them, slowest first.
+        """
+        totals = sorted(((times[0] + times[1], filename)
+                         for filename, times in self.files.items()),
+                        key=lambda total: -total[0])
+        return totals[:count]
+
+    def format(self, count=None):
+        """ Return a table of the times of the count slowest files, or of
+        all of them, as a string.
+        """
+        lines = ["{0:>10} {1:>10} {2:>6}  {3}".format(
+            "import ms", "rules ms", "rules", "file")]
+        for total, filename in self.slowest(count):
+            times = self.files[filename]
+            lines.append("{0:>10.1f} {1:>10.1f} {2:>6}  {3}".format(
+                times[0] * 1e3, times[1] * 1e3, times[2], filename))
+        if self.pool_seconds:
+            lines.append("{0:>10} {1:>10.1f} {2:>6}  {3}".format(
+                "", self.pool_seconds * 1e3, "", "(process pool)"))
+        return "\n".join(lines)
+
+
 class Topic(object):
     """ Topic object. Stores Rule objects and references to substitution
     methods for each topic.
@@ -257,13 +981,85 @@ class Topic(object):
                 in reverse sorted order by score
         substitutions : List of substitution methods, in no particular
                 order. RulesDB puts tuples in here, (name, method)
+        substitution_table : SubstitutionTable combining the substitutions
+                dictionaries of the scripts in this topic, or None if
+                they don't have any
+        ascii : True if the patterns use regular expressions compiled
+                with re.ASCII for ASCII targets, see set_ascii
+    Public methods:
+        match : given a Target and reply history, return the first rule
+                in sortedrules which matches them and its Match object
+        candidate_rules : given a Target, yield the rules which might match
+                it, in the same order as sortedrules
+        pattern_count : return the number of different patterns used by
+                the rules
+        is_ascii : return True if all the patterns are ASCII
+        set_ascii : switch the topic to or from ASCII mode
+        add_lazy_rules : add rules to be made when the topic is built
+        build : make and sort the rules added by add_lazy_rules
+        compile_regexes : compile the regular expressions of all the
+                patterns now instead of when they are first matched
+        rule_count : return the number of rules, including unbuilt ones
     """
-    def __init__(self):
-        """ Create a new empty Topic object. """
+    def __init__(self, matcher="index", exact_limit=64):
+        """ Create a new empty Topic object.
+
+        Keyword arguments:
+        matcher -- how to find the rules that might match a target:
+            "index" -- look up the words in the target in an index of the
+                words each pattern requires
+            "trie" -- walk the words of the target through a PatternTrie
+                built from all the patterns (see trie.py)
+            "regex" -- match the target against combined regular expressions
+                built from all the patterns (see dispatch.py)
+        exact_limit -- patterns which can match no more than this many
+            different strings are looked up in a dictionary of those strings
+            instead. Set it to 0 to turn that off.
+        """
+        if matcher not in ("index", "trie", "regex"):
+            raise ValueError("Unknown matcher {0}".format(matcher))
         self.rules = {}
         self.rules_are_sorted = True
         self.sortedrules = []
         self.substitutions = []
+        self.substitution_table = None
+        self.ascii = False
+        self._word_index = {}
+        self._unindexed = []
+        self._matcher = matcher
+        self._trie = None
+        self._not_in_trie = []
+        self._dispatcher = None
+        self._dispatched = set()
+        self._exact_limit = exact_limit
+        self._exact = {}
+        self._exact_rules = set()
+        self._min_words = []
+        self._max_words = []
+        self._previous_index = {}
+        self._patterns = {}
+        self._lazy_rules = []
+        self._build_lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Pickle a built topic, for RulesDB.save_bundle. The methods of
+        the substitutions are left out (RulesDB.load_bundle puts them back),
+        and so are the regular expression match objects in the exact table,
+        so Rule.match will match those rules' patterns again.
+        """
+        if self._lazy_rules:
+            raise ValueError("Topics must be built before they are pickled")
+        state = self.__dict__.copy()
+        del state["_build_lock"]
+        state["substitutions"] = [(name, None)
+                                  for name, method in self.substitutions]
+        state["_exact"] = dict((key, [(i, None) for i, m in matches])
+                               for key, matches in self._exact.items())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lock = threading.Lock()
 
     def add_rules(self, rules):
         """ Add rules from a list to the rule dictionary. If there is already
@@ -281,22 +1077,309 @@ class Topic(object):
                             "{1} ".format(
                                 rule.rulename, existing_rule.rulename))
             else:
+                rule.pattern = self._intern(rule.pattern)
+                if rule.previous:
+                    rule.previous = self._intern(rule.previous)
                 self.rules[tup] = rule
                 log.debug('Loaded pattern "{0[0]}", previous="{0[1]}", '
                           'weight={1}, method={2}'.format(tup, rule.weight,
                                                           rule.rulename))
 
+    def _intern(self, pattern):
+        """ Return the Pattern already in this topic that matches the same
+        strings as pattern, or if there isn't one, remember and return
+        pattern. This lets rules share compiled regular expressions, and
+        lets Topic.match remember match results by Pattern.
+        """
+        return self._patterns.setdefault(pattern.match_key, pattern)
+
+    def pattern_count(self):
+        """ Return the number of different Pattern objects used by the rules
+        in this topic, counting both patterns and previous reply patterns.
+        """
+        return len(self._patterns)
+
+    def is_ascii(self):
+        """ Return True if the patterns of all the rules in this topic,
+        and the values of the alternates they use, are all ASCII.
+        """
+        return all(part is None or part.isascii()
+                   for key in self._patterns for part in key)
+
+    def set_ascii(self, ascii):
+        """ Switch all the patterns in this topic to or from regular
+        expressions compiled with re.ASCII (see Pattern.set_ascii). Targets
+        for this topic can then be normalized in ASCII mode too.
+        """
+        self.ascii = bool(ascii and _ASCII_FLAG is not None)
+        for pattern in self._patterns.values():
+            pattern.set_ascii(self.ascii)
+
     def add_substitutions(self, substitutions):
         """ Add substitution methods to the substitutions list """
         self.substitutions.extend(substitutions)
 
+    def add_substitution_table(self, name, substitutions, strip=""):
+        """ Add a dictionary of words and their replacements to the
+        substitution table, making it if this is the first one.
+        """
+        if self.substitution_table is None:
+            self.substitution_table = SubstitutionTable()
+        self.substitution_table.add(name, substitutions, strip)
+
+    def add_lazy_rules(self, lazy_rules):
+        """ Add a LazyRules, whose rules will be added to the topic when
+        it is built instead of now.
+        """
+        self._lazy_rules.append(lazy_rules)
+
+    def rule_count(self):
+        """ Return the number of rules in this topic, counting the ones
+        which haven't been made yet and any duplicates among them.
+        """
+        return len(self.rules) + sum(len(lr) for lr in self._lazy_rules)
+
+    def build(self):
+        """ Make the rules added by add_lazy_rules, add them and sort
+        them, and if the topic was in ASCII mode before it had any patterns,
+        check whether it still should be. This may be called from more than
+        one thread at once; the rules are only made once, and the others
+        wait for them. Until it is built, sort_rules does nothing, and match
+        and candidate_rules build the topic first.
+        """
+        if not self._lazy_rules:
+            return
+        with self._build_lock:
+            if not self._lazy_rules:
+                return
+            self.add_rules([rule for lazy_rules in self._lazy_rules
+                            for rule in lazy_rules()])
+            self._sort_rules()
+            if self.ascii:
+                self.set_ascii(self.is_ascii())
+            self._lazy_rules = []
+
+    def compile_regexes(self):
+        """ Compile the regular expressions of all the patterns in this
+        topic, which are otherwise compiled when they are first matched.
+        """
+        for pattern in self._patterns.values():
+            pattern.compile_regexes()
+
     def sort_rules(self):
-        """ If sorted_rules is out of date, update it. """
-        if self.rules_are_sorted:
+        """ If sorted_rules is out of date, update it. Like build, this
+        may be called from more than one thread at once.
+        """
+        if self.rules_are_sorted or self._lazy_rules:
             return
+        with self._build_lock:
+            if not self.rules_are_sorted:
+                self._sort_rules()
+
+    def _sort_rules(self):
         self.sortedrules = sorted(self.rules.values(), reverse=True)
+        self._build_exact_table()
+        self._index_word_counts()
+        self._index_required_words()
+        self._index_previous_patterns()
+        if self._matcher == "trie":
+            self._build_trie()
+        elif self._matcher == "regex":
+            self._build_dispatcher()
         self.rules_are_sorted = True
 
+    def _build_exact_table(self):
+        """ Expand every pattern which can only match a few different
+        strings (no more than exact_limit) into all of them, and build a
+        dictionary from those strings to the positions in sortedrules of
+        the rules which match them, along with the regular expression
+        match object, so the match dictionary can be built without running
+        the regular expression again.
+        """
+        self._exact = {}
+        self._exact_rules = set()
+        if not self._exact_limit:
+            return
+        for i, rule in enumerate(self.sortedrules):
+            expanded = rule.pattern.expansions(self._exact_limit)
+            if expanded is None or rule.pattern.regexc is None:
+                continue
+            matches = [rule.pattern.regexc.match(key) for key in expanded]
+            if None in matches:
+                continue
+            for key, m in zip(expanded, matches):
+                self._exact.setdefault(key, []).append((i, m))
+            self._exact_rules.add(i)
+
+    def _index_word_counts(self):
+        """ Make lists of the fewest and the most words a target can have
+        for the pattern of each rule in sortedrules to match it, with None
+        for patterns which can match any number of words.
+        """
+        self._min_words = [rule.pattern.min_words
+                           for rule in self.sortedrules]
+        self._max_words = [rule.pattern.max_words
+                           for rule in self.sortedrules]
+
+    def _fits_word_count(self, i, count):
+        """ Return True if the pattern of the rule at position i in
+        sortedrules can match a target of count words.
+        """
+        maximum = self._max_words[i]
+        return (self._min_words[i] <= count and
+                (maximum is None or count <= maximum))
+
+    def _build_trie(self):
+        """ Build a PatternTrie from the patterns in sortedrules, which
+        will give back their positions in sortedrules when they match.
+        Patterns that can't go in the trie are kept in a list, to be
+        checked for every target. Patterns in the exact table are left out.
+        """
+        self._trie = PatternTrie()
+        self._not_in_trie = []
+        for i, rule in enumerate(self.sortedrules):
+            if i in self._exact_rules:
+                continue
+            if not rule.pattern.add_to_trie(self._trie, i):
+                self._not_in_trie.append(i)
+
+    def _build_dispatcher(self):
+        """ Build a PatternDispatcher from the patterns of the rules which
+        have compiled regular expressions, no previous reply patterns, and
+        aren't in the exact table, which will give back the position in
+        sortedrules of the first one that matches.
+        """
+        regexes = []
+        self._dispatched = set()
+        for i, rule in enumerate(self.sortedrules):
+            if (rule.pattern.regexc is not None and not rule.previous and
+                    i not in self._exact_rules):
+                regexes.append(rule.pattern.regexc.pattern)
+                self._dispatched.add(i)
+        self._dispatcher = PatternDispatcher(regexes, sorted(self._dispatched))
+
+    def _index_required_words(self):
+        """ Build an inverted index from words to the positions in sortedrules
+        of the rules whose patterns can't match without them. Each rule is
+        filed under the words of just one of its requirements, preferring
+        small sets of long (and so hopefully uncommon) words. Rules which
+        don't require any words go in the unindexed list.
+        """
+        self._word_index = {}
+        self._unindexed = []
+        for i, rule in enumerate(self.sortedrules):
+            required = rule.pattern.required_words
+            if not required:
+                self._unindexed.append(i)
+                continue
+            key = min(required, key=lambda words: (
+                len(words), -min(len(w) for w in words)))
+            for word in key:
+                self._word_index.setdefault(word, []).append(i)
+
+    def _index_previous_patterns(self):
+        """ Build a dictionary from the match_keys of the previous reply
+        patterns used in this topic to the positions in sortedrules of the
+        rules which use them.
+        """
+        self._previous_index = {}
+        for i, rule in enumerate(self.sortedrules):
+            if rule.previous:
+                self._previous_index.setdefault(rule.previous.match_key,
+                                                set()).add(i)
+
+    def match(self, target, history, variables):
+        """ Find the first rule in sortedrules which matches the target and
+        history. Return a tuple of the rule and its Match object, or
+        (None, None) if nothing matches. Arguments are as for Rule.match.
+
+        Each different pattern is only matched once against the target and
+        each different previous reply pattern once against the previous
+        reply. When a previous reply pattern fails, all the rules which use
+        it are skipped.
+        """
+        if self._lazy_rules:
+            self.build()
+        memo = {}
+        skipped = set()
+        for i, pattern_match in self._candidates(target):
+            if i in skipped:
+                continue
+            rule = self.sortedrules[i]
+            m = rule.match(target, history, variables, pattern_match, memo)
+            if m is not None:
+                return rule, m
+            if (rule.previous and history and
+                    memo.get((rule.previous, history[0].normalized),
+                             True) is None):
+                skipped.update(
+                    self._previous_index[rule.previous.match_key])
+        return None, None
+
+    def candidate_rules(self, target):
+        """ Generate the rules from sortedrules which could possibly match
+        the target, in sorted order.
+        """
+        if self._lazy_rules:
+            self.build()
+        for i, pattern_match in self._candidates(target):
+            yield self.sortedrules[i]
+
+    def _candidates(self, target):
+        """ Generate tuples of positions in sortedrules of the rules which
+        could possibly match the target, in sorted order, and a regular
+        expression match object for the rule's pattern, or None if
+        the pattern has not been matched yet.
+
+        Rules with patterns in the exact table are found by looking up
+        target.normalized. Of the rest, those whose patterns contain words
+        which are missing from target.normalized are skipped. If this topic
+        was created with matcher="trie", the candidates are instead the rules
+        whose patterns the trie found to match, plus any which weren't
+        added to the trie. With matcher="regex", only the first rule found
+        by the dispatcher is a candidate, along with any rules ahead of it
+        that weren't given to the dispatcher. Either way, rules whose
+        patterns need more or fewer words than there are in the target
+        are skipped.
+
+        The exact table and the trie work on words, so they can't tell
+        that patterns would match differently when there are empty words
+        in the target. In that case, only the required words are used.
+        """
+        words = target.normalized.split()
+        regular = (" ".join(words) == target.normalized)
+        exact = {}
+        if regular:
+            exact = dict(self._exact.get(target.normalized, ()))
+
+        count = len(words)
+        fits = self._fits_word_count
+        if regular and self._trie is not None:
+            positions = self._trie.match(words)
+            positions.update(i for i in self._not_in_trie if fits(i, count))
+        else:
+            words = set(words)
+            positions = set(self._unindexed)
+            for word in words:
+                positions.update(self._word_index.get(word, ()))
+            positions = set(i for i in positions if fits(i, count))
+            if regular:
+                positions.difference_update(self._exact_rules)
+            if self._dispatcher is not None:
+                positions.difference_update(self._dispatched)
+                first = self._dispatcher.match(target.normalized)
+                if first is not None:
+                    positions = set(i for i in positions if i < first)
+                    positions.add(first)
+            positions = set(
+                i for i in positions
+                if all(not required.isdisjoint(words) for required in
+                       self.sortedrules[i].pattern.required_words))
+
+        positions.update(exact)
+        for i in sorted(positions):
+            yield i, exact.get(i)
+
     def log_sorted_rules(self):
         """ Print sorted rules to logging output """
         for r in self.sortedrules:
@@ -327,7 +1410,7 @@ class Rule(object):
             score of the two patterns
     """
     def __init__(self, raw_pattern, raw_previous, weight, alternates,
-                 method, rulename):
+                 method, rulename, atomic=False, make_pattern=Pattern):
         """ Create a new Rule object based on information supplied to the
         @rule decorator. Arguments:
         raw_pattern - simplified regular expression string supplied to @rule
@@ -338,6 +1421,10 @@ class Rule(object):
         method - reference to method decorated by @rule
         rulename - modulename.classname.methodname, used to make better
                  error messages
+        atomic - if True, generate regular expressions which don't
+                 backtrack (see patterns.py)
+        make_pattern - called with the same arguments as Pattern to make
+                 the Pattern objects, such as RuleCache.pattern
 
         Raises PatternError, PatternVariableNotFoundError,
                PatternVariableValueError
@@ -346,9 +1433,11 @@ class Rule(object):
             previous = ""
             if not raw_pattern:
                 raise PatternError("Empty string found")
-            self.pattern = Pattern(raw_pattern, alternates)
+            self.pattern = make_pattern(raw_pattern, alternates,
+                                        atomic=atomic)
             previous = "previous "
-            self.previous = Pattern(raw_previous, alternates)
+            self.previous = make_pattern(raw_previous, alternates,
+                                         atomic=atomic)
         except (TypeError, PatternError, PatternVariableValueError,
                 PatternVariableNotFoundError) as e:
             msg = " in {0}pattern of {1}".format(previous, rulename)
@@ -359,7 +1448,16 @@ class Rule(object):
         self.method = method
         self.rulename = rulename
 
-    def match(self, target, history, variables):
+    def __getstate__(self):
+        """ Pickle everything but the method, which RulesDB.load_bundle
+        finds again by rulename.
+        """
+        state = self.__dict__.copy()
+        state["method"] = None
+        return state
+
+    def match(self, target, history, variables, pattern_match=None,
+              memo=None):
         """ Return a Match object if the targets match the patterns
         for this rule, or None if they don't.
         Arguments:
@@ -368,22 +1466,49 @@ class Rule(object):
                       replies
             variables - User and Bot variables for the PatternParser
                       to substitute into the patterns
+            pattern_match - if the caller already has the regular expression
+                      match of this rule's pattern with target.normalized,
+                      it may be passed in here to save matching it again
+            memo - a dictionary used to remember the results of matching
+                      Pattern objects against strings, keyed by tuples of
+                      the Pattern and the string, so rules which share
+                      patterns only match them once. It should only be
+                      shared between calls with the same variables.
+
+        The previous reply pattern is checked first, because when rules
+        share previous patterns its result is likely to be remembered.
         """
-        m = self.pattern.match(target.normalized, variables)
-        if m is None:
-            return None
         mp = None
         reply_target = None
-
         if self.previous:
             if not history:
                 return None
             reply_target = history[0]
-            mp = self.previous.match(reply_target.normalized, variables)
+            mp = self._match_pattern(self.previous, reply_target.normalized,
+                                     variables, memo)
             if mp is None:
                 return None
+
+        m = pattern_match
+        if m is None:
+            m = self._match_pattern(self.pattern, target.normalized,
+                                    variables, memo)
+        if m is None:
+            return None
         return Match(m, mp, target, reply_target)
 
+    def _match_pattern(self, pattern, string, variables, memo):
+        """ Match a Pattern against a string, first looking for the result
+        in memo if it isn't None, and saving it there if it wasn't found.
+        """
+        if memo is None:
+            return pattern.match(string, variables)
+        key = (pattern, string)
+        if key in memo:
+            return memo[key]
+        m = memo[key] = pattern.match(string, variables)
+        return m
+
     def __lt__(self, other):
         """ Full set of comparison operators. The weight passed to @rule
         is the most significant, followed by the complexity of the pattern
@@ -414,13 +1539,32 @@ class Rule(object):
         return not self == other
 
 
+class LazyRules(object):
+    """ The Rules of one Script instance, made the first time they are
+    asked for, for topics which aren't built until they are needed. Calling
+    it returns the list of Rules, and len gives the number there will be.
+    """
+    def __init__(self, make_rules, count):
+        self._make_rules = make_rules
+        self._count = count
+        self._rules = None
+
+    def __call__(self):
+        if self._rules is None:
+            self._rules = self._make_rules()
+        return self._rules
+
+    def __len__(self):
+        return self._count
+
+
 class Match(object):
     """ For a match between the two patterns of a @rule and a user message
     and previous reply, construct a dictionary of values for the parts of the
     match the @rule wanted to use.
 
     Public instance variable:
-        dict -- dictionary of matched text
+        dict -- a MatchDict of matched text
 
     The dictionary keys will be:
     match0..matchN         -- memorized matches in the tokenized text of
@@ -439,33 +1583,103 @@ class Match(object):
         with keys match0, match1, ... matchN, as well as the Target objects
         they were matched to.
         """
-        self.dict = {}
-        self._add_matches(m_pattern, target, "")
+        self.dict = MatchDict()
+        self.dict.add_matches(m_pattern, target, "")
         if m_previous is not None:
-            self._add_matches(m_previous, previous_target, "reply_")
-
-    def _add_matches(self, m, target, prefix):
-        """ Prefix all keys from m.groupdict() with the prefix argument, and
-        add them to self.dict. Then use the fact that the tokenized_words and
-        raw_words lists in target are the same length to find the chunk of raw
-        text that each match corresponds to, and add those to the dictionary
-        with "raw_" prefixed to their keys.
+            self.dict.add_matches(m_previous, previous_target, "reply_")
+
+
+class MatchDict(MutableMapping):
+    """ A dictionary of the text matched by memorized parts of patterns,
+    with the keys described in Match. The values are only looked up in
+    the regular expression match objects, and the raw text only pieced
+    together from the Target's raw words, when a key is first read, since
+    most rules never use most of them. It works like a dictionary, and can
+    be passed to str.format with **.
+
+    Public method:
+        add_matches - add the keys for a regular expression match object
+    """
+    def __init__(self):
+        self._values = {}
+        self._sources = []  # tuples of (prefix, match object, Target)
+
+    def add_matches(self, m, target, prefix):
+        """ Add the keys from m.groupdict() with the prefix argument, and
+        the same keys with "raw_" in front of the prefix.
         Arguments:
             m - a match object from a re function
             target - a Target object
             prefix - a prefix string to add to key names
+        """
+        self._sources.append((prefix, m, target))
 
+    def _find(self, key):
+        """ Return a tuple of the match object, group name and Target for
+        a key, plus True if it is a raw_ key, or None if there is no such key.
         """
-        offsets = []
-        offset = 0
-        for wl in target.tokenized_words:
-            offsets.append(offset)
-            offset += len(" ".join(wl)) + 1
+        if not isinstance(key, string_types):
+            return None
+        for prefix, m, target in self._sources:
+            for raw, start in ((False, prefix), (True, "raw_" + prefix)):
+                if (key.startswith(start) and
+                        key[len(start):] in m.re.groupindex):
+                    return m, key[len(start):], target, raw
+        return None
+
+    def _lookup(self, m, name, target, raw):
+        """ Return the value for a group in a match object. For a raw_ key,
+        use the fact that the tokenized_words and raw_words lists in target
+        are the same length, and the offsets of the tokenized words recorded
+        by the target, to find the chunk of raw text that the group matched.
+        """
+        if not raw:
+            return m.group(name)
+        start, end = m.span(name)
+        i_start = bisect.bisect_left(target.offsets, start)
+        i_end = bisect.bisect(target.offsets, end)
+        return " ".join(target.raw_words[i_start:i_end])
+
+    def _materialize(self):
+        """ Look up all the values, so the dictionary can be changed """
+        for key in list(self):
+            self[key]
+        self._sources = []
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            found = self._find(key)
+            if found is None:
+                raise
+        value = self._values[key] = self._lookup(*found)
+        return value
+
+    def __setitem__(self, key, value):
+        self._materialize()
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        self._materialize()
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or self._find(key) is not None
+
+    def __iter__(self):
+        if not self._sources:
+            return iter(self._values)
+        return (start + name
+                for prefix, m, target in self._sources
+                for start in (prefix, "raw_" + prefix)
+                for name in m.re.groupindex)
+
+    def __len__(self):
+        if not self._sources:
+            return len(self._values)
+        return sum(2 * len(m.re.groupindex)
+                   for prefix, m, target in self._sources)
 
-        for k, v in m.groupdict().items():
-            self.dict[prefix + k] = v
-            start, end = m.span(k)
-            i_start = bisect.bisect_left(offsets, start)
-            i_end = bisect.bisect(offsets, end)
-            self.dict["raw_" + prefix + k] = " ".join(target.raw_words[i_start:
-                                                                       i_end])
+    def __repr__(self):
+        return "MatchDict({0!r})".format(dict(self))
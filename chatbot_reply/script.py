@@ -8,10 +8,13 @@
 from __future__ import unicode_literals
 import collections
 from functools import wraps
+import itertools
+import operator
 import random
 import re
+import threading
 
-from chatbot_reply.six import with_metaclass
+from chatbot_reply.six import text_type, with_metaclass
 from chatbot_reply.constants import _HISTORY, _PREFIX
 
 
@@ -95,6 +98,19 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         Changing self.alternates after import will have no effect on pattern
         matching.
 
+    substitutions - a dictionary of words and the text to put in their
+        place in messages in this topic, such as {"don't": "do not"}. Like
+        alternates, it may be a class attribute or be set by setup. Words
+        are lower cased before they are looked up, so the keys should be
+        too. All the substitutions dictionaries in a topic are combined
+        into one lookup table, which is a lot faster than doing the same
+        thing in a substitute method, and is used before any substitute
+        methods are called.
+
+    substitutions_strip - a string of characters, such as
+        string.punctuation, to remove from the end of words before looking
+        them up in substitutions. Words with no entry are left as they were.
+
     substitute(self, text, list_of_lists) - Any method name defined by a
         subclass that begins with substitute will be called with the raw text
         of every message (within its topic) and a list of list of words that
@@ -134,6 +150,13 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         the matched user input (and previous reply, if applicable) and the
         rule's patterns
 
+    userinfo, uservars and match come from the ReplyContext of the reply
+    being made in the current thread, so one instance can serve replies
+    to different users in different threads at once.
+    Anything else a script keeps in its own instance variables while
+    replying is shared by all of them, so per-user state belongs in
+    uservars.
+
     Public instance variable, ok to change in child classes:
 
     current_topic - string giving current conversation topic, which
@@ -145,8 +168,38 @@ class Script(with_metaclass(ScriptRegistrar, object)):
 
     def __init__(self):
         self.botvars = None
-        self.userinfo = None
-        self.match = None
+        self._userinfo = None
+        self._match = None
+
+    def ui_get(self):
+        context = current_context()
+        if context is None:
+            return self._userinfo
+        return context.userinfo
+
+    def ui_set(self, userinfo):
+        context = current_context()
+        if context is None:
+            self._userinfo = userinfo
+        else:
+            context.userinfo = userinfo
+
+    userinfo = property(ui_get, ui_set)
+
+    def m_get(self):
+        context = current_context()
+        if context is None:
+            return self._match
+        return context.match
+
+    def m_set(self, match):
+        context = current_context()
+        if context is None:
+            self._match = match
+        else:
+            context.match = match
+
+    match = property(m_get, m_set)
 
     @property
     def uservars(self):
@@ -202,8 +255,14 @@ class Script(with_metaclass(ScriptRegistrar, object)):
     def process_reply(self, string):
         """ Process a reply before returning it to the chatbot engine. The only
         thing this does is use built-in string formatting to substitute in the
-        match results.
+        match results. Where str.format_map is available it is used, so only
+        the match results named in the string are looked up.
         """
+        if hasattr(string, "format_map"):
+            try:
+                return string.format_map(self.match)
+            except ValueError:
+                pass  # such as positional fields, let format complain
         return string.format(*[], **self.match)
 
 
@@ -213,7 +272,10 @@ class UserInfo(object):
     info: a dictionary of information about the user
     topic_name: the name of the topic the user is currently in
     msg_history: a deque containing Targets for a few recent messages
-    repl_history: a deque containing Targets for a few recent replies
+    repl_history: a deque containing LazyTargets for a few recent replies
+    lock: a threading.Lock held by ChatbotEngine.reply while replying to
+        the user, and by ChatbotEngine.reload_changed while setting up new
+        scripts for the user, so only one thread changes the user at a time
     """
     def __init__(self, info):
         self.vars = {}
@@ -221,23 +283,175 @@ class UserInfo(object):
         self.topic_name = "all"
         self.msg_history = collections.deque(maxlen=_HISTORY)
         self.repl_history = collections.deque(maxlen=_HISTORY)
+        self.lock = threading.Lock()
+
+
+_local = threading.local()
+
+
+class ReplyContext(object):
+    """ The things about a reply that the methods of Script instances
+    need, kept for each thread instead of in the instances, which are
+    shared by all users. Using one in a with statement makes it the
+    current one in the thread until the with block ends, when the one
+    before it is put back. Public instance variables:
+    userinfo: the UserInfo of the user being replied to
+    match: the match dictionary of the rule being called, or None
+    variables: the VariableLayers of user and bot variables patterns are
+        matched with, or None
+    """
+    def __init__(self, userinfo, match=None, variables=None):
+        self.userinfo = userinfo
+        self.match = match
+        self.variables = variables
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, "context", None)
+        _local.context = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.context = self._previous
+        self._previous = None
+
+
+def current_context():
+    """ Return the ReplyContext of the reply being made in this thread,
+    or None if there isn't one.
+    """
+    return getattr(_local, "context", None)
 
 # ----- a couple of useful utility functions for writers of substitute methods
 
 
+_non_alphanumerics = re.compile(r"\W+", re.UNICODE)
+
+
 def split_on_whitespace(text):
-    """ Because this has to work in Py 2.6, and re.split doesn't do UNICODE
-    in 2.6.  Return text broken into words by whitespace. """
-    matches = [m for m in re.finditer("[\S]+", text, flags=re.UNICODE)]
-    results = [text[m.span()[0]:m.span()[1]] for m in matches]
-    return results
+    """ Return text broken into words by whitespace. For unicode strings,
+    str.split with no arguments splits on the same characters as \\s does
+    with re.UNICODE."""
+    return text.split()
 
 
 def kill_non_alphanumerics(text):
     """remove any non-alphanumeric characters from a string and return the
-    result. re.sub doesn't do UNICODE in python 2.6.
+    result. re.sub doesn't take flags in python 2.6, so this uses a
+    compiled regular expression, and skips it entirely for the common case
+    of a word which is already all alphanumerics.
 
     """
-    matches = [m for m in re.finditer("[\w]+", text, flags=re.UNICODE)]
-    result = "".join([text[m.span()[0]:m.span()[1]] for m in matches])
-    return result
+    if text.isalnum():
+        return text
+    return _non_alphanumerics.sub("", text)
+
+
+class SubstitutionTable(object):
+    """ The substitutions dictionaries of all the Script subclasses in a
+    topic, combined so that each word of a message can be looked up once
+    instead of being passed through each one in turn.
+
+    Tables added one after another which strip the same characters are
+    combined into a single dictionary, in which looking up a word gives the
+    words the first table would turn it into, after the second table has
+    had a go at each of those, and so on. Tables which strip different
+    characters can't be combined, so a table which strips different
+    characters from the one before it starts a new lookup. The lookups are
+    done in the order the tables were added.
+
+    Public instance variable:
+    names - a tuple of the names of the tables which have been added
+
+    Public methods:
+    add - add another substitutions dictionary
+    lookup - return the list of words to use in place of a word
+    substitute - return lists of words to use in place of a list of words
+    substitute_joined - return strings to use in place of a list of words
+    """
+    def __init__(self):
+        self.names = ()
+        self._passes = []
+
+    def add(self, name, substitutions, strip=""):
+        """ Add a dictionary of words and the text to replace them with.
+        The keys are compared to the words of messages after they are
+        lower cased and have any of the characters in strip removed from
+        the end. Words that aren't found are left alone.
+        """
+        table = dict((self._key(word, strip), text.split())
+                     for word, text in substitutions.items())
+        combined = {}
+        if self._passes and self._passes[-1][0] == strip:
+            combined = self._passes.pop()[1]
+        for key, words in combined.items():
+            combined[key] = [new for word in words
+                             for new in table.get(self._key(word, strip),
+                                                  [word])]
+        for key, words in table.items():
+            combined.setdefault(key, words)
+        self._passes.append((strip, combined))
+        self.names += (name,)
+
+    @staticmethod
+    def _key(word, strip):
+        return word.lower().rstrip(strip) if strip else word.lower()
+
+    def lookup(self, word):
+        """ Return a new list of the words which should replace word """
+        return self.substitute([word])[0]
+
+    def substitute(self, words):
+        """ Given a list of words, return a list containing a new list of
+        words to replace each one.
+        """
+        results = [[word] for word in words]
+        for n, (strip, table) in enumerate(self._passes):
+            if n == 0:
+                results = [[word] if found is None else list(found)
+                           for word, found in zip(
+                               words, self._find_all(words, strip, table))]
+                continue
+            get = table.get
+            for i, wl in enumerate(results):
+                if len(wl) == 1:
+                    key = wl[0].lower()
+                    found = get(key.rstrip(strip) if strip else key)
+                    if found is not None:
+                        results[i] = list(found)
+                else:
+                    results[i] = [new for w in wl
+                                  for new in get(self._key(w, strip), [w])]
+        return results
+
+    def substitute_joined(self, words, joiner):
+        """ Given a list of words, return a list of strings to replace
+        them with, each made by joining the words substitute would give
+        for a word with joiner, or the word itself if it has no entry. This
+        only does one lookup per word, so if there are tables which strip
+        different characters, return None.
+        """
+        if not self._passes:
+            return list(words)
+        if len(self._passes) > 1:
+            return None
+        strip, table = self._passes[0]
+        found = self._find_all(words, strip, table)
+        results = list(words)
+        for i in itertools.compress(itertools.count(), map(
+                operator.is_not, found, [None] * len(found))):
+            results[i] = joiner.join(found[i])
+        return results
+
+    @staticmethod
+    def _find_all(words, strip, table):
+        """ Look up each of a list of words in one pass's table, lower
+        casing them all at once, and return a list of the lists of words
+        found, or None for the words which aren't there.
+        """
+        keys = " ".join(words).lower().split(" ")
+        if len(keys) != len(words):  # some words contain spaces
+            keys = [word.lower() for word in words]
+        if strip:
+            keys = map(text_type.rstrip, keys, [strip] * len(keys))
+        return list(map(table.get, keys))
@@ -0,0 +1,162 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.trie, a word-level trie of all the patterns in a topic.
+
+    Instead of matching a target against each pattern's regular expression
+    in turn, the patterns of a topic can be merged into one trie whose edges
+    are words and wildcards. Optionals and alternatives become branches,
+    and memorization makes no difference to which targets match. Walking
+    the words of a target through the trie once finds every pattern that
+    matches it, so the cost depends on the length of the message rather
+    than the number of rules.
+
+    The trie only decides which patterns match. The regular expression of
+    the winning rule is still used to fill in the match dictionary, so
+    memorized text is exactly the same as it would be without the trie.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+
+_BRANCH_LIMIT = 256  # most trie nodes a single pattern may end on
+
+
+class TrieCompileError(Exception):
+    """ Raised when a pattern can't be added to a trie, because it uses
+    user or bot variables or has too many branches. Such patterns have to
+    be matched with their regular expressions instead.
+    """
+    pass
+
+
+class TrieNode(object):
+    """ A node in a PatternTrie. Instance variables:
+    words - dictionary of words and the nodes they lead to
+    wilds - dictionary of WildEdges, keyed by wildcard character, minimum
+        and maximum
+    accepts - list of values added along with patterns ending at this node
+    """
+    __slots__ = ("words", "wilds", "accepts")
+
+    def __init__(self):
+        self.words = {}
+        self.wilds = {}
+        self.accepts = []
+
+    def add_word(self, word):
+        """ Return the node reached from this one by word, making it if
+        it doesn't exist yet.
+        """
+        node = self.words.get(word)
+        if node is None:
+            node = self.words[word] = TrieNode()
+        return node
+
+    def add_wild(self, wild, minimum, maximum):
+        """ Return the node reached from this one by a wildcard, making it
+        if it doesn't exist yet. maximum is None for no maximum.
+        """
+        key = (wild, minimum, maximum)
+        edge = self.wilds.get(key)
+        if edge is None:
+            edge = self.wilds[key] = WildEdge(wild, minimum, maximum)
+        return edge.node
+
+
+class WildEdge(object):
+    """ An edge in a PatternTrie which consumes from minimum to maximum
+    words matching one of the wildcard characters.
+    """
+    __slots__ = ("accepts", "minimum", "maximum", "node")
+
+    wildcards = {"@": re.compile(r"[^_\d\W]+$", re.UNICODE).match,
+                 "#": re.compile(r"\d+$", re.UNICODE).match,
+                 "*": re.compile(r"\w+$", re.UNICODE).match}
+
+    def __init__(self, wild, minimum, maximum):
+        self.accepts = self.wildcards[wild]
+        self.minimum = minimum
+        self.maximum = maximum
+        self.node = TrieNode()
+
+
+class PatternTrie(object):
+    """ A trie built from ParsedPatterns.
+
+    Public methods:
+    add - add a pattern to the trie, with a value to return when it matches
+    match - given a list of words, return the values of all the patterns
+            that match them
+    """
+    def __init__(self):
+        self.root = TrieNode()
+
+    def add(self, parsed_pattern, variables, value):
+        """ Add a ParsedPattern to the trie. variables is used to look up
+        alternates. Raises TrieCompileError if the pattern can't be
+        represented in the trie.
+        """
+        nodes = parsed_pattern.add_to_trie([self.root], variables)
+        for node in nodes:
+            node.accepts.append(value)
+
+    def match(self, words):
+        """ Walk the list of words through the trie, and return a set of
+        the values of all the patterns which match the whole list.
+        """
+        nodes = set([self.root])
+        wilds = set()  # tuples of (WildEdge, number of words so far)
+        for word in words:
+            next_nodes = set()
+            next_wilds = set()
+            for node in nodes:
+                child = node.words.get(word)
+                if child is not None:
+                    next_nodes.add(child)
+                for edge in node.wilds.values():
+                    if edge.accepts(word):
+                        self._enter(edge, 1, next_nodes, next_wilds)
+            for edge, count in wilds:
+                if edge.accepts(word):
+                    self._enter(edge, count + 1, next_nodes, next_wilds)
+            if not next_nodes and not next_wilds:
+                return set()
+            nodes, wilds = next_nodes, next_wilds
+
+        results = set()
+        for node in nodes:
+            results.update(node.accepts)
+        return results
+
+    def _enter(self, edge, count, nodes, wilds):
+        """ Record that count words have been consumed by a wildcard edge.
+        Once the minimum is reached the node at the end of the edge can be
+        used, and until the maximum is reached the wildcard can keep going.
+        """
+        if edge.maximum is None:
+            if count >= edge.minimum:
+                nodes.add(edge.node)
+            wilds.add((edge, min(count, edge.minimum)))
+        elif count <= edge.maximum:
+            if count >= edge.minimum:
+                nodes.add(edge.node)
+            if count < edge.maximum:
+                wilds.add((edge, count))
+
+
+def unique_nodes(nodes):
+    """ Remove duplicates from a list of TrieNodes, keeping the order.
+    Raises TrieCompileError if there are too many left.
+    """
+    seen = set()
+    results = []
+    for node in nodes:
+        if node not in seen:
+            seen.add(node)
+            results.append(node)
+    if len(results) > _BRANCH_LIMIT:
+        raise TrieCompileError("Too many branches")
+    return results
@@ -6,6 +6,8 @@ import random
 import string
 from chatbot_reply import rule, Script
 
+formatter = string.Formatter()
+
 class ElizaIntroScript(Script):
     @rule("[id like to|can i|may i] talk to Eliza")
     def rule_eliza_intro(self):
@@ -18,6 +20,11 @@ class ElizaIntroScript(Script):
 class ElizaScript(Script):
     topic = "eliza"
 
+    substitutions = {"don't":"do not", "can't":"can not", "won't":"will not",
+                     "you're":"you are", "i'm" : "i am",
+                     "i've" : "i have", "you've" : "you have"}
+    substitutions_strip = string.punctuation
+
     def setup(self):
         self.alternates = {
             "be"       : "(am|is|are|was|be)",
@@ -61,29 +68,21 @@ class ElizaScript(Script):
         else:
             return super(ElizaScript, self).choose(args)
 
-    def substitute(self, text, wordlists):
-        contractions = {"don't":"do not", "can't":"can not", "won't":"will not",
-                        "you're":"you are", "i'm" : "i am",
-                        "i've" : "i have", "you've" : "you have"}
-        results = []
-        for wl in wordlists:
-            new = []
-            for word in wl:
-                stripped = word.lower().rstrip(string.punctuation)
-                new_word = contractions.get(stripped, word)
-                new.extend(new_word.split())
-            results.append(new)
-        return results
-
     def process_reply(self, string):
         """This version of process_reply does Eliza style swapping of first and
         second person, and creates a match dictionary containing swapped versions
-        of all the match variables that it then passes to str.format
+        of the match variables used in the string that it then passes to
+        str.format
         """
         reflected_matches = {}
-        for k, v in self.match.items():
-            reflected_matches[k] = v
-            reflected_matches["refl_" + k] = self.reflect(v)
+        for text, field, spec, conversion in formatter.parse(string):
+            if field is None:
+                continue
+            field = field.split(".")[0].split("[")[0]
+            k = field[len("refl_"):] if field.startswith("refl_") else field
+            if k in self.match:
+                reflected_matches[k] = self.match[k]
+                reflected_matches["refl_" + k] = self.reflect(self.match[k])
         return string.format(*[], **reflected_matches)
 
     @rule("(bye|goodbye|done|exit|quit)")
@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath("."))
 
 from test_patterns import *
 from test_reply import *
+from test_rules import *
 
 if __name__ == "__main__":
     unittest.main()
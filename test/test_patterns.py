@@ -8,7 +8,9 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from chatbot_reply.patterns import ParsedPattern
+from chatbot_reply.cache import LRUCache
+from chatbot_reply.patterns import (_ASCII_FLAG, _ATOMIC_GROUPS,
+                                    ParsedPattern, Pattern, VariableLayers)
 from chatbot_reply import PatternError
 
 import re
@@ -194,6 +196,108 @@ class PatternParserTestCase(unittest.TestCase):
                    
             
         
+    def test_PP_RequiredWords(self):
+        alternates = {"a": {"colors": "(red|blue)"}}
+        problems = [("hello world", [["hello"], ["world"]]),
+                    ("hello *", [["hello"]]),
+                    ("[hello] *", []),
+                    ("(a|b c) d", [["a", "b"], ["d"]]),
+                    ("(a|[b] c)", [["a", "c"]]),
+                    ("(a|[b]) c", [["c"]]),
+                    ("_(one|two) %u:name", [["one", "two"]]),
+                    ("my %a:colors car", [["my"], ["red", "blue"], ["car"]])]
+        for pattern, expected in problems:
+            required = ParsedPattern(pattern).required_words(alternates)
+            self.assertEqual(required, [frozenset(e) for e in expected])
+
+    def test_PP_WordCount(self):
+        alternates = {"a": {"colors": "(red|light blue)"}}
+        problems = [("hello world", (2, 2)),
+                    ("hello *", (2, None)),
+                    ("[hello] *~3", (1, 4)),
+                    ("_(a|b c [d e]) #2~3", (3, 7)),
+                    ("%u:name @", (1, None)),
+                    ("my %a:colors car", (3, 4))]
+        for pattern, expected in problems:
+            self.assertEqual(ParsedPattern(pattern).word_count(alternates),
+                             expected)
+
+    def test_Pattern_CachesRegexesWithVariables(self):
+        saved = Pattern.regex_cache
+        Pattern.regex_cache = LRUCache(2)
+        try:
+            pattern = Pattern("hello %u:name [%b:title]", {})
+            self.assertEqual(pattern.regexc, None)
+            botvars = {"title": "sir"}
+            for name, message in [("bob", "hello bob sir"),
+                                  ("jim", "hello jim"),
+                                  ("bob", "hello bob"),
+                                  ("ann", "hello ann sir"),
+                                  ("jim", "hello jim")]:
+                variables = {"u": {"name": name}, "b": botvars}
+                self.assertTrue(pattern.match(message, variables) is not None)
+            self.assertEqual(Pattern.regex_cache.hits, 1)
+            self.assertEqual(Pattern.regex_cache.misses, 4)
+            self.assertEqual(Pattern.regex_cache.evictions, 2)
+            self.assertEqual(pattern.match("hello bob", {"u": {}, "b": {}}),
+                             None)
+        finally:
+            Pattern.regex_cache = saved
+
+    def test_Pattern_Matches_With_VariableLayers(self):
+        pattern = Pattern("%a:greet %u:name", {"a": {"greet": "(hi|hello)"}})
+        variables = VariableLayers({"u": {"name": "bob"}}, None,
+                                   {"b": {}, "u": {"name": "jim"}})
+        self.assertEqual(variables["u"], {"name": "bob"})
+        self.assertTrue("b" in variables)
+        self.assertFalse("a" in variables)
+        self.assertRaises(KeyError, lambda: variables["a"])
+        self.assertTrue(pattern.match("hello bob", variables) is not None)
+        self.assertEqual(pattern.match("hello jim", variables), None)
+
+    @unittest.skipIf(not _ATOMIC_GROUPS, "needs Python 3.11 or later")
+    def test_Pattern_Atomic_MatchesSameAsPlain(self):
+        alternates = {"a": {"colors": "(red|blue|light yellow)"}}
+        patterns = ["* * * x", "_* is _* of _*", "[*] the machine [*]",
+                    "_@ [_#] is _*~2", "my _%a:colors [*1] car _*",
+                    "(a|b *) _*2~3", "x _* y * z *"]
+        messages = ["x", "a b x", "the x is y of z", "the machine",
+                    "what about the machine now", "fred 12 is here",
+                    "fred is here now", "my red car is fast",
+                    "my light yellow old car goes", "a b c", "b c d e f",
+                    "x y z", "x a y b z c", "x a  y b z c", "a b  c d"]
+        for raw in patterns:
+            plain = Pattern(raw, alternates)
+            atomic = Pattern(raw, alternates, atomic=True)
+            self.assertNotEqual(plain.regexc.pattern, atomic.regexc.pattern)
+            for message in messages:
+                m1 = plain.match(message, {})
+                m2 = atomic.match(message, {})
+                self.assertEqual(m1 and m1.groupdict(),
+                                 m2 and m2.groupdict())
+
+    @unittest.skipIf(_ASCII_FLAG is None, "needs Python 3.7 or later")
+    def test_Pattern_Ascii_FallsBackToUnicode(self):
+        variables = {"u": {"name": "zoë"}, "b": {}}
+        pattern = Pattern("_* [and] _@", {})
+        variable_pattern = Pattern("hi %u:name _*", {})
+        for p in (pattern, variable_pattern):
+            p.set_ascii(True)
+            self.assertTrue(p.ascii)
+        self.assertTrue(pattern.regexc.flags & re.ASCII)
+        self.assertEqual(pattern.match("me and you", variables).groupdict(),
+                         {"match0": "me", "match1": "you"})
+        self.assertEqual(pattern.match("me and été", variables).groupdict(),
+                         {"match0": "me", "match1": "été"})
+        self.assertEqual(variable_pattern.match("hi zoë ça va",
+                                                variables).group("match0"),
+                         "ça va")
+        self.assertEqual(variable_pattern.match("hi zoë x",
+                                                variables).group("match0"),
+                         "x")
+        pattern.set_ascii(False)
+        self.assertFalse(pattern.regexc.flags & re.ASCII)
+
     def score(self, string):
         return ParsedPattern(string).score()
 
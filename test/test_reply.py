@@ -8,17 +8,24 @@
 
 """
 from __future__ import print_function
+import gc
 import logging
 import os
 import shutil
+import sys
 import tempfile
+import threading
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
 
 from chatbot_reply import ChatbotEngine
 from chatbot_reply import PatternError, RecursionTooDeepError, NoRulesFoundError
-from chatbot_reply.reply import Target
+from chatbot_reply import BundleError, prefork
+from chatbot_reply.patterns import _ASCII_FLAG
+from chatbot_reply.reply import LazyTarget, Target, normalize_messages
+from chatbot_reply.rules import Topic
+from chatbot_reply.script import SubstitutionTable
 
 class TestHandler(logging.Handler):
     def emit(self, record):
@@ -42,8 +49,100 @@ class TargetTestCase(unittest.TestCase):
             self.assertEqual(len(t.raw_words), len(t.tokenized_words))
             for wl in t.tokenized_words:
                 self.assertTrue(isinstance(wl, list))
-            
-            
+
+    def test_Target_Offsets_Locate_Words(self):
+        expand = [("expand", lambda text, wl: [["i", "am"] if w == ["I'm"]
+                                               else w for w in wl])]
+        for p, subs in [("Wazzup! :) Ça   va?", []), ("", []),
+                        ("I'm  FINE, thanks", expand)]:
+            t = Target(p, subs)
+            self.assertEqual(len(t.offsets), len(t.tokenized_words))
+            self.assertEqual(t.normalized, " ".join(
+                " ".join(wl) for wl in t.tokenized_words))
+            for offset, wl in zip(t.offsets, t.tokenized_words):
+                self.assertTrue(t.normalized[offset:].startswith(
+                    " ".join(wl)))
+        self.assertEqual(Target("Wazzup! :) Ça va?").normalized,
+                         "wazzup  ça va")
+
+    def test_SubstitutionTable_Combines_Tables(self):
+        table = SubstitutionTable()
+        table.add("a", {"i'm": "i am", "u": "you"}, "!?")
+        table.add("b", {"you": "thou", "am": "be"}, "!?")
+        table.add("c", {"be": "exist"})
+        self.assertEqual(table.names, ("a", "b", "c"))
+        self.assertEqual(table.lookup("I'm!"), ["i", "exist"])
+        self.assertEqual(table.lookup("U?"), ["thou"])
+        self.assertEqual(table.lookup("be!"), ["be!"])
+        self.assertEqual(table.lookup("Hello?"), ["Hello?"])
+        table.lookup("u").append("changed")
+        self.assertEqual(table.lookup("u"), ["thou"])
+
+        upper = [("upper", lambda text, wl: [[w.upper() for w in l]
+                                             for l in wl])]
+        t = Target("Hey, I'm  tired", upper, table)
+        self.assertEqual(t.tokenized_words, [["hey"], ["i", "exist"],
+                                             ["tired"]])
+        self.assertEqual(t.normalized, "hey i exist tired")
+        self.assertEqual(list(t.offsets), [0, 4, 12])
+
+    def test_SubstitutionTable_KeepsOrder_OfDifferentStrips(self):
+        table = SubstitutionTable()
+        table.add("a", {"hi": "hello"}, "!")
+        table.add("b", {"hello!": "greetings"})
+        table.add("c", {"greetings": "salutations"}, "!")
+        self.assertEqual(table.lookup("hi!"), ["hello"])
+        self.assertEqual(table.lookup("hello!"), ["salutations"])
+        self.assertEqual(table.lookup("hello"), ["hello"])
+
+
+    def test_LazyTarget_MakesTargetOnce_WhenRead(self):
+        subs = [("upper", lambda text, wl: [[w.upper() for w in l]
+                                            for l in wl])]
+        make = Mock(side_effect=lambda text, topic_name: Target(text, subs))
+        lt = LazyTarget("Hello, there", "all", make)
+        self.assertEqual(lt.raw_text, "Hello, there")
+        self.assertEqual(lt.topic_name, "all")
+        self.assertFalse(make.called)
+        self.assertEqual(lt.normalized, "hello there")
+        self.assertEqual(lt.tokenized_words, [["hello"], ["there"]])
+        make.assert_called_once_with("Hello, there", "all")
+        self.assertTrue(isinstance(lt.target, Target))
+        self.assertRaises(AttributeError, getattr, lt, "_missing")
+
+    def test_NormalizeMessages_MatchesTarget(self):
+        messages = ["Wazzup! :) Ça   va?", "", ":)", "I'm  FINE, thanks",
+                    "ΟΔΟΣ", "line\nbreak", "x_y z"] * 3
+        topic = Topic()
+        topic.add_substitution_table("t", {"i'm": "i am"}, ",")
+        topic.add_substitutions([("expand", lambda text, wl: [
+            w + ["!"] if w == ["thanks"] else w for w in wl])])
+        for t in [None, topic]:
+            subs, table = [], None
+            if t is not None:
+                subs, table = t.substitutions, t.substitution_table
+            expected = [(target.normalized, list(target.offsets))
+                        for target in [Target(m, subs, table)
+                                       for m in messages]]
+            for processes in [None, 2]:
+                results = normalize_messages(iter(messages), t, processes,
+                                             chunksize=4)
+                self.assertEqual([(n, list(o)) for n, o in results],
+                                 expected)
+
+    def test_NormalizeMessages_TableOnly_MatchesTarget(self):
+        messages = ["I'm  FINE, thanks", "You're gone?!", "!! x", "ok",
+                    "Two. words", "Ça va", "a\x01b", "GONE"]
+        topic = Topic()
+        topic.add_substitution_table("t", {"i'm": "i am", "gone": "",
+                                           "you're": "you are"}, ",.?!")
+        for chunk in [messages[:5], messages]:
+            expected = [(target.normalized, list(target.offsets))
+                        for target in [Target(m, [], topic.substitution_table)
+                                       for m in chunk]]
+            results = normalize_messages(chunk, topic)
+            self.assertEqual([(n, list(o)) for n, o in results], expected)
+
 class ChatbotEngineTestCase(unittest.TestCase):
     def setUp(self):
 
@@ -167,6 +266,20 @@ class TestScript(Script):
                                       self.scripts_dir)
         
 
+    def test_Load_Raises_OnMalformedSubstitutions(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    substitutions = {"u": 2}
+    @rule("hello")
+    def rule_foo(self):
+        pass
+"""
+        self.write_py(py)
+        self.assertRaisesCheckMessage(TypeError,
+                                      "substitutions of test.TestScript",
+                                      self.ch.load_script_directory,
+                                      self.scripts_dir)
+
     def test_Load_RaisesNoRulesFoundError_OnTopicNone(self):
         py = self.py_imports + b"""
 class TestScript(Script):
@@ -490,6 +603,650 @@ class TestScriptTest(Script):
                         (100, u"1 2 3", u"pass all")]
         self.have_conversation(py, conversation)
 
+    def test_Reply_Reuses_CachedTargets(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def substitute(self, text, wordlists):
+        return [[{"u": "you"}.get(w, w) for w in wl] for wl in wordlists]
+    @rule("yes")
+    def rule_yes(self):
+        return "<thank you>"
+    @rule("thank you")
+    def rule_thanks(self):
+        return "ok"
+"""
+        self.ch = ChatbotEngine(target_cache_size=2)
+        conversation = [(100, u"yes", u"ok"), (100, u"thank u", u"ok"),
+                        (100, u"yes", u"ok"), (100, u"yes", u"ok")]
+        self.have_conversation(py, conversation)
+        cache = self.ch.target_cache
+        self.assertEqual(len(cache), 2)
+        # "thank u" pushes out "yes", which pushes out "thank you"
+        self.assertEqual(cache.misses, 5)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.evictions, 3)
+        # replies are only normalized when something looks at them
+        self.assertEqual(self.ch._users[100].repl_history[0].normalized, "ok")
+        self.assertEqual(cache.misses, 6)
+
+        self.ch.load_script_directory(self.scripts_dir)
+        self.assertEqual(len(cache), 0)
+        self.ch.clear_rules()
+        self.assertEqual(cache.hits + cache.misses, 0)
+
+    def test_Reply_Uses_SubstitutionTablesThenMethods(self):
+        py = self.py_imports + b"""
+import string
+class TestScript(Script):
+    substitutions = {"u": "you", "r": "are"}
+    substitutions_strip = string.punctuation
+    def substitute(self, text, wordlists):
+        return [["thou" if w == "you" else w for w in wl] for wl in wordlists]
+    @rule("how are thou _*")
+    def rule_how(self):
+        return "{raw_match0}"
+
+class TestScriptOther(Script):
+    def setup(self):
+        self.substitutions = {"how": "who"}
+    @rule("who are thou")
+    def rule_who(self):
+        return "me"
+"""
+        conversation = [(100, u"How r u?", u"me"),
+                        (100, u"How? R U today?!", u"today?!")]
+        self.have_conversation(py, conversation)
+        table = self.ch.rules_db.topics["all"].substitution_table
+        self.assertEqual(sorted(table.names),
+                         ["test.TestScript", "test.TestScriptOther"])
+
+    @unittest.skipIf(_ASCII_FLAG is None, "needs Python 3.7 or later")
+    def test_Reply_AsciiMode_OnlyInTopicsWithAsciiPatterns(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.alternates = {"hi": "(hello|hi)"}
+    @rule("%a:hi _*")
+    def rule_hello(self):
+        return "hi {raw_match0}"
+    @rule("go to the cafe")
+    def rule_cafe(self):
+        self.current_topic = "cafe"
+        return "ok"
+"""
+        self.ch = ChatbotEngine(ascii=True)
+        conversation = [(100, u"Hello, Robot!", u"hi Robot!"),
+                        (100, u"hi Zoë", u"hi Zoë")]
+        self.have_conversation(py, conversation)
+        self.assertTrue(self.ch.rules_db.topics["all"].ascii)
+
+        py = self.py_encoding + py + b"""
+class TestScriptCafe(Script):
+    topic = "cafe"
+    @rule("caf\xc3\xa9 _*")
+    def rule_cafe(self):
+        return "coffee"
+    @rule("(hello|hi) _*")
+    def rule_hello(self):
+        self.current_topic = "all"
+        return "bye {raw_match0}"
+"""
+        self.ch.clear_rules()
+        conversation = [(100, u"go to the cafe", u"ok"),
+                        (100, u"Café au lait", u"coffee"),
+                        (100, u"hi Zoë", u"bye Zoë"),
+                        (100, u"hi Zoë", u"hi Zoë")]
+        self.have_conversation(py, conversation)
+        self.assertTrue(self.ch.rules_db.topics["all"].ascii)
+        self.assertFalse(self.ch.rules_db.topics["cafe"].ascii)
+
+    def test_Load_Reuses_CachedPatterns(self):
+        cache_dir = os.path.join(self.scripts_dir, "cache")
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.alternates = {"hi": "(hello|hi)"}
+    @rule("%a:hi _*")
+    def rule_hello(self):
+        return "hi {raw_match0}"
+    @rule("who are you", "hi *")
+    def rule_who(self):
+        return "a robot"
+"""
+        self.write_py(py)
+        conversation = [(100, u"Hello, Robot!", u"hi Robot!"),
+                        (100, u"who are you", u"a robot")]
+        for i in range(2):
+            self.ch = ChatbotEngine()
+            self.ch.load_script_directory(self.scripts_dir,
+                                          cache_dir=cache_dir)
+            for user, msg, rep in conversation:
+                self.assertEqual(self.ch.reply(user, {}, msg), rep)
+            cache = self.ch.rules_db.rule_cache
+            self.assertEqual((cache.hits, cache.misses), (i * 5, 5 - i * 5))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        self.write_py(py.replace(b"a robot", b"a chatbot"))
+        self.ch = ChatbotEngine()
+        self.ch.load_script_directory(self.scripts_dir, cache_dir=cache_dir)
+        cache = self.ch.rules_db.rule_cache
+        self.assertEqual((cache.hits, cache.misses), (0, 5))
+        conversation[1] = (100, u"who are you", u"a chatbot")
+        for user, msg, rep in conversation:
+            self.assertEqual(self.ch.reply(user, {}, msg), rep)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        with patch("chatbot_reply.rulecache.pattern_source_digest",
+                   return_value="changed"):
+            self.ch = ChatbotEngine()
+            self.ch.load_script_directory(self.scripts_dir,
+                                          cache_dir=cache_dir)
+        cache = self.ch.rules_db.rule_cache
+        self.assertEqual((cache.hits, cache.misses), (0, 5))
+        self.assertFalse(self.errorlogger.called)
+
+    def test_Load_InProcesses_MatchesSerialLoad(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.alternates = {"hi": "(hello|hi)"}
+    @rule("%a:hi _*")
+    def rule_hello(self):
+        return "hi {raw_match0}"
+    @rule("who are you", "hi *")
+    def rule_who(self):
+        return "a robot"
+    @rule("*")
+    def rule_star(self):
+        return "what?"
+"""
+        self.write_py(py)
+        other = self.py_imports + b"""
+class OtherScript(Script):
+    @rule("[well] what are you")
+    def rule_what(self):
+        return "a chatbot"
+"""
+        self.write_py(other, filename="other.py")
+        conversation = [(100, u"Hello, Robot!", u"hi Robot!"),
+                        (100, u"who are you", u"a robot"),
+                        (100, u"who are you", u"what?"),
+                        (100, u"what are you", u"a chatbot")]
+        rules = []
+        for processes in [None, 2]:
+            self.ch = ChatbotEngine()
+            parse = self.ch.rules_db._parse_alternates
+            with patch.object(self.ch.rules_db, "_parse_alternates",
+                              side_effect=parse) as parse_alternates:
+                self.ch.load_script_directory(self.scripts_dir,
+                                              processes=processes)
+            self.assertEqual(parse_alternates.call_count, 1)
+            for user, msg, rep in conversation:
+                self.assertEqual(self.ch.reply(user, {}, msg), rep)
+            rules.append([(r.rulename, r.pattern.formatted_pattern,
+                           r.previous.formatted_pattern)
+                          for r in self.ch.rules_db.topics["all"].sortedrules])
+        self.assertEqual(rules[0], rules[1])
+        self.assertFalse(self.errorlogger.called)
+
+    def test_Load_InProcesses_RaisesPatternError_NamingRule(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    @rule("hello")
+    def rule_foo(self):
+        pass
+    @rule("hello", "(_)")
+    def rule_bar(self):
+        pass
+"""
+        self.write_py(py)
+        with self.assertRaises(PatternError) as cm:
+            self.ch.load_script_directory(self.scripts_dir, processes=2)
+        self.assertIn("in previous pattern of test.TestScript.rule_bar",
+                      cm.exception.args[0])
+
+    def test_ReloadChanged_RebuildsAffectedTopics_KeepsUsers(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.botvars.setdefault("count", 0)
+    def setup_user(self, user):
+        self.uservars["name"] = "stranger"
+    @rule("my name is _*")
+    def rule_name(self):
+        self.uservars["name"] = self.match["raw_match0"]
+        return "ok"
+    @rule("go to the cafe")
+    def rule_cafe(self):
+        self.botvars["count"] += 1
+        self.current_topic = "cafe"
+        return "ok"
+"""
+        cafe = self.py_imports + b"""
+class CafeScript(Script):
+    topic = "cafe"
+    def setup_user(self, user):
+        self.uservars["order"] = "coffee"
+    @rule("hello")
+    def rule_hello(self):
+        return "hello {0}, {1}?".format(self.uservars["name"],
+                                         self.uservars["order"])
+"""
+        conversation = [(100, u"my name is Fred", u"ok"),
+                        (100, u"go to the cafe", u"ok"),
+                        (100, u"hello", u"hello Fred, coffee?")]
+        self.write_py(cafe, filename="cafe.py")
+        self.have_conversation(py, conversation)
+        self.assertEqual(self.ch.reload_changed(), [])
+        topic_all = self.ch.rules_db.topics["all"]
+
+        self.write_py(cafe.replace(b"coffee", b"tea or coffee"),
+                      filename="cafe.py")
+        self.write_py(self.py_imports + b"""
+class NewScript(Script):
+    topic = "cafe"
+    @rule("bye")
+    def rule_bye(self):
+        self.current_topic = "all"
+        return "bye after {0}".format(self.botvars["count"])
+""", filename="new.py")
+        self.assertEqual(self.ch.reload_changed(),
+                         [os.path.join(self.scripts_dir, "cafe.py"),
+                          os.path.join(self.scripts_dir, "new.py")])
+        self.assertIs(self.ch.rules_db.topics["all"], topic_all)
+        self.assertEqual(len(self.ch.rules_db.script_instances), 3)
+        conversation = [(100, u"hello", u"hello Fred, coffee?"),
+                        (100, u"bye", u"bye after 1"),
+                        (200, u"go to the cafe", u"ok"),
+                        (200, u"hello", u"hello stranger, tea or coffee?")]
+        for user, msg, rep in conversation:
+            self.assertEqual(self.ch.reply(user, {}, msg), rep)
+
+        os.remove(os.path.join(self.scripts_dir, "cafe.py"))
+        self.assertEqual(self.ch.reload_changed(),
+                         [os.path.join(self.scripts_dir, "cafe.py")])
+        self.assertEqual(self.ch.reply(200, {}, u"hello"), u"")
+        self.assertEqual(self.ch.reply(200, {}, u"bye"), u"bye after 2")
+        self.assertFalse(self.errorlogger.called)
+
+    def test_ReloadChanged_KeepsOldRules_OnError(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    @rule("hello")
+    def rule_hello(self):
+        return "hi"
+"""
+        self.have_conversation(py, [(100, u"hello", u"hi")])
+        self.write_py(py + b"""
+    @rule("(_)")
+    def rule_broken(self):
+        return "broken"
+""")
+        with self.assertRaises(PatternError):
+            self.ch.reload_changed()
+        self.assertEqual(self.ch.reply(100, {}, u"hello"), u"hi")
+        self.assertEqual(len(self.ch.rules_db.topics["all"].rules), 1)
+
+    def test_ReloadChanged_PreviousReply_UsesNewSubstitutions(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.substitutions = {"hi": "hello"}
+    @rule("hello")
+    def rule_hello(self):
+        return "hi there"
+"""
+        self.have_conversation(py, [(100, u"hi", u"hi there")])
+        self.write_py(py.replace(b'"hello"}', b'"hello", "there": "friend"}')
+                      + b"""
+    @rule("yes", "hello friend")
+    def rule_yes(self):
+        return "good"
+""")
+        self.ch.reload_changed()
+        self.assertEqual(self.ch.reply(100, {}, u"yes"), u"good")
+
+    def test_ReloadChanged_KeepsUserAndBotVariables(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    def setup(self):
+        self.botvars["greeting"] = "hello"
+    def setup_user(self, user):
+        self.uservars["Eliza replies"] = {}
+        self.uservars["Eliza remembers"] = []
+    @rule("remember _*")
+    def rule_remember(self):
+        self.uservars["Eliza remembers"].append(self.match["raw_match0"])
+        self.uservars["Eliza replies"]["remember"] = 1
+        return "{0}, ok".format(self.botvars["greeting"])
+    @rule("recall")
+    def rule_recall(self):
+        return " ".join(self.uservars["Eliza remembers"])
+"""
+        self.have_conversation(py, [(100, u"remember cats", u"hello, ok")])
+        self.write_py(py.replace(b'"hello"', b'"hi"') + b"""
+    @rule("count")
+    def rule_count(self):
+        return str(len(self.uservars["Eliza replies"]))
+""")
+        self.assertEqual(self.ch.reload_changed(),
+                         [os.path.join(self.scripts_dir, "test.py")])
+        conversation = [(100, u"recall", u"cats"),
+                        (100, u"count", u"1"),
+                        (100, u"remember dogs", u"hello, ok"),
+                        (100, u"recall", u"cats dogs"),
+                        (200, u"count", u"0")]
+        for user, msg, rep in conversation:
+            self.assertEqual(self.ch.reply(user, {}, msg), rep)
+
+    def test_Reply_LazyMode_BuildsTopicsOnEntry(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    @rule("go to the cafe")
+    def rule_cafe(self):
+        self.current_topic = "cafe"
+        return "ok"
+
+class TestScriptCafe(Script):
+    topic = "cafe"
+    @rule("hello")
+    def rule_hello(self):
+        return "coffee?"
+    @rule("(_)")
+    def rule_broken(self):
+        return "broken"
+"""
+        self.ch = ChatbotEngine(lazy=True)
+        self.write_py(py)
+        self.ch.load_script_directory(self.scripts_dir)
+        topics = self.ch.rules_db.topics
+        self.assertEqual(len(topics["cafe"].rules), 0)
+        self.assertEqual(topics["cafe"].rule_count(), 2)
+        self.assertEqual(len(topics["all"].rules), 0)
+        self.assertEqual(self.ch.reply(100, {}, u"hello"), u"")
+        self.assertEqual(len(topics["all"].rules), 1)
+        with self.assertRaises(PatternError) as cm:
+            self.ch.reply(100, {}, u"go to the cafe")
+        self.assertIn("test.TestScriptCafe.rule_broken",
+                      cm.exception.args[0])
+
+    def test_Load_ImportsPackages_ReturnsReport(self):
+        os.makedirs(os.path.join(self.scripts_dir, "cafe", "menu"))
+        self.write_py(b"", filename=os.path.join("cafe", "__init__.py"))
+        self.write_py(b'DRINK = "coffee"',
+                      filename=os.path.join("cafe", "drinks.py"))
+        self.write_py(self.py_imports + b"""
+from ..drinks import DRINK
+class TestScriptMenu(Script):
+    @rule("what is on the menu")
+    def rule_menu(self):
+        return DRINK
+""", filename=os.path.join("cafe", "menu", "__init__.py"))
+        self.write_py(self.py_imports + b"""
+class TestScript(Script):
+    @rule("hello")
+    def rule_hello(self):
+        return "hi"
+    @rule("goodbye")
+    def rule_goodbye(self):
+        return "bye"
+""")
+        self.write_py(self.py_imports, filename="nothing.py")
+        report = self.ch.load_script_directory(self.scripts_dir,
+                                               bytecode=False)
+        self.assertEqual(self.ch.reply(100, {}, u"what is on the menu"),
+                         u"coffee")
+        menu = os.path.join(self.scripts_dir, "cafe", "menu", "__init__.py")
+        self.assertEqual(
+            list(report.files),
+            [os.path.join(self.scripts_dir, "cafe", "__init__.py"),
+             os.path.join(self.scripts_dir, "cafe", "drinks.py"),
+             menu,
+             os.path.join(self.scripts_dir, "nothing.py"),
+             os.path.join(self.scripts_dir, "test.py")])
+        self.assertEqual([times[2] for times in report.files.values()],
+                         [0, 0, 1, 0, 2])
+        self.assertEqual(len(report.slowest(2)), 2)
+        self.assertIn(menu, report.format())
+        for path, dirs, files in os.walk(self.scripts_dir):
+            self.assertNotIn("__pycache__", dirs)
+
+    def test_LoadBundle_MatchesLoadScriptDirectory(self):
+        py = self.py_imports + b"""
+class TestScriptMain(Script):
+    def setup(self):
+        self.alternates = {"num": "(1|one)"}
+        self.botvars["greeting"] = "hello"
+    def substitute(self, text, wordlists):
+        sub = {"3":"three"}
+        return [[sub.get(w, w) for w in wl] for wl in wordlists]
+    @rule("%a:num 2 three")
+    def rule_count(self):
+        return "counted"
+    @rule("change topic")
+    def rule_change_topic(self):
+        self.current_topic = "test"
+        return "changed to test"
+    @rule("%b:greeting")
+    def rule_greeting(self):
+        return "hi"
+    @rule("*")
+    def rule_star(self):
+        return "what?"
+
+class TestScriptTest(Script):
+    topic = "test"
+    substitutions = {"1": "one"}
+    @rule("one 2 3")
+    def rule_topic(self):
+        return "pass test"
+    @rule("why", "pass test")
+    def rule_why(self):
+        return "because"
+"""
+        conversation = [(100, u"1 2 3", u"counted"),
+                        (100, u"hello", u"hi"),
+                        (100, u"change topic", u"changed to test"),
+                        (100, u"1 2 3", u"pass test"),
+                        (100, u"why", u"because")]
+        self.have_conversation(py, conversation)
+        bundle = os.path.join(self.scripts_dir, "test.bundle")
+        self.ch.save_bundle(bundle)
+        old_topics = self.ch.rules_db.topics
+
+        self.ch = ChatbotEngine()
+        self.ch.load_bundle(bundle, self.scripts_dir)
+        for user, msg, rep in conversation:
+            self.assertEqual(self.ch.reply(user, {}, msg), rep)
+        topics = self.ch.rules_db.topics
+        self.assertEqual(sorted(topics), sorted(old_topics))
+        for name, topic in topics.items():
+            self.assertEqual([r.rulename for r in topic.sortedrules],
+                             [r.rulename for r in old_topics[name].sortedrules])
+        self.assertFalse(self.errorlogger.called)
+
+        with self.assertRaises(BundleError):
+            ChatbotEngine(matcher="trie").load_bundle(bundle, self.scripts_dir)
+        self.write_py(py.replace(b"counted", b"counted again"))
+        with self.assertRaises(BundleError):
+            ChatbotEngine().load_bundle(bundle, self.scripts_dir)
+
+    def test_LoadBundle_KeepsOldRules_OnError(self):
+        py = self.py_imports + b"""
+import os
+if os.path.exists(os.path.join(os.path.dirname(__file__), "fail")):
+    raise RuntimeError("failed on purpose")
+class TestScript(Script):
+    @rule("hello")
+    def rule_hello(self):
+        return "hi"
+"""
+        self.have_conversation(py, [(100, u"hello", u"hi")])
+        bundle = os.path.join(self.scripts_dir, "test.bundle")
+        self.ch.save_bundle(bundle)
+        self.ch.load_bundle(bundle, self.scripts_dir)
+        topics = self.ch.rules_db.topics
+        open(os.path.join(self.scripts_dir, "fail"), "w").close()
+        with self.assertRaises(RuntimeError):
+            self.ch.load_bundle(bundle, self.scripts_dir)
+        self.assertIs(self.ch.rules_db.topics, topics)
+        self.assertEqual(len(self.ch.rules_db.script_instances), 1)
+        self.assertEqual(self.ch.reply(100, {}, u"hello"), u"hi")
+        self.assertEqual(self.ch.reload_changed(), [])
+
+    def test_Reply_FromManyThreads_KeepsUsersApart(self):
+        py = self.py_imports + b"""
+import time
+class TestScript(Script):
+    def setup_user(self, user):
+        self.uservars["count"] = 0
+    @rule("my name is _*")
+    def rule_name(self):
+        time.sleep(0)  # let the other threads run
+        self.uservars["name"] = self.match["raw_match0"]
+        self.uservars["count"] += 1
+        return "hi {raw_match0}"
+    @rule("what is my name")
+    def rule_what(self):
+        time.sleep(0)
+        return "{0} {1}".format(self.uservars["name"], self.uservars["count"])
+    @rule("go to the cafe")
+    def rule_cafe(self):
+        self.current_topic = "cafe"
+        return "welcome {0}".format(self.uservars["name"])
+
+class TestScriptCafe(Script):
+    topic = "cafe"
+    @rule("*")
+    def rule_leave(self):
+        time.sleep(0)
+        self.current_topic = "all"
+        return "bye {0}".format(self.uservars["name"])
+"""
+        self.ch = ChatbotEngine(target_cache_size=10)
+        self.write_py(py)
+        self.ch.load_script_directory(self.scripts_dir)
+        if hasattr(sys, "setswitchinterval"):
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+        errors = []
+
+        def converse(user):
+            try:
+                for i in range(50):
+                    name = "user{0}".format(user)
+                    for msg, rep in [
+                            ("my name is " + name, "hi " + name),
+                            ("what is my name", "{0} {1}".format(name, i + 1)),
+                            ("go to the cafe", "welcome " + name),
+                            ("anything", "bye " + name)]:
+                        self.assertEqual(self.ch.reply(user, {}, msg), rep)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=converse, args=(user,))
+                   for user in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertFalse(self.errorlogger.called)
+
+    def test_Reply_FromManyThreads_WhileReloading(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    @rule("go to the cafe")
+    def rule_cafe(self):
+        self.current_topic = "cafe"
+        return "ok"
+"""
+        cafe = self.py_imports + b"""
+class CafeScript(Script):
+    topic = "cafe"
+    @rule("*")
+    def rule_leave(self):
+        self.current_topic = "all"
+        return "bye"
+"""
+        self.write_py(cafe, filename="cafe.py")
+        self.write_py(py)
+        self.ch.load_script_directory(self.scripts_dir)
+        if hasattr(sys, "setswitchinterval"):
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+        errors = []
+        done = threading.Event()
+
+        def converse(user):
+            try:
+                for i in range(3000):
+                    self.assertEqual(
+                        self.ch.reply(user, {}, u"go to the cafe"), u"ok")
+                    self.assertIn(self.ch.reply(user, {}, u"anything"),
+                                  [u"bye", u""])
+            except Exception as e:
+                errors.append(e)
+
+        def reload_scripts():
+            try:
+                while not done.is_set():
+                    os.remove(os.path.join(self.scripts_dir, "cafe.py"))
+                    self.ch.reload_changed()
+                    self.write_py(cafe, filename="cafe.py")
+                    self.ch.reload_changed()
+            except Exception as e:
+                errors.append(e)
+
+        reloader = threading.Thread(target=reload_scripts)
+        reloader.start()
+        threads = [threading.Thread(target=converse, args=(user,))
+                   for user in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        reloader.join()
+        self.assertEqual(errors, [])
+
+    @unittest.skipIf(not hasattr(os, "fork"), "needs os.fork")
+    def test_ForkWorkers_ReplyFromPreloadedEngine(self):
+        py = self.py_imports + b"""
+class TestScript(Script):
+    @rule("hello _*")
+    def rule_hello(self):
+        return "hi {match0}"
+
+class TestScriptCafe(Script):
+    topic = "cafe"
+    @rule("[a] coffee please")
+    def rule_coffee(self):
+        return "here you are"
+"""
+        self.ch = ChatbotEngine(lazy=True)
+        self.write_py(py)
+        self.ch.load_script_directory(self.scripts_dir)
+        self.ch.preload()
+        for topic in self.ch.rules_db.topics.values():
+            self.assertEqual(len(topic.rules), topic.rule_count())
+            self.assertTrue(topic.rules_are_sorted)
+            for rule in topic.rules.values():
+                self.assertTrue(rule.pattern._regexc is not None)
+
+        def serve(engine, index):
+            if index == 1:
+                raise ValueError("worker failed")
+            with open(os.path.join(self.scripts_dir, "reply.txt"), "w") as f:
+                f.write(engine.reply(100, {}, u"hello there"))
+
+        if hasattr(gc, "unfreeze"):
+            self.addCleanup(gc.unfreeze)
+        pids = prefork.fork_workers(self.ch, 2, serve)
+        self.assertEqual(prefork.wait_workers(pids), [0, 1])
+        with open(os.path.join(self.scripts_dir, "reply.txt")) as f:
+            self.assertEqual(f.read(), "hi there")
+
     def assertRaisesCheckMessage(self, expected_error, expected_message,
                                  func, *args, **kwargs):
         """ assert that an error is raised, and that something useful is in 
@@ -0,0 +1,240 @@
+# coding=utf-8
+
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Unit tests for Python Chatbot Reply Generator's Topics and Rules """
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from chatbot_reply.reply import Target
+from chatbot_reply.rules import LazyRules, Match, Rule, Topic
+
+
+class TopicTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def make_topic(self, patterns, matcher="index", exact_limit=64):
+        topic = Topic(matcher=matcher, exact_limit=exact_limit)
+        rules = []
+        for pattern in patterns:
+            weight = 1
+            if isinstance(pattern, tuple):
+                pattern, weight = pattern
+            rules.append(Rule(pattern, "", weight, {}, None, pattern))
+        topic.add_rules(rules)
+        topic.sort_rules()
+        return topic
+
+    def candidates(self, topic, message):
+        return [rule.rulename
+                for rule in topic.candidate_rules(Target(message))]
+
+    def test_Topic_CandidateRules_SkipsRulesMissingRequiredWords(self):
+        topic = self.make_topic(["hello world", "hello *", "(hi|hey) *",
+                                 "* world", "[hello] *", "*"])
+        self.assertEqual(self.candidates(topic, "hello there"),
+                         ["hello *", "[hello] *", "*"])
+        self.assertEqual(self.candidates(topic, "hey world"),
+                         ["(hi|hey) *", "* world", "[hello] *", "*"])
+
+    def test_Topic_CandidateRules_KeepsSortedOrder(self):
+        patterns = ["* {0} *".format(i) for i in range(20)]
+        patterns += ["{0} *".format(i) for i in range(20)]
+        topic = self.make_topic(patterns)
+        message = " ".join(str(i) for i in range(20))
+        expected = [rule.rulename for rule in topic.sortedrules]
+        self.assertEqual(self.candidates(topic, message), expected)
+
+    def test_Topic_Trie_FindsSameRulesAsRegex(self):
+        patterns = ["hello world", "hello *", "(hi|hey) *~2", "* world",
+                    "[hello] *", "*", "_@ [_#] is _*3", "%u:name *",
+                    "i am _#1 years old", "i am @~3 years old", "[*] (a|b c)"]
+        topic = self.make_topic(patterns, matcher="trie")
+        variables = {"u": {"name": "bob"}}
+        messages = ["hello world", "hey you there", "fred 12 is a b c",
+                    "fred is a b c", "bob the builder", "i am 12 years old",
+                    "i am very very old years old", "x y z b c", "b c d", ""]
+        for message in messages:
+            target = Target(message)
+            expected = [rule.rulename for rule in topic.sortedrules
+                        if (rule.pattern.formatted_pattern == "%u:name *" and
+                            message) or
+                        rule.pattern.match(target.normalized,
+                                           variables) is not None]
+            self.assertEqual(self.candidates(topic, message), expected)
+
+    def test_Topic_ExactTable_PreservesPriorityAndMemos(self):
+        patterns = ["[can i|may i] talk to _(eliza|bob)", "can i *",
+                    ("* talk to *", 2), "status", "valve status"]
+        topic = self.make_topic(patterns)
+        self.assertEqual(len(topic._exact_rules), 3)
+        rule, m = topic.match(Target("May I talk to Bob?"), [], {})
+        self.assertEqual(rule.rulename, "* talk to *")
+        rule, m = topic.match(Target("talk to Bob?"), [], {})
+        self.assertEqual(rule.rulename, "[can i|may i] talk to _(eliza|bob)")
+        self.assertEqual(m.dict["match0"], "bob")
+        self.assertEqual(m.dict["raw_match0"], "Bob?")
+        rule, m = topic.match(Target("Valve status"), [], {})
+        self.assertEqual(rule.rulename, "valve status")
+
+        topic = self.make_topic(patterns, exact_limit=5)
+        self.assertEqual(len(topic._exact_rules), 2)
+
+    def test_Topic_CandidateRules_SkipsRulesByWordCount(self):
+        patterns = ["*6~", "*~2 *~2", "[a] *", "*~2", "%u:x [*]",
+                    "_[a|b c] d"]
+        topic = self.make_topic(patterns)
+        self.assertEqual(self.candidates(topic, "one two three"),
+                         ["[a] *", "%u:x [*]", "*~2 *~2"])
+        self.assertEqual(self.candidates(topic, "1 2 3 4 5 6 7"),
+                         ["[a] *", "%u:x [*]", "*6~"])
+        self.assertEqual(self.candidates(topic, "b c d"),
+                         ["_[a|b c] d", "[a] *", "%u:x [*]", "*~2 *~2"])
+
+    def test_Topic_CandidateRules_LargeWordCount(self):
+        patterns = ["word{0} *".format(i) for i in range(200)]
+        patterns += ["*500", "*2~1000", "word7 [*]"]
+        long_message = " ".join(["word7"] * 500)
+        for matcher in ["index", "trie"]:
+            topic = self.make_topic(patterns, matcher=matcher)
+            self.assertEqual(len(topic._min_words), len(patterns))
+            self.assertEqual(self.candidates(topic, "word7 a b"),
+                             ["word7 *", "word7 [*]", "*2~1000"])
+            self.assertEqual(self.candidates(topic, long_message),
+                             ["word7 *", "word7 [*]", "*500", "*2~1000"])
+            self.assertEqual(self.candidates(topic, long_message + " x"),
+                             ["word7 *", "word7 [*]", "*2~1000"])
+
+    def test_Topic_Dispatcher_FindsSameRuleAsLinearScan(self):
+        patterns = ["hello world", "hello *", ("(hi|hey) *~2", 2), "* world",
+                    "[hello] *", "_@ [_#] is _*3", "%u:name *",
+                    "i am _#1 years old", "i am @~3 years old", "[*] (a|b c)"]
+        indexed = self.make_topic(patterns, exact_limit=0)
+        dispatched = self.make_topic(patterns, matcher="regex", exact_limit=0)
+        self.assertEqual(len(dispatched._dispatched), len(patterns) - 1)
+        variables = {"u": {"name": "bob"}}
+        messages = ["hello world", "hey you there", "fred 12 is a b c",
+                    "bob the builder", "i am 12 years old", "x y z b c",
+                    "hey :) world", "nothing at all", ""]
+        for message in messages:
+            target = Target(message)
+            expected, m = indexed.match(target, [], variables)
+            found, m = dispatched.match(target, [], variables)
+            self.assertEqual(found and found.rulename,
+                             expected and expected.rulename)
+
+    def test_Topic_Match_SharesPatterns(self):
+        topic = Topic()
+        rules = []
+        for pattern in ["yes", "no", "*", "[*] maybe [*]"]:
+            for previous in ["do you want to continue *", "what is _*"]:
+                rules.append(Rule(pattern, previous, 1, {}, None,
+                                  "{0}/{1}".format(pattern, previous)))
+        rules.append(Rule("*", "", 0, {}, None, "fallback"))
+        topic.add_rules(rules)
+        topic.sort_rules()
+
+        self.assertEqual(topic.pattern_count(), 6)
+        calls = []
+        previous = set(rule.previous for rule in topic.sortedrules
+                       if rule.previous)
+        self.assertEqual(len(previous), 2)
+        for pattern in previous:
+            pattern.match = (
+                lambda string, variables, match=pattern.match:
+                calls.append(string) or match(string, variables))
+
+        for previous, message, expected in [
+                ("do you want to continue playing", "no",
+                 "no/do you want to continue *"),
+                ("what is your name", "i will maybe tell you",
+                 "[*] maybe [*]/what is _*"),
+                ("hello", "yes", "fallback")]:
+            del calls[:]
+            history = [Target(previous)]
+            rule, m = topic.match(Target(message), history, {})
+            self.assertEqual(rule.rulename, expected)
+            self.assertTrue(len(calls) <= 2)
+        rule, m = topic.match(Target("yes"), [], {})
+        self.assertEqual(rule.rulename, "fallback")
+
+    def test_Topic_AddRules_SharesPatternsOnlyWithSameAlternates(self):
+        colors = {"a": {"color": "(red|blue)"}}
+        topic = Topic()
+        topic.add_rules([
+            Rule("my %a:color car", "", 1, colors, None, "one"),
+            Rule("my %a:color car", "*", 1, colors, None, "two"),
+            Rule("my %a:color car", "yes", 1, {"a": {"color": "green"}},
+                 None, "three")])
+        topic.sort_rules()
+        self.assertEqual(topic.pattern_count(), 4)
+        patterns = dict((rule.rulename, rule.pattern)
+                        for rule in topic.sortedrules)
+        self.assertTrue(patterns["one"] is patterns["two"])
+        self.assertFalse(patterns["one"] is patterns["three"])
+
+    def test_Topic_Build_MakesLazyRulesOnce(self):
+        calls = []
+
+        def make_rules():
+            calls.append(1)
+            time.sleep(0.01)  # give the other threads a chance to race
+            return [Rule(pattern, "", 1, {}, None, pattern)
+                    for pattern in ["hello *", "*", "hello world"]]
+
+        topic = Topic()
+        topic.add_lazy_rules(LazyRules(make_rules, 3))
+        topic.sort_rules()
+        self.assertEqual((topic.rule_count(), len(topic.rules)), (3, 0))
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                topic.match(Target("hello world"), [], {})[0].rulename))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["hello world"] * 8)
+        self.assertEqual((topic.rule_count(), len(topic.rules)), (3, 3))
+
+
+class MatchTestCase(unittest.TestCase):
+    def test_Match_Dict_LooksUpValuesWhenRead(self):
+        rule = Rule("_* is [very] _*", "i said _*", 1, {}, None, "r")
+        target = Target("My CAR is fast!")
+        previous = Target("I said hello, Fred.")
+        m = rule.match(target, [previous], {})
+        self.assertTrue(isinstance(m, Match))
+        self.assertEqual(m.dict._values, {})
+        self.assertEqual(m.dict["raw_match1"], "fast!")
+        self.assertEqual(list(m.dict._values), ["raw_match1"])
+        self.assertTrue("raw_reply_match0" in m.dict)
+        self.assertFalse("raw_reply_match1" in m.dict)
+        self.assertFalse(0 in m.dict)
+        self.assertEqual(dict(m.dict), {
+            "match0": "my car", "match1": "fast",
+            "raw_match0": "My CAR", "raw_match1": "fast!",
+            "reply_match0": "hello fred",
+            "raw_reply_match0": "hello, Fred."})
+        self.assertEqual("{raw_match0}/{raw_reply_match0}".format(**m.dict),
+                         "My CAR/hello, Fred.")
+        m.dict["extra"] = 1
+        del m.dict["match1"]
+        self.assertEqual(len(m.dict), 6)
+        self.assertEqual(sorted(m.dict)[0], "extra")
+
+
+if __name__ == "__main__":
+    unittest.main()